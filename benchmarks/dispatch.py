@@ -0,0 +1,326 @@
+# Dispatch benchmark
+#
+# Compares the table-driven dispatch loop in `interpreter.py` against the old
+# chained `if (byte == OP_...)` loop, running the same compiled chunk.
+#
+# Usage: python benchmarks/dispatch.py [statements] [runs]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "source"))
+
+from opcodes     import *
+from compiler    import compile
+from interpreter import Interpreter, interpreter_init, interpret, make_handlers
+
+# Legacy Interpreter
+class Legacy():
+
+    stack       = []
+    stack_count = 0
+
+    chunk = None
+
+    index     = 0
+    had_error = False
+
+    global_variables = {}
+    local_variables  = []
+
+legacy = Legacy()
+
+# Push to the stack
+def push(value):
+    legacy.stack[legacy.stack_count] = value
+    legacy.stack_count += 1
+
+# Pop from the stack
+def pop():
+    value = legacy.stack[legacy.stack_count - 1]
+    legacy.stack_count -= 1
+    legacy.stack[legacy.stack_count] = 0
+    return value
+
+# Peek
+def peek(distance):
+    return legacy.stack[(legacy.stack_count - 1) - distance]
+
+# Read byte
+def read_byte():
+    legacy.index += 1
+    return legacy.chunk.code[legacy.index - 1]
+
+# Read Jump
+def read_jump():
+    legacy.index += 1
+    return (legacy.chunk.code[legacy.index - 1])
+
+# Read Constant
+def read_constant():
+    return legacy.chunk.constants[read_byte()]
+
+# Binary Op
+def binary_op(operator):
+
+    if (type(peek(0)) != float or type(peek(1)) != float):
+        legacy.had_error = True
+        return
+
+    b = float(pop())
+    a = float(pop())
+
+    if (operator == OP_ADD): push(float(a + b))
+    if (operator == OP_SUB): push(float(a - b))
+    if (operator == OP_MUL): push(float(a * b))
+    if (operator == OP_DIV): push(float(a / b))
+
+    if (operator == OP_LESS):         push(bool(a <  b))
+    if (operator == OP_LESS_THAN):    push(bool(a <= b))
+    if (operator == OP_GREATER):      push(bool(a >  b))
+    if (operator == OP_GREATER_THAN): push(bool(a >= b))
+
+# Unary Op
+def unary_op(operator):
+
+    if (type(peek(0)) != float):
+        legacy.had_error = True
+        return
+
+    a = float(pop())
+
+    if (operator == OP_NEGATE): push(float(-a))
+
+# Initialize legacy interpreter
+def legacy_init(chunk):
+
+    legacy.chunk       = chunk
+    legacy.index       = 0
+    legacy.had_error   = False
+    legacy.stack       = [0] * 255
+    legacy.stack_count = 0
+
+    legacy.local_variables = [0.0] * 255
+
+# Legacy interpret, the old loop without the runtime error reporting. Global
+# operands are slots now, so the name is looked up by slot and then hashed
+# into a dict the way the old loop did.
+def legacy_interpret():
+
+    while (not legacy.had_error):
+
+        byte = read_byte()
+
+        if (byte == OP_CONSTANT): push(read_constant())
+
+        if (byte == OP_TRUE):  push(True)
+        if (byte == OP_FALSE): push(False)
+        if (byte == OP_NULL):  push(None)
+
+        if (byte == OP_ADD):
+            if (not(type(peek(0)) == type(peek(1)))):
+                legacy.had_error = True
+                return
+
+            b = pop()
+            a = pop()
+
+            if (type(a) == str):   push(str(a + b))
+            if (type(a) == float): push(float(a + b))
+
+        if (byte == OP_SUB): binary_op(OP_SUB)
+        if (byte == OP_MUL): binary_op(OP_MUL)
+        if (byte == OP_DIV): binary_op(OP_DIV)
+        if (byte == OP_NEGATE): unary_op(OP_NEGATE)
+
+        if (byte == OP_NOT):
+            if (type(peek(0)) != bool):
+                legacy.had_error = True
+                return
+
+            a = bool(pop())
+            push(bool(not a))
+
+        if (byte == OP_NOT_EQUAL):
+            if (not(type(peek(0)) == type(peek(1)))):
+                legacy.had_error = True
+                return
+
+            b = pop()
+            a = pop()
+
+            if (type(a) == str):   push(bool(not (a == b)))
+            if (type(a) == float): push(bool(not (a == b)))
+
+        if (byte == OP_LESS): binary_op(OP_LESS)
+        if (byte == OP_LESS_THAN): binary_op(OP_LESS_THAN)
+        if (byte == OP_GREATER): binary_op(OP_GREATER)
+        if (byte == OP_GREATER_THAN): binary_op(OP_GREATER_THAN)
+
+        if (byte == OP_EQUALS):
+            if (not(type(peek(0)) == type(peek(1)))):
+                legacy.had_error = True
+                return
+
+            b = pop()
+            a = pop()
+
+            if (type(a) == float):  push(bool(a == b))
+            elif (type(a) == str):  push(bool(a == b))
+            elif (type(a) == bool): push(bool(a == b))
+            else: legacy.had_error = True
+
+        if (byte == OP_AND):
+            if (type(peek(0)) != bool or type(peek(1)) != bool):
+                legacy.had_error = True
+                return
+
+            b = pop()
+            a = pop()
+            push(bool(a and b))
+
+        if (byte == OP_OR):
+            if (type(peek(0)) != bool or type(peek(1)) != bool):
+                legacy.had_error = True
+                return
+
+            b = pop()
+            a = pop()
+            push(bool(a or b))
+
+        if (byte == OP_JUMP_IF_FALSE):
+            offset = read_jump()
+            if (not bool(peek(0))):
+                legacy.index += offset
+
+        if (byte == OP_JUMP_IF_FALSE_OR_POP or byte == OP_JUMP_IF_TRUE_OR_POP):
+            offset = read_jump()
+            if (type(peek(0)) != bool):
+                legacy.had_error = True
+                return
+
+            if (bool(peek(0)) == (byte == OP_JUMP_IF_TRUE_OR_POP)): legacy.index += offset
+            else: pop()
+
+        if (byte == OP_CHECK_BOOL):
+            if (type(peek(0)) != bool):
+                legacy.had_error = True
+                return
+
+        if (byte == OP_JUMP):
+            offset = read_jump()
+            legacy.index += offset
+
+        if (byte == OP_POP):
+            pop()
+
+        if (byte == OP_SET_GLOBAL):
+            name = str(legacy.chunk.global_names[read_byte()])
+            legacy.global_variables[name] = pop()
+
+        if (byte == OP_GET_GLOBAL):
+            name = str(legacy.chunk.global_names[read_byte()])
+            push(legacy.global_variables[name])
+
+        if (byte == OP_SET_LOCAL):
+            slot = read_byte()
+            legacy.local_variables[slot] = pop()
+
+        if (byte == OP_GET_LOCAL):
+            slot = read_byte()
+            push(legacy.local_variables[slot])
+
+        if (byte == OP_PRINT):
+            print(pop())
+
+        if (byte == OP_LOOP):
+            offset = read_jump()
+            legacy.index -= offset
+
+        if (byte == OP_EXIT):
+            break
+
+# Interpreter for the table dispatch runs
+interpreter = Interpreter()
+
+# Initialize interpreter
+def table_init(chunk):
+    interpreter_init(interpreter, chunk)
+
+# Table dispatch interpret
+def table_interpret():
+    interpret(interpreter)
+
+# Make a straight-line workload without any print statement
+def make_source(statements):
+
+    source = "global a = 1;\nglobal b = 2;\nglobal c = true;\n"
+
+    for i in range(statements):
+        source += "a = a + b * 2 - 1;\n"
+        source += "if (a > b) b = b + 1; else b = b - 1;\n"
+        source += "c = (a == b) || c;\n"
+
+    return source
+
+# Count the instructions executed by one run
+def count_instructions(chunk):
+
+    # Run once with the new handlers and count the dispatches
+    table_init(chunk)
+
+    code     = chunk.code
+    handlers = make_handlers(interpreter, code)
+    index    = 0
+    count    = 0
+
+    while (index >= 0):
+        index = handlers[code[index]](index + 1)
+        count += 1
+
+    return count
+
+# Time a single run
+def time_run(init, run, chunk, runs):
+
+    best = None
+
+    for i in range(runs):
+        init(chunk)
+
+        start   = time.perf_counter()
+        run()
+        elapsed = time.perf_counter() - start
+
+        if (best == None or elapsed < best): best = elapsed
+
+    return best
+
+# Main
+def main():
+
+    statements = int(sys.argv[1]) if (len(sys.argv) > 1) else 2000
+    runs       = int(sys.argv[2]) if (len(sys.argv) > 2) else 5
+
+    # The old loop only knows the plain opcodes, so compile without the
+    # optimizer for the comparison, and once more with it. The new loop
+    # quickens the code it runs, so the old loop gets its own copy.
+    chunk        = compile(make_source(statements), False)
+    legacy_chunk = compile(make_source(statements), False)
+    optimized    = compile(make_source(statements), True)
+
+    instructions           = count_instructions(chunk)
+    optimized_instructions = count_instructions(optimized)
+
+    old  = time_run(legacy_init, legacy_interpret, legacy_chunk, runs)
+    new  = time_run(table_init, table_interpret, chunk, runs)
+    best = time_run(table_init, table_interpret, optimized, runs)
+
+    print("instructions per run: {0} ({1} optimized)".format(instructions, optimized_instructions))
+    print("chained if loop:      {0:8.2f} ms  ({1:6.2f} M instr/s)".format(old * 1000, instructions / old / 1e6))
+    print("table dispatch loop:  {0:8.2f} ms  ({1:6.2f} M instr/s)".format(new * 1000, instructions / new / 1e6))
+    print("speedup:              {0:8.2f}x".format(old / new))
+    print("optimized bytecode:   {0:8.2f} ms  ({1:8.2f}x)".format(best * 1000, old / best))
+
+main()
@@ -0,0 +1,69 @@
+# Opcode pair miner
+#
+# Runs scripts with an instrumented dispatch loop and reports the most
+# frequent pairs of consecutive opcodes, to pick sequences worth fusing into
+# superinstructions. Scripts are compiled without superinstructions unless
+# --fused is given, so the report shows what is left to fuse.
+#
+# Usage: python benchmarks/opcode_pairs.py [--fused] [--top N] files...
+
+import contextlib
+import glob
+import io
+import os
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(root, "source"))
+
+from opcodes   import OPCODE_NAMES
+from compiler  import compile
+from optimizer import peephole
+from profiler  import interpret_pairs
+
+# Main
+def main():
+
+    arguments = sys.argv[1:]
+    fused     = "--fused" in arguments
+    top       = 20
+
+    if ("--top" in arguments):
+        top = int(arguments[arguments.index("--top") + 1])
+        del arguments[arguments.index("--top") : arguments.index("--top") + 2]
+
+    files = [x for x in arguments if (x != "--fused")]
+
+    # Default to the example and benchmark scripts
+    if (len(files) == 0):
+        files = sorted(glob.glob(os.path.join(root, "examples", "*.pr")) + glob.glob(os.path.join(root, "benchmarks", "*.pr")))
+
+    totals = {}
+
+    for file_name in files:
+
+        with open(file_name, "r") as f:
+            source = f.read()
+
+        chunk = compile(source, False)
+        if (chunk == None): continue
+
+        peephole(chunk, fused)
+
+        # The scripts' own output is not part of the report
+        with contextlib.redirect_stdout(io.StringIO()):
+            pairs = interpret_pairs(chunk)
+
+        for pair, count in pairs.items():
+            totals[pair] = totals.get(pair, 0) + count
+
+    total = sum(totals.values())
+
+    print("{0:<32} {1:<32} {2:>10} {3:>7}".format("first", "second", "count", "share"))
+
+    for (first, second), count in sorted(totals.items(), key = lambda x: -x[1])[:top]:
+
+        first = OPCODE_NAMES[first] if (first != None) else "(start)"
+        print("{0:<32} {1:<32} {2:>10} {3:>6.1f}%".format(first, OPCODE_NAMES[second], count, 100.0 * count / total))
+
+main()
@@ -0,0 +1,56 @@
+# Peephole benchmark
+#
+# Compiles every script with and without the peephole optimizer and reports
+# the instruction counts before and after.
+#
+# Usage: python benchmarks/peephole.py [files...]
+
+import glob
+import os
+import sys
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(root, "source"))
+
+from compiler  import compile
+from optimizer import count_instructions
+
+# Main
+def main():
+
+    files = sys.argv[1:]
+
+    # Default to the example and benchmark scripts
+    if (len(files) == 0):
+        files = sorted(glob.glob(os.path.join(root, "examples", "*.pr")) + glob.glob(os.path.join(root, "benchmarks", "*.pr")))
+
+    total_before = 0
+    total_after  = 0
+
+    print("{0:<40} {1:>8} {2:>8} {3:>8}".format("script", "before", "after", "saved"))
+
+    for file_name in files:
+
+        with open(file_name, "r") as f:
+            source = f.read()
+
+        before = compile(source, False)
+        after  = compile(source, True)
+
+        # Failed to compile?
+        if (before == None or after == None):
+            print("{0:<40} {1:>8}".format(os.path.basename(file_name), "error"))
+            continue
+
+        before = count_instructions(before)
+        after  = count_instructions(after)
+
+        total_before += before
+        total_after  += after
+
+        print("{0:<40} {1:>8} {2:>8} {3:>7.1f}%".format(os.path.basename(file_name), before, after, 100.0 * (before - after) / before))
+
+    if (total_before > 0):
+        print("{0:<40} {1:>8} {2:>8} {3:>7.1f}%".format("total", total_before, total_after, 100.0 * (total_before - total_after) / total_before))
+
+main()
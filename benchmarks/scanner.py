@@ -0,0 +1,70 @@
+# Scanner benchmark
+#
+# Scans a generated script with the character scanner and with the bulk
+# tokenizer, checks both produce the same tokens and reports the timings.
+#
+# Usage: python benchmarks/scanner.py [statements]
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "source"))
+
+from tokens  import TOKEN_END
+from scanner import Scanner, scanner_init, scan_token
+
+# Make a generated script
+def make_source(statements):
+
+    lines = ["global total = 0;", "global name = \"report\";"]
+
+    for i in range(statements):
+        lines.append("# statement {0}".format(i))
+        lines.append("if (total >= {0}.5) {{ total = total - 1; }} else total = total + {0} * 2;".format(i))
+        lines.append("print name + \"line\n{0}\";   var x{0} = !(total != 3) || false;".format(i))
+
+    return "\n".join(lines)
+
+# Scan every token
+def scan_all(source, bulk):
+
+    scanner = Scanner()
+    scanner_init(scanner, source, bulk)
+
+    tokens = []
+
+    while (True):
+        token = scan_token(scanner)
+        tokens.append((token.kind, token.content, token.length, token.line, token.column))
+
+        if (token.kind == TOKEN_END): return tokens
+
+# Time a scan
+def time_scan(source, bulk):
+
+    start  = time.perf_counter()
+    tokens = scan_all(source, bulk)
+
+    return (time.perf_counter() - start, tokens)
+
+# Main
+def main():
+
+    statements = int(sys.argv[1]) if (len(sys.argv) > 1) else 20000
+    source     = make_source(statements)
+
+    chars, chars_tokens = time_scan(source, False)
+    bulk,  bulk_tokens  = time_scan(source, True)
+
+    # Both scanners must agree on every token
+    if (chars_tokens != bulk_tokens):
+        print("token streams differ!")
+        sys.exit(1)
+
+    print("source size:       {0:8.2f} MB, {1} tokens".format(len(source) / 1e6, len(bulk_tokens)))
+    print("character scanner: {0:8.2f} ms".format(chars * 1000))
+    print("bulk tokenizer:    {0:8.2f} ms".format(bulk * 1000))
+    print("speedup:           {0:8.2f}x".format(chars / bulk))
+
+main()
@@ -0,0 +1,224 @@
+# Benchmark suite
+#
+# Times the scan, compile and interpret phases of every workload separately
+# over repeated runs, writes the results as JSON and flags regressions against
+# a saved baseline.
+#
+# The workloads are the `.pr` scripts in `benchmarks/`, plus a large generated
+# script. Compile times include scanning, since the compiler pulls its tokens
+# from the scanner.
+#
+# Usage: python benchmarks/suite.py [--runs N] [--output results.json]
+#                                   [--baseline baseline.json] [--threshold 0.10]
+#                                   [--statements N] [files...]
+
+import argparse
+import contextlib
+import glob
+import io
+import json
+import os
+import platform
+import statistics
+import sys
+import time
+
+root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+sys.path.insert(0, os.path.join(root, "source"))
+
+from tokens      import TOKEN_END
+from scanner     import Scanner, scanner_init, scan_token
+from compiler    import compile
+from interpreter import Interpreter, interpreter_init, interpret
+
+# Phases, in order
+PHASES = ["scan", "compile", "interpret"]
+
+# Make a large generated script
+def make_source(statements):
+
+    lines = ["global total = 0;", "global name = \"generated\";", "global flag = false;"]
+
+    for i in range(statements):
+        lines.append("# statement {0}".format(i))
+        lines.append("if (total >= {0}.5) {{ var x = total - 1; total = x; }} else total = total + {0} * 2;".format(i))
+        lines.append("flag = !(total != {0}) || flag;   name = \"line \" + \"{0}\";".format(i))
+
+    lines.append("print total;")
+
+    return "\n".join(lines) + "\n"
+
+# Load workloads, as (name, source) pairs
+def load_workloads(files, statements):
+
+    workloads = []
+
+    for file_name in files:
+        with open(file_name, "r") as f:
+            workloads.append((os.path.splitext(os.path.basename(file_name))[0], f.read()))
+
+    if (statements > 0):
+        workloads.append(("generated", make_source(statements)))
+
+    return workloads
+
+# Scan every token
+def scan(source):
+
+    scanner = Scanner()
+    scanner_init(scanner, source)
+
+    while (scan_token(scanner).kind != TOKEN_END):
+        pass
+
+# Time one run of every phase
+def time_phases(source):
+
+    times = {}
+
+    start = time.perf_counter()
+    scan(source)
+    times["scan"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    chunk = compile(source)
+    times["compile"] = time.perf_counter() - start
+
+    if (chunk == None): return None
+
+    # Keep the script output out of the report
+    with contextlib.redirect_stdout(io.StringIO()):
+
+        interpreter = Interpreter()
+        interpreter_init(interpreter, chunk)
+
+        start = time.perf_counter()
+        interpret(interpreter)
+        times["interpret"] = time.perf_counter() - start
+
+    if (interpreter.had_error): return None
+
+    return times
+
+# Get statistics of a list of times, in milliseconds
+def get_statistics(times):
+
+    times = [x * 1000 for x in times]
+
+    return {
+        "min":    min(times),
+        "max":    max(times),
+        "mean":   statistics.mean(times),
+        "median": statistics.median(times),
+        "stdev":  statistics.stdev(times) if (len(times) > 1) else 0.0
+    }
+
+# Run one workload
+def run_workload(source, runs, warmup):
+
+    times = {phase: [] for phase in PHASES}
+
+    for i in range(warmup + runs):
+
+        result = time_phases(source)
+        if (result == None): return None
+
+        # Warmup runs are not counted
+        if (i < warmup): continue
+
+        for phase in PHASES:
+            times[phase].append(result[phase])
+
+    return {phase: get_statistics(times[phase]) for phase in PHASES}
+
+# Compare results against a baseline, returns the regressions
+def find_regressions(results, baseline, threshold):
+
+    regressions = []
+
+    for name, phases in results.items():
+
+        old = baseline.get(name)
+        if (old == None): continue
+
+        for phase in PHASES:
+
+            if (phase not in old): continue
+
+            before = old[phase]["median"]
+            after  = phases[phase]["median"]
+
+            if (before > 0 and after > before * (1 + threshold)):
+                regressions.append((name, phase, before, after))
+
+    return regressions
+
+# Main
+def main():
+
+    arguments = argparse.ArgumentParser(description = "Run the pyler benchmark suite.")
+    arguments.add_argument("files", nargs = "*", help = "workload scripts, defaults to benchmarks/*.pr")
+    arguments.add_argument("--runs",       type = int,   default = 10,   help = "timed runs per workload")
+    arguments.add_argument("--warmup",     type = int,   default = 1,    help = "untimed runs per workload")
+    arguments.add_argument("--statements", type = int,   default = 2000, help = "size of the generated workload, 0 to skip it")
+    arguments.add_argument("--output",                                   help = "write the results to this JSON file")
+    arguments.add_argument("--baseline",                                 help = "compare against this JSON file")
+    arguments.add_argument("--threshold",  type = float, default = 0.10, help = "median slowdown that counts as a regression")
+
+    options = arguments.parse_args()
+
+    files = options.files
+
+    # Default to the benchmark scripts
+    if (len(files) == 0):
+        files = sorted(glob.glob(os.path.join(root, "benchmarks", "*.pr")))
+
+    results = {}
+
+    print("{0:<20} {1:<10} {2:>10} {3:>10} {4:>10} {5:>10}".format("workload", "phase", "min ms", "median ms", "mean ms", "stdev"))
+
+    for name, source in load_workloads(files, options.statements):
+
+        result = run_workload(source, options.runs, options.warmup)
+
+        # Failed to compile or run?
+        if (result == None):
+            print("{0:<20} failed".format(name))
+            continue
+
+        results[name] = result
+
+        for phase in PHASES:
+            entry = result[phase]
+            print("{0:<20} {1:<10} {2:>10.3f} {3:>10.3f} {4:>10.3f} {5:>10.3f}".format(name, phase,
+                entry["min"], entry["median"], entry["mean"], entry["stdev"]))
+
+    # Save results
+    if (options.output != None):
+
+        with open(options.output, "w") as f:
+            json.dump({
+                "python":    platform.python_version(),
+                "machine":   platform.machine(),
+                "runs":      options.runs,
+                "workloads": results
+            }, f, indent = 4)
+
+    # Compare against baseline
+    if (options.baseline != None):
+
+        with open(options.baseline, "r") as f:
+            baseline = json.load(f)["workloads"]
+
+        regressions = find_regressions(results, baseline, options.threshold)
+
+        if (len(regressions) == 0):
+            print("no regressions against '{0}'.".format(options.baseline))
+            return
+
+        for name, phase, before, after in regressions:
+            print("regression: {0} {1} {2:.3f} ms -> {3:.3f} ms ({4:+.1f}%)".format(name, phase, before, after, 100 * (after / before - 1)))
+
+        sys.exit(1)
+
+main()
@@ -0,0 +1,74 @@
+from opcodes   import *
+from optimizer import instruction_size, jump_offset
+
+# Get the net stack effect of the instruction at index, when it doesn't jump
+def stack_effect(code, index):
+
+    opcode = code[index]
+    effect = STACK_EFFECTS.get(opcode, 0)
+
+    # Calls and arrays take as many values as their operand says
+    if (opcode in [OP_CALL, OP_ARRAY, OP_ARRAY_EXTEND]): effect -= code[index + 1]
+
+    return effect
+
+# Get the stack depth right before every instruction reachable from start,
+# by the index of the instruction
+def stack_depths(chunk, start = 0):
+
+    code   = chunk.code
+    depths = {}
+    work   = [(start, 0)]
+
+    while (len(work) > 0):
+
+        index, depth = work.pop()
+
+        # Run straight through until the path ends or joins a visited one
+        while (index < chunk.count and index not in depths):
+
+            depths[index] = depth
+
+            opcode = code[index]
+            before = depth
+            depth += stack_effect(code, index)
+            end    = index + instruction_size(opcode)
+
+            # Branches, some of them leave the stack different when they jump
+            jumped = before + JUMP_STACK_EFFECTS.get(opcode, depth - before)
+
+            if (opcode in JUMP_OPCODES): work.append((end + jump_offset(code, index), jumped))
+            if (opcode in LOOP_OPCODES): work.append((end - jump_offset(code, index), jumped))
+
+            # Nothing falls through these
+            if (opcode in UNCONDITIONAL_OPCODES or opcode in [OP_EXIT, OP_RETURN]): break
+
+            index = end
+
+    return depths
+
+# Get the most values on the stack at once, following every path from start,
+# returns the depth and the index of the instruction that reaches it
+def stack_depth(chunk, start = 0):
+
+    highest = (0, start)
+
+    for index, depth in stack_depths(chunk, start).items():
+
+        depth += stack_effect(chunk.code, index)
+        if (depth > highest[0]): highest = (depth, index)
+
+    return highest
+
+# Check if a function chunk only depends on its arguments
+def is_pure(chunk):
+
+    code  = chunk.code
+    index = 0
+
+    while (index < chunk.count):
+
+        if (code[index] in IMPURE_OPCODES): return False
+        index += instruction_size(code[index])
+
+    return True
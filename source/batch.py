@@ -0,0 +1,131 @@
+from cache       import compile_file
+from scanner     import open_source
+from interpreter import Interpreter, interpreter_init, interpret
+from closure     import interpret_closures
+from output      import Output
+from utils       import ensure_recursion_limit
+
+from concurrent.futures import ProcessPoolExecutor
+from itertools          import repeat
+
+import contextlib
+import glob
+import io
+import os
+import sys
+import time
+
+# Script result
+class Result():
+
+    # Initialize
+    def __init__(self, file_name, output, elapsed, error):
+
+        self.file_name = file_name
+        self.output    = output
+        self.elapsed   = elapsed
+
+        # Why the script failed, None if it didn't
+        self.error = error
+
+# Run options, the same for every script of a batch
+class RunOptions():
+
+    # Initialize
+    def __init__(self, buffer_size = None, memo_size = 0, backend = "vm"):
+
+        # Output buffer size, None for the default one
+        self.buffer_size = buffer_size
+
+        # Results of pure functions kept per function, 0 for none
+        self.memo_size = memo_size
+
+        # Dispatch loop, "vm", or compiled closures, "closure"
+        self.backend = backend
+
+# Find scripts in a directory, or matching a glob
+def find_scripts(path):
+
+    if (os.path.isdir(path)):
+        return sorted(glob.glob(os.path.join(path, "**", "*.pr"), recursive = True))
+
+    return sorted(glob.glob(path, recursive = True))
+
+# Get the directory the scripts of a batch are found from, their outputs keep
+# their paths relative to it
+def scripts_root(path, file_names):
+
+    if (os.path.isdir(path)):
+        return path
+
+    return os.path.commonpath([os.path.dirname(x) or "." for x in file_names])
+
+# Compile and run one script, capturing its output
+def run_script(options, file_name):
+
+    output = io.StringIO()
+    error  = None
+    start  = time.perf_counter()
+
+    with contextlib.redirect_stdout(output):
+
+        try:
+            code  = open_source(file_name)
+            chunk = compile_file(file_name, code)
+
+            # Done with the source
+            if (type(code) != bytes): code.close()
+
+            # Run
+            if (chunk == None):
+                error = "compile error"
+            else:
+                interpreter = Interpreter()
+                interpreter_init(interpreter, chunk)
+
+                if (options.buffer_size != None):
+                    interpreter.output = Output(None, options.buffer_size)
+
+                interpreter.memo_size = options.memo_size
+
+                if (options.backend == "closure"):
+                    interpret_closures(interpreter)
+                else:
+                    interpret(interpreter)
+
+                if (interpreter.had_error): error = "runtime error"
+        except OSError:
+            error = "failed to read file"
+        except Exception as e:
+            error = "{0}: {1}".format(type(e).__name__, e)
+
+    return Result(file_name, output.getvalue(), time.perf_counter() - start, error)
+
+# Run scripts across a process pool, results come back in order
+def run_batch(file_names, workers = None, chunk_size = 1, options = None):
+
+    options = options if (options != None) else RunOptions()
+
+    # Workers run with the recursion limit of the process that starts them
+    with ProcessPoolExecutor(max_workers = workers, initializer = ensure_recursion_limit, initargs = (sys.getrecursionlimit(),)) as executor:
+        return list(executor.map(run_script, repeat(options), file_names, chunksize = chunk_size))
+
+# Format the batch report
+def batch_report(results, elapsed):
+
+    lines  = ["{0:<48} {1:>10}  {2}".format("script", "ms", "status")]
+    failed = 0
+
+    for result in results:
+
+        status = "ok"
+
+        if (result.error != None):
+            status = "failed, " + result.error
+            failed += 1
+
+        lines.append("{0:<48} {1:>10.3f}  {2}".format(result.file_name, result.elapsed * 1000, status))
+
+    lines.append("{0} scripts, {1} failed, {2:.3f} ms".format(len(results), failed, elapsed * 1000))
+
+    return "\n".join(lines)
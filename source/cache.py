@@ -0,0 +1,248 @@
+from array    import array
+from chunk    import Chunk, constant_key
+from compiler import compile, COMPILER_VERSION
+from function import Function
+
+import hashlib
+import os
+import struct
+import sys
+
+# Bytecode image layout, all numbers little-endian:
+#
+#   magic "PYLR" | format version (H) | compiler version (H) | sha256 of source
+#   chunk | global count (I) | global names (I + utf-8)
+#
+# where a chunk is
+#
+#   code count (I) | code cells (H) | line cells (I) | column cells (I)
+#   constant count (I) | constants, each tagged 'f' (d), 's' (I + utf-8) or
+#   'c' for a function, name (I + utf-8) | arity (I) | pure (B) | chunk
+#   local count (I) | stack size (I)
+#
+# Function chunks share the global names of the script.
+MAGIC          = b"PYLR"
+FORMAT_VERSION = 5
+
+CACHE_DIRECTORY = "__pycache__"
+CACHE_EXTENSION = ".prc"
+
+# Hash source
+def source_hash(source):
+
+    if (type(source) == str):
+        source = source.encode("utf-8")
+
+    return hashlib.sha256(source).digest()
+
+# Get cache path of a script
+def cache_path(file_name):
+
+    directory, name = os.path.split(os.path.abspath(file_name))
+    name = os.path.splitext(name)[0]
+
+    return os.path.join(directory, CACHE_DIRECTORY, "{0}.pyler-{1}{2}".format(name, COMPILER_VERSION, CACHE_EXTENSION))
+
+# Array to little-endian bytes
+def array_bytes(cells):
+
+    if (sys.byteorder == "big"):
+        cells = array(cells.typecode, cells)
+        cells.byteswap()
+
+    return cells.tobytes()
+
+# Little-endian bytes to array
+def bytes_array(typecode, data):
+
+    cells = array(typecode)
+    cells.frombytes(data)
+
+    if (sys.byteorder == "big"):
+        cells.byteswap()
+
+    return cells
+
+# Write string
+def write_string(out, value):
+
+    value = value.encode("utf-8")
+
+    out.append(struct.pack("<I", len(value)))
+    out.append(value)
+
+# Write chunk, with the chunks of its functions
+def write_chunk(out, chunk):
+
+    # Code and line table
+    out.append(struct.pack("<I", chunk.count))
+    out.append(array_bytes(chunk.code))
+    out.append(array_bytes(chunk.lines))
+    out.append(array_bytes(chunk.columns))
+
+    # Constants
+    out.append(struct.pack("<I", chunk.constants_count))
+
+    for constant in chunk.constants:
+        if (type(constant) == float):
+            out.append(b"f")
+            out.append(struct.pack("<d", constant))
+        elif (type(constant) == str):
+            out.append(b"s")
+            write_string(out, constant)
+        elif (type(constant) == Function):
+            out.append(b"c")
+            write_string(out, constant.name)
+            out.append(struct.pack("<IB", constant.arity, constant.pure))
+            write_chunk(out, constant.chunk)
+        else:
+            raise TypeError("Can't serialize constant '{0}'.".format(constant))
+
+    # Locals
+    out.append(struct.pack("<I", chunk.local_count))
+
+    # Stack
+    out.append(struct.pack("<I", chunk.stack_size))
+
+# Dump chunk to a bytecode image
+def chunk_dump(chunk, source):
+
+    out = [MAGIC, struct.pack("<HH", FORMAT_VERSION, COMPILER_VERSION), source_hash(source)]
+
+    write_chunk(out, chunk)
+
+    # Globals
+    out.append(struct.pack("<I", len(chunk.global_names)))
+
+    for name in chunk.global_names:
+        write_string(out, name)
+
+    return b"".join(out)
+
+# Bytecode image reader
+class Reader():
+
+    # Initialize
+    def __init__(self, data):
+
+        self.data  = data
+        self.index = 0
+
+    # Read raw bytes
+    def read(self, size):
+
+        if (self.index + size > len(self.data)):
+            raise ValueError("Truncated bytecode image.")
+
+        self.index += size
+        return self.data[self.index - size : self.index]
+
+    # Read packed values
+    def unpack(self, format):
+        return struct.unpack(format, self.read(struct.calcsize(format)))
+
+    # Read string
+    def read_string(self):
+        return self.read(self.unpack("<I")[0]).decode("utf-8")
+
+# Read chunk, with the chunks of its functions, they all share global names
+def read_chunk(reader, global_names):
+
+    chunk = Chunk()
+    chunk.global_names = global_names
+
+    # Code and line table
+    count = reader.unpack("<I")[0]
+
+    chunk.code    = bytes_array("H", reader.read(count * 2))
+    chunk.lines   = bytes_array("I", reader.read(count * 4))
+    chunk.columns = bytes_array("I", reader.read(count * 4))
+
+    # Constants
+    for i in range(reader.unpack("<I")[0]):
+
+        tag = reader.read(1)
+
+        if (tag == b"f"):   chunk.constants.append(reader.unpack("<d")[0])
+        elif (tag == b"s"): chunk.constants.append(reader.read_string())
+        elif (tag == b"c"):
+            function = Function(reader.read_string())
+            function.arity, function.pure = reader.unpack("<IB")
+            function.pure  = bool(function.pure)
+            function.chunk = read_chunk(reader, global_names)
+
+            chunk.constants.append(function)
+        else:
+            raise ValueError("Unknown constant tag {0}.".format(tag))
+
+    for i in range(chunk.constants_count):
+        chunk.constant_indices[constant_key(chunk.constants[i])] = i
+
+    # Locals
+    chunk.local_count = reader.unpack("<I")[0]
+
+    # Stack
+    chunk.stack_size = reader.unpack("<I")[0]
+
+    return chunk
+
+# Load chunk from a bytecode image, returns None if the image is stale
+def chunk_load(data, source):
+
+    reader = Reader(data)
+
+    # Check header
+    if (reader.read(4) != MAGIC): return None
+    if (reader.unpack("<HH") != (FORMAT_VERSION, COMPILER_VERSION)): return None
+    if (reader.read(32) != source_hash(source)): return None
+
+    chunk = read_chunk(reader, [])
+
+    # Globals
+    for i in range(reader.unpack("<I")[0]):
+        chunk.global_names.append(reader.read_string())
+
+    return chunk
+
+# Load cached chunk of a script, an image with functions nested deeper than
+# the recursion limit allows for is recompiled, which reports it
+def load_cached(file_name, source):
+
+    try:
+        with open(cache_path(file_name), "rb") as f:
+            return chunk_load(f.read(), source)
+    except (OSError, ValueError, struct.error, UnicodeDecodeError, RecursionError):
+        return None
+
+# Save compiled chunk of a script
+def save_cached(file_name, source, chunk):
+
+    path = cache_path(file_name)
+
+    # Write to a temporary file first, so a reader never sees half an image
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok = True)
+
+        temporary = "{0}.{1}.tmp".format(path, os.getpid())
+
+        with open(temporary, "wb") as f:
+            f.write(chunk_dump(chunk, source))
+
+        os.replace(temporary, path)
+    except OSError:
+        pass
+
+# Compile a script, reusing its cached bytecode if the source hasn't changed
+def compile_file(file_name, source):
+
+    # Cache hit?
+    chunk = load_cached(file_name, source)
+    if (chunk != None): return chunk
+
+    # Compile and cache
+    chunk = compile(source)
+
+    if (chunk != None):
+        save_cached(file_name, source, chunk)
+
+    return chunk
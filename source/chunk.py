@@ -1,14 +1,41 @@
+from array import array
+
+# Biggest value a single code cell can hold
+CODE_MAX = 0xFFFF
+
 # Chunk
 class Chunk():
 
-    count           = 0
-    constants_count = 0
+    # Initialize
+    def __init__(self):
+
+        # Opcodes and operands live in one 16-bit cell each, lines and columns
+        # use one 32-bit cell per code cell
+        self.code    = array("H")
+        self.lines   = array("I")
+        self.columns = array("I")
+
+        self.constants = []
+
+        # Maps each constant key to its index in the constant pool
+        self.constant_indices = {}
+
+        # Global variable names, indexed by slot, and number of local slots
+        self.global_names = []
+        self.local_count  = 0
+
+        # Most values on the stack at once, worked out after compiling
+        self.stack_size = 0
 
-    code            = []
-    lines           = []
-    columns         = []
-    constants       = []
-    local_variables = []
+    # Number of code cells
+    @property
+    def count(self):
+        return len(self.code)
+
+    # Number of constants
+    @property
+    def constants_count(self):
+        return len(self.constants)
 
 # Write to chunk
 def chunk_write(chunk, byte, line, column):
@@ -17,12 +44,69 @@ def chunk_write(chunk, byte, line, column):
     chunk.lines.append(line)
     chunk.columns.append(column)
 
-    chunk.count += 1
+# Write many cells to chunk, all at the same line and column
+def chunk_write_all(chunk, cells, line, column):
+
+    chunk.code.extend(cells)
+    chunk.lines.extend([line] * len(cells))
+    chunk.columns.extend([column] * len(cells))
+
+# Truncate chunk back to a code count and a constants count
+def chunk_truncate(chunk, count, constants_count):
+
+    del chunk.code[count:]
+    del chunk.lines[count:]
+    del chunk.columns[count:]
+
+    # Forget the dropped constants
+    for constant in chunk.constants[constants_count:]:
+        del chunk.constant_indices[constant_key(constant)]
+
+    del chunk.constants[constants_count:]
+
+# Cut the code from start to the end out of the chunk, the constants it uses
+# stay in the pool
+def chunk_cut(chunk, start):
+
+    piece = (chunk.code[start:], chunk.lines[start:], chunk.columns[start:])
+    chunk_truncate(chunk, start, chunk.constants_count)
+
+    return piece
+
+# Paste code cut out of the chunk back at its end
+def chunk_paste(chunk, piece):
+
+    code, lines, columns = piece
+
+    chunk.code.extend(code)
+    chunk.lines.extend(lines)
+    chunk.columns.extend(columns)
+
+# Get a zero-copy view of the chunk code
+def chunk_view(chunk):
+    return memoryview(chunk.code)
+
+# Get constant key
+def constant_key(value):
+
+    # Keep the type in the key so 1.0 and true never share a slot, and keep
+    # the sign of zero so -0.0 is not folded into 0.0
+    if (type(value) == float and value == 0.0):
+        return (float, value, str(value))
+
+    return (type(value), value)
 
 # Add constant to chunk
 def add_constant(chunk, value):
 
+    key = constant_key(value)
+
+    # Already in the pool?
+    index = chunk.constant_indices.get(key)
+    if (index != None): return index
+
+    # Add it
     chunk.constants.append(value)
-    chunk.constants_count += 1
+    chunk.constant_indices[key] = chunk.constants_count - 1
 
-    return (chunk.constants_count - 1)
\ No newline at end of file
+    return (chunk.constants_count - 1)
@@ -0,0 +1,939 @@
+from opcodes     import *
+from optimizer   import decode
+from analysis    import stack_depths
+from interpreter import Frame, FRAMES_MAX, runtime_error_at, elementwise, add_values
+from output      import output_write, output_flush, format_value
+from function    import Function
+from rope        import Rope, rope_text, concat
+from utils       import ensure_recursion_limit
+
+from array import array
+
+import operator
+import sys
+
+# Closure backend, compiles the bytecode of a chunk into a tree of Python
+# closures instead of dispatching it opcode by opcode. Every basic block
+# becomes one closure that runs its statements and returns the number of the
+# next block, and every value the VM would push is either known at compile
+# time, read straight from a slot, or computed by the closure of the
+# expression that makes it.
+
+# Python frames a call takes on top of the closures of the expression it is
+# in, the runner, the block, the statement, the call and its arguments
+CALL_FRAMES = 8
+
+# Python frames kept free for the callers of the backend and the slow paths
+RECURSION_RESERVE = 100
+
+# Most Python frames an expression closure may nest, a deeper one is stored
+# in its slot straight away, so long chains of values, like the ones TEE
+# leaves for the next statement, don't nest without end
+HEIGHT_MAX = 48
+
+# Highest recursion limit the backend asks for, before Python 3.11 every
+# Python frame takes C stack too, and a limit past what the C stack holds
+# crashes the process instead of raising RecursionError
+RECURSION_MAX = 20000
+
+# Kinds of value the VM would have on its stack
+CONSTANT   = 0 # Known while compiling
+TEMPORARY  = 1 # Stored in the frame slot of its stack position
+LOCAL      = 2 # Read from a local variable, not yet
+EXPRESSION = 3 # Computed by a closure, not yet
+
+# Specialized opcodes run the same as the generic ones they came from
+GENERIC_OPCODES = {
+    OP_ADD_NUM:       OP_ADD,       OP_ADD_STR:       OP_ADD,
+    OP_EQUALS_NUM:    OP_EQUALS,    OP_EQUALS_STR:    OP_EQUALS,
+    OP_NOT_EQUAL_NUM: OP_NOT_EQUAL, OP_NOT_EQUAL_STR: OP_NOT_EQUAL
+}
+
+# Compare and jump, compares and then pops and jumps if false
+COMPARE_JUMPS = {
+    OP_LESS_JUMP_IF_FALSE:         OP_LESS,
+    OP_LESS_THAN_JUMP_IF_FALSE:    OP_LESS_THAN,
+    OP_GREATER_JUMP_IF_FALSE:      OP_GREATER,
+    OP_GREATER_THAN_JUMP_IF_FALSE: OP_GREATER_THAN,
+    OP_EQUALS_JUMP_IF_FALSE:       OP_EQUALS,
+    OP_NOT_EQUAL_JUMP_IF_FALSE:    OP_NOT_EQUAL
+}
+
+NUMBERS_MESSAGE  = "Operands must be two numbers."
+SAME_MESSAGE     = "Operands must be the same type."
+VALUES_MESSAGE   = "Operands must be two numbers, two strings or two booleans."
+BOOLEANS_MESSAGE = "Operands must be two booleans."
+
+# Halt, raised once a runtime error was reported, it unwinds every closure
+# the way returning -1 stops the dispatch loop
+class Halt(Exception):
+    pass
+
+# Program, what every chunk of one run shares
+class Program():
+
+    # Initialize
+    def __init__(self):
+
+        # Runners of the functions compiled so far
+        self.compiled = {}
+
+        # Python frames each expression closure nests, by closure, and the
+        # most any closure of the script and of a function nests
+        self.heights         = {}
+        self.script_height   = 0
+        self.function_height = 0
+
+        # Most calls that fit under the recursion limit at once
+        self.calls_max = FRAMES_MAX
+
+# Builder, what the blocks of one chunk are compiled with
+class Builder():
+
+    # Initialize
+    def __init__(self, interpreter, chunk, start, local_count, program):
+
+        self.interpreter = interpreter
+        self.chunk       = chunk
+
+        # Frame layout, the locals, then a slot per stack position, then the
+        # result of the function
+        self.base   = local_count
+        self.result = local_count + chunk.stack_size
+
+        # Block number of every block start
+        self.blocks = {}
+
+        # Shared by every chunk of the run
+        self.program = program
+
+        # Most Python frames any closure of the chunk nests
+        self.height = 1
+
+# Report a runtime error at the instruction at offset, and stop
+def halt(interpreter, offset, message):
+
+    runtime_error_at(interpreter, offset + 1, message)
+    raise Halt()
+
+# Add, the slow path of OP_ADD
+def add(interpreter, index, a, b):
+
+    if (type(a) != type(b)):
+        return add_values(interpreter, index, a, b, SAME_MESSAGE)
+
+    if (type(a) == float): return a + b
+    if (type(a) == str):   return concat(a, b)
+
+    return add_values(interpreter, index, a, b, "Operands must be two numbers or two strings.")
+
+# Add a constant, the slow path of OP_ADD_CONSTANT and the increments
+def add_constant(interpreter, index, a, b):
+
+    if (type(a) != type(b) or type(a) != float):
+        return add_values(interpreter, index, a, b, SAME_MESSAGE)
+
+    return a + b
+
+# Make Numbers, the slow path of arithmetic and ordering, element-wise
+def make_numbers(compute):
+
+    def numbers(interpreter, index, a, b):
+
+        if (type(a) != float or type(b) != float):
+            return elementwise(interpreter, index, compute, a, b, NUMBERS_MESSAGE)
+
+        return compute(a, b)
+
+    return numbers
+
+# Make Values, the slow path of equality, ropes compare by their text
+def make_values(compute):
+
+    def values(interpreter, index, a, b):
+
+        if (type(a) != type(b)):
+            if (type(a) == Rope or type(b) == Rope): return values(interpreter, index, flatten(a), flatten(b))
+            return elementwise(interpreter, index, compute, a, b, SAME_MESSAGE)
+
+        if (type(a) in [float, str, bool]): return compute(a, b)
+
+        if (type(a) == Rope): return values(interpreter, index, flatten(a), flatten(b))
+        return elementwise(interpreter, index, compute, a, b, VALUES_MESSAGE)
+
+    return values
+
+# Booleans, the slow path of && and || without short-circuit, only reached
+# when the operands are not two booleans
+def booleans(interpreter, index, a, b):
+
+    runtime_error_at(interpreter, index, BOOLEANS_MESSAGE)
+    return None
+
+# Get the text of a rope, anything else as it is
+def flatten(a):
+    return rope_text(a) if (type(a) == Rope) else a
+
+# Binary operators, the type both operands have on the fast path, the fast
+# path and the slow path
+BINARY = {
+    OP_ADD:          (float, operator.add,     add),
+    OP_SUB:          (float, operator.sub,     make_numbers(operator.sub)),
+    OP_MUL:          (float, operator.mul,     make_numbers(operator.mul)),
+    OP_DIV:          (float, operator.truediv, make_numbers(operator.truediv)),
+    OP_LESS:         (float, operator.lt,      make_numbers(operator.lt)),
+    OP_LESS_THAN:    (float, operator.le,      make_numbers(operator.le)),
+    OP_GREATER:      (float, operator.gt,      make_numbers(operator.gt)),
+    OP_GREATER_THAN: (float, operator.ge,      make_numbers(operator.ge)),
+    OP_EQUALS:       (float, operator.eq,      make_values(operator.eq)),
+    OP_NOT_EQUAL:    (float, operator.ne,      make_values(operator.ne)),
+    OP_AND:          (bool,  operator.and_,    booleans),
+    OP_OR:           (bool,  operator.or_,     booleans)
+}
+
+# Get the Python frames reading a stack value nests
+def entry_height(builder, entry):
+    return builder.program.heights[entry[1]] if (entry[0] == EXPRESSION) else 1
+
+# Get the closure that reads a stack value
+def getter(entry):
+
+    kind, value = entry
+
+    if (kind == EXPRESSION): return value
+
+    if (kind == CONSTANT):
+        def get_constant(frame):
+            return value
+
+        return get_constant
+
+    def get_slot(frame):
+        return frame[value]
+
+    return get_slot
+
+# Make Binary, the fast path runs inline, a number on the right that is known
+# while compiling is not read at all
+def make_binary(interpreter, offset, opcode, a, b):
+
+    kind, compute, slow = BINARY[opcode]
+    index = offset + 1
+
+    get_a = getter(a)
+
+    if (b[0] == CONSTANT and type(b[1]) == kind):
+
+        b = b[1]
+
+        def binary_constant(frame):
+
+            a = get_a(frame)
+
+            try:
+                if (type(a) == kind): return compute(a, b)
+            except ZeroDivisionError:
+                halt(interpreter, offset, "Division by zero.")
+
+            result = slow(interpreter, index, a, b)
+            if (result is None): raise Halt()
+
+            return result
+
+        return binary_constant
+
+    get_b = getter(b)
+
+    def binary(frame):
+
+        a = get_a(frame)
+        b = get_b(frame)
+
+        # Only a division can fail on two numbers
+        try:
+            if (type(a) == kind and type(b) == kind): return compute(a, b)
+        except ZeroDivisionError:
+            halt(interpreter, offset, "Division by zero.")
+
+        result = slow(interpreter, index, a, b)
+        if (result is None): raise Halt()
+
+        return result
+
+    return binary
+
+# Make Add Constant, the fused add keeps its own error message
+def make_add_constant(interpreter, offset, a, b):
+
+    get_a = getter(a)
+    index = offset + 1
+
+    def add_constant_value(frame):
+
+        a = get_a(frame)
+        if (type(a) == float and type(b) == float): return a + b
+
+        result = add_constant(interpreter, index, a, b)
+        if (result is None): raise Halt()
+
+        return result
+
+    return add_constant_value
+
+# Make Unary, negate, not and the boolean check of && and ||
+def make_unary(interpreter, offset, opcode, a):
+
+    get_a = getter(a)
+
+    if (opcode == OP_NEGATE):
+
+        def negate(frame):
+
+            a = get_a(frame)
+            if (type(a) == float): return -a
+
+            # Every element of an array
+            if (type(a) == array): return array("d", map(operator.neg, a))
+
+            halt(interpreter, offset, "Operand must be a number.")
+
+        return negate
+
+    if (opcode == OP_NOT):
+
+        def not_value(frame):
+
+            a = get_a(frame)
+            if (type(a) != bool): halt(interpreter, offset, "Operand must be a boolean.")
+
+            return not a
+
+        return not_value
+
+    def check_bool(frame):
+
+        a = get_a(frame)
+        if (type(a) != bool): halt(interpreter, offset, BOOLEANS_MESSAGE)
+
+        return a
+
+    return check_bool
+
+# Make Get Global, by slot or by name for names not resolved at compile time
+def make_get_global(interpreter, offset, slot, name = None):
+
+    global_variables = interpreter.global_variables
+    global_slots     = interpreter.global_slots
+
+    if (name == None):
+        def get_global(frame):
+            return global_variables[slot]
+
+        return get_global
+
+    def get_global_name(frame):
+
+        slot = global_slots.get(name)
+
+        # Undefined?
+        if (slot == None):
+            halt(interpreter, offset, "The variable '{0}' is not declared!".format(name))
+
+        return global_variables[slot]
+
+    return get_global_name
+
+# Make Tee, sets a variable and keeps the value
+def make_tee(interpreter, opcode, slot, a):
+
+    get_a = getter(a)
+
+    if (opcode == OP_TEE_LOCAL):
+        def tee_local(frame):
+
+            value = frame[slot] = get_a(frame)
+            return value
+
+        return tee_local
+
+    global_variables = interpreter.global_variables
+
+    def tee_global(frame):
+
+        value = global_variables[slot] = get_a(frame)
+        return value
+
+    return tee_global
+
+# Make Array, made from numbers
+def make_array(interpreter, offset, values):
+
+    getters = [getter(x) for x in values]
+
+    def array_value(frame):
+
+        values = [get(frame) for get in getters]
+
+        # Type checking
+        for value in values:
+            if (type(value) != float):
+                halt(interpreter, offset, "Array elements must be numbers.")
+
+        return array("d", values)
+
+    return array_value
+
+# Make Array Extend, adds numbers to an array made by the same literal
+def make_array_extend(interpreter, offset, a, values):
+
+    get_a   = getter(a)
+    getters = [getter(x) for x in values]
+
+    def array_extend(frame):
+
+        a      = get_a(frame)
+        values = [get(frame) for get in getters]
+
+        # Type checking
+        for value in values:
+            if (type(value) != float):
+                halt(interpreter, offset, "Array elements must be numbers.")
+
+        a.extend(values)
+        return a
+
+    return array_extend
+
+# Make Index, gets an element of an array
+def make_index(interpreter, offset, a, position):
+
+    get_a        = getter(a)
+    get_position = getter(position)
+
+    def index_value(frame):
+
+        a        = get_a(frame)
+        position = get_position(frame)
+
+        # Type checking
+        if (type(a) != array):
+            halt(interpreter, offset, "Can only index arrays.")
+
+        if (type(position) != float or not position.is_integer()):
+            halt(interpreter, offset, "Index must be a whole number.")
+
+        if (position < 0 or position >= len(a)):
+            halt(interpreter, offset, "Index out of range.")
+
+        return a[int(position)]
+
+    return index_value
+
+# Make Call, the arguments become the first slots of the frame of the
+# function, the function is compiled on its first call
+def make_call(builder, offset, callee, arguments):
+
+    interpreter = builder.interpreter
+    program     = builder.program
+    compiled    = program.compiled
+    frames      = interpreter.frames
+
+    get_callee = getter(callee)
+    getters    = [getter(x) for x in arguments]
+    count      = len(getters)
+
+    def call(frame):
+
+        callee    = get_callee(frame)
+        arguments = [get(frame) for get in getters]
+
+        if (type(callee) != Function):
+            halt(interpreter, offset, "Can only call functions.")
+
+        if (count != callee.arity):
+            halt(interpreter, offset, "Expected {0} arguments but got {1}.".format(callee.arity, count))
+
+        run = compiled.get(callee)
+
+        if (run == None):
+            run = compiled[callee] = compile_function(interpreter, callee, program)
+
+        # Compiling the callee may have made calls deeper
+        if (len(frames) >= program.calls_max):
+            halt(interpreter, offset, "Stack overflow.")
+
+        return run(arguments)
+
+    return call
+
+# Make Store, keeps a value in a frame slot
+def make_store(slot, a):
+
+    get_a = getter(a)
+
+    def store(frame):
+        frame[slot] = get_a(frame)
+
+    return store
+
+# Make Statement, for the opcodes that consume a value and leave nothing
+def make_statement(builder, offset, opcode, operand, a):
+
+    interpreter      = builder.interpreter
+    global_variables = interpreter.global_variables
+    global_slots     = interpreter.global_slots
+    output           = interpreter.output
+
+    get_a = getter(a)
+
+    if (opcode == OP_SET_LOCAL): return make_store(operand, a)
+
+    if (opcode == OP_SET_GLOBAL):
+        def set_global(frame):
+            global_variables[operand] = get_a(frame)
+
+        return set_global
+
+    if (opcode == OP_SET_GLOBAL_NAME):
+        name = builder.chunk.constants[operand]
+
+        def set_global_name(frame):
+
+            value = get_a(frame)
+            slot  = global_slots.get(name)
+
+            # New global?
+            if (slot == None):
+                slot = len(global_variables)
+                global_slots[name] = slot
+                global_variables.append(None)
+
+            global_variables[slot] = value
+
+        return set_global_name
+
+    if (opcode == OP_PRINT):
+        def print_value(frame):
+            output_write(output, format_value(get_a(frame)))
+
+        return print_value
+
+    # Pop, the value only runs for what it does
+    def evaluate(frame):
+        get_a(frame)
+
+    return evaluate
+
+# Make Increment, adds a constant to a variable in place
+def make_increment(interpreter, offset, opcode, slot, b):
+
+    index = offset + 1
+
+    variables = None if (opcode == OP_INCREMENT_LOCAL) else interpreter.global_variables
+
+    def increment(frame):
+
+        values = frame if (variables == None) else variables
+
+        a = values[slot]
+
+        if (type(a) != float or type(b) != float):
+            a = add_constant(interpreter, index, a, b)
+            if (a is None): raise Halt()
+
+            values[slot] = a
+            return
+
+        values[slot] = a + b
+
+    return increment
+
+# Store every value still waiting on the stack in the slot of its position,
+# in the order the VM would have made them, constants too if asked for
+def materialize(builder, statements, entries, count, constants = False):
+
+    for position in range(count):
+
+        kind = entries[position][0]
+
+        if (kind == TEMPORARY or (kind == CONSTANT and not constants)): continue
+
+        slot = builder.base + position
+
+        statements.append(make_store(slot, entries[position]))
+        entries[position] = (TEMPORARY, slot)
+
+# Make Block, runs the statements and then the end of the block, which
+# returns the number of the next block, or -1 to stop
+def make_block(statements, end):
+
+    if (len(statements) == 0): return end
+
+    if (len(statements) == 1):
+        statement = statements[0]
+
+        def block_statement(frame):
+            statement(frame)
+            return end(frame)
+
+        return block_statement
+
+    def block(frame):
+
+        for statement in statements:
+            statement(frame)
+
+        return end(frame)
+
+    return block
+
+# Make Go To, the end of a block that always goes on to the same block
+def make_goto(target):
+
+    def goto(frame):
+        return target
+
+    return goto
+
+# Make Branch, pops a condition and goes to target if it is false
+def make_branch_if_false(a, target, after):
+
+    get_a = getter(a)
+
+    def branch_if_false(frame):
+
+        if (not get_a(frame)): return target
+        return after
+
+    return branch_if_false
+
+# Make Branch, pops a condition and goes to target if it is true, it has to
+# be a boolean
+def make_branch_if_true(interpreter, offset, a, target, after, message):
+
+    get_a = getter(a)
+
+    def branch_if_true(frame):
+
+        a = get_a(frame)
+        if (type(a) != bool): halt(interpreter, offset, message)
+
+        if (a): return target
+        return after
+
+    return branch_if_true
+
+# Make Branch Or Pop, for && and ||, the boolean stays in its slot for the
+# target and is dropped for the block after
+def make_branch_or_pop(interpreter, offset, slot, jump_if, target, after):
+
+    def branch_or_pop(frame):
+
+        a = frame[slot]
+        if (type(a) != bool): halt(interpreter, offset, BOOLEANS_MESSAGE)
+
+        if (a == jump_if): return target
+        return after
+
+    return branch_or_pop
+
+# Make Return, keeps the result in the last slot of the frame and stops
+def make_return(slot, a):
+
+    get_a = getter(a)
+
+    def return_value(frame):
+
+        frame[slot] = get_a(frame)
+        return -1
+
+    return return_value
+
+# Compile the instructions of one block, which starts with depth values on
+# the stack and falls through into the block at after
+def compile_block(builder, instructions, depth, after):
+
+    interpreter = builder.interpreter
+    constants   = builder.chunk.constants
+    blocks      = builder.blocks
+
+    entries    = [(TEMPORARY, builder.base + position) for position in range(depth)]
+    statements = []
+
+    # Push the value an expression closure makes, the closure nests one
+    # Python frame deeper than its operands
+    def push(closure, *operands):
+
+        height = 1 + max([entry_height(builder, x) for x in operands], default = 1)
+
+        builder.program.heights[closure] = height
+        builder.height = max(builder.height, height)
+
+        entries.append((EXPRESSION, closure))
+
+        # Too deep, work out the stack so far, the VM already has
+        if (height >= HEIGHT_MAX):
+            materialize(builder, statements, entries, len(entries))
+
+    for instruction in instructions:
+
+        offset    = instruction.offset
+        opcode    = GENERIC_OPCODES.get(instruction.opcode, instruction.opcode)
+        operands  = instruction.operands
+        target    = blocks.get(instruction.target.offset) if (instruction.target != None) else None
+        following = blocks.get(offset + 1 + len(operands))
+
+        # Values
+        if (opcode == OP_CONSTANT):
+            entries.append((CONSTANT, constants[operands[0]]))
+
+        elif (opcode in [OP_TRUE, OP_FALSE, OP_NULL]):
+            entries.append((CONSTANT, {OP_TRUE: True, OP_FALSE: False, OP_NULL: None}[opcode]))
+
+        elif (opcode == OP_GET_LOCAL):
+            entries.append((LOCAL, operands[0]))
+
+        elif (opcode == OP_GET_GLOBAL):
+            push(make_get_global(interpreter, offset, operands[0]))
+
+        elif (opcode == OP_GET_GLOBAL_NAME):
+            push(make_get_global(interpreter, offset, None, constants[operands[0]]))
+
+        # Operators
+        elif (opcode in BINARY):
+            b = entries.pop()
+            a = entries.pop()
+            push(make_binary(interpreter, offset, opcode, a, b), a, b)
+
+        elif (opcode == OP_ADD_CONSTANT):
+            a = entries.pop()
+            push(make_add_constant(interpreter, offset, a, constants[operands[0]]), a)
+
+        elif (opcode in [OP_NEGATE, OP_NOT, OP_CHECK_BOOL]):
+            a = entries.pop()
+            push(make_unary(interpreter, offset, opcode, a), a)
+
+        elif (opcode in [OP_TEE_LOCAL, OP_TEE_GLOBAL]):
+            a = entries.pop()
+            push(make_tee(interpreter, opcode, operands[0], a), a)
+
+        elif (opcode == OP_ARRAY):
+            values = entries[len(entries) - operands[0]:]
+            del entries[len(entries) - operands[0]:]
+            push(make_array(interpreter, offset, values), *values)
+
+        elif (opcode == OP_ARRAY_EXTEND):
+            values = entries[len(entries) - operands[0]:]
+            del entries[len(entries) - operands[0]:]
+            a = entries.pop()
+            push(make_array_extend(interpreter, offset, a, values), a, *values)
+
+        elif (opcode == OP_INDEX):
+            position = entries.pop()
+            a        = entries.pop()
+            push(make_index(interpreter, offset, a, position), a, position)
+
+        elif (opcode == OP_CALL):
+            arguments = entries[len(entries) - operands[0]:]
+            del entries[len(entries) - operands[0]:]
+            callee = entries.pop()
+            push(make_call(builder, offset, callee, arguments), callee, *arguments)
+
+        # Statements, whatever is below them runs first
+        elif (opcode in [OP_SET_LOCAL, OP_SET_GLOBAL, OP_SET_GLOBAL_NAME, OP_PRINT, OP_POP]):
+            a = entries.pop()
+
+            if (opcode == OP_POP and a[0] != EXPRESSION): continue
+
+            materialize(builder, statements, entries, len(entries))
+            statements.append(make_statement(builder, offset, opcode, operands[0] if (len(operands) > 0) else None, a))
+
+        elif (opcode in [OP_INCREMENT_LOCAL, OP_INCREMENT_GLOBAL]):
+            materialize(builder, statements, entries, len(entries))
+            statements.append(make_increment(interpreter, offset, opcode, operands[0], constants[operands[1]]))
+
+        # Ends of blocks, whatever is left on the stack is carried in slots
+        elif (opcode in [OP_JUMP, OP_JUMP_LONG, OP_LOOP, OP_LOOP_LONG]):
+            materialize(builder, statements, entries, len(entries), True)
+            return make_block(statements, make_goto(target))
+
+        elif (opcode in [OP_JUMP_IF_FALSE, OP_JUMP_IF_FALSE_LONG]):
+            materialize(builder, statements, entries, len(entries), True)
+            return make_block(statements, make_branch_if_false(entries[-1], target, following))
+
+        elif (opcode == OP_JUMP_IF_TRUE):
+            materialize(builder, statements, entries, len(entries), True)
+            return make_block(statements, make_branch_if_true(interpreter, offset, entries[-1], target, following, "Operand must be a boolean."))
+
+        elif (opcode in [OP_POP_JUMP_IF_FALSE, OP_POP_JUMP_IF_TRUE] or opcode in COMPARE_JUMPS):
+
+            if (opcode in COMPARE_JUMPS):
+                b = entries.pop()
+                a = entries.pop()
+                push(make_binary(interpreter, offset, COMPARE_JUMPS[opcode], a, b), a, b)
+                condition = entries.pop()
+            else:
+                condition = entries.pop()
+
+            materialize(builder, statements, entries, len(entries), True)
+
+            if (opcode == OP_POP_JUMP_IF_TRUE):
+                return make_block(statements, make_branch_if_true(interpreter, offset, condition, target, following, "Operand must be a boolean."))
+
+            return make_block(statements, make_branch_if_false(condition, target, following))
+
+        elif (opcode in [OP_JUMP_IF_FALSE_OR_POP, OP_JUMP_IF_TRUE_OR_POP, OP_JUMP_IF_FALSE_OR_POP_LONG, OP_JUMP_IF_TRUE_OR_POP_LONG]):
+            materialize(builder, statements, entries, len(entries), True)
+
+            jump_if = opcode in [OP_JUMP_IF_TRUE_OR_POP, OP_JUMP_IF_TRUE_OR_POP_LONG]
+            return make_block(statements, make_branch_or_pop(interpreter, offset, entries[-1][1], jump_if, target, following))
+
+        elif (opcode == OP_RETURN):
+            a = entries.pop()
+            materialize(builder, statements, entries, len(entries), True)
+            return make_block(statements, make_return(builder.result, a))
+
+        elif (opcode == OP_EXIT):
+            materialize(builder, statements, entries, len(entries), True)
+            return make_block(statements, make_goto(-1))
+
+        # Unknown opcode
+        else:
+            message = "Unknown opcode '{0}'.".format(instruction.opcode)
+
+            def unknown(frame):
+                halt(interpreter, offset, message)
+
+            materialize(builder, statements, entries, len(entries), True)
+            return make_block(statements, unknown)
+
+    # Falls through into the next block
+    materialize(builder, statements, entries, len(entries), True)
+    return make_block(statements, make_goto(blocks[after]))
+
+# Compile a chunk from start, returns the blocks, the number of the first one
+# and the builder
+def compile_chunk(interpreter, chunk, start, local_count, program):
+
+    builder      = Builder(interpreter, chunk, start, local_count, program)
+    instructions = [x for x in decode(chunk) if (x.offset >= start)]
+    depths       = stack_depths(chunk, start)
+
+    # Blocks start at the start, at every jump target and after every jump
+    starts = set([start])
+
+    for instruction in instructions:
+
+        opcode = instruction.opcode
+
+        if (instruction.target != None): starts.add(instruction.target.offset)
+
+        if (opcode in JUMP_OPCODES or opcode in LOOP_OPCODES or opcode in [OP_EXIT, OP_RETURN]):
+            starts.add(instruction.offset + 1 + len(instruction.operands))
+
+    # Only the blocks that can run, numbered in order
+    starts = sorted(x for x in starts if (x in depths))
+
+    for number, offset in enumerate(starts):
+        builder.blocks[offset] = number
+
+    # Split the instructions at the block starts
+    blocks  = []
+    current = []
+
+    for instruction in instructions:
+
+        if (instruction.offset in builder.blocks and len(current) > 0):
+            blocks.append(current)
+            current = []
+
+        current.append(instruction)
+
+    blocks.append(current)
+
+    blocks = [x for x in blocks if (x[0].offset in depths)]
+
+    blocks = [
+        compile_block(builder, x, depths[x[0].offset], x[-1].offset + 1 + len(x[-1].operands))
+        for x in blocks
+    ]
+
+    return blocks, builder.blocks[start], builder
+
+# Make sure Python lets the closures nest as deep as they can, the script at
+# the bottom and then as many calls as there can be, each as deep as the
+# deepest function. The limit is only ever raised, so runs in other threads
+# keep the room they need, and never past RECURSION_MAX, calls that would go
+# deeper than the limit allows are a stack overflow instead.
+def ensure_program_depth(program):
+
+    call_height = program.function_height + CALL_FRAMES
+
+    ensure_recursion_limit(min(RECURSION_RESERVE + program.script_height + FRAMES_MAX * call_height, RECURSION_MAX))
+
+    program.calls_max = min(FRAMES_MAX, (sys.getrecursionlimit() - RECURSION_RESERVE - program.script_height) // call_height)
+
+# Compile a function, returns what runs it with a list of arguments
+def compile_function(interpreter, function, program):
+
+    chunk  = function.chunk
+    frames = interpreter.frames
+
+    blocks, start, builder = compile_chunk(interpreter, chunk, 0, chunk.local_count, program)
+
+    program.function_height = max(program.function_height, builder.height)
+    ensure_program_depth(program)
+
+    result = builder.result
+    rest   = [None] * (result + 1 - function.arity)
+
+    def run(arguments):
+
+        frame = arguments + rest
+        frames.append(Frame(function, 0))
+
+        index = start
+
+        while (index >= 0):
+            index = blocks[index](frame)
+
+        frames.pop()
+        return frame[result]
+
+    return run
+
+# Interpret bytecode by compiling it into closures
+def interpret_closures(interpreter):
+
+    chunk   = interpreter.chunk
+    program = Program()
+
+    blocks, start, builder = compile_chunk(interpreter, chunk, interpreter.index, chunk.local_count, program)
+
+    program.script_height = builder.height
+    ensure_program_depth(program)
+
+    # Even the script alone is too deep for the recursion limit
+    if (program.calls_max < 0):
+        runtime_error_at(interpreter, interpreter.index, "Code nested too deeply.")
+        return
+
+    # The locals of the script, then its stack slots
+    local_count = chunk.local_count
+    frame       = interpreter.local_variables + [None] * (builder.result + 1 - local_count)
+
+    try:
+        index = start
+
+        while (index >= 0):
+            index = blocks[index](frame)
+
+    except Halt:
+        interpreter.frames.clear()
+
+    # Even if Python raised, what was printed before it still shows up
+    finally:
+        interpreter.local_variables[:] = frame[:local_count]
+
+        # Write whatever is still buffered
+        output_flush(interpreter.output)
@@ -1,45 +1,99 @@
 from opcodes  import *
 from tokens   import *
-from scanner  import scanner_init, scan_token
-from chunk    import Chunk, chunk_write, add_constant
+from scanner  import Scanner, scanner_init, scan_token
+from chunk    import Chunk, chunk_write, chunk_write_all, chunk_truncate, chunk_cut, chunk_paste, add_constant, CODE_MAX
 from coloring import failure, success, warning
-from interpreter import interpreter_init, interpret
-
-# Parser
+from interpreter import Interpreter, interpreter_init, interpret
+from optimizer   import peephole, instruction_size, jump_offset
+from analysis    import stack_depth, is_pure
+from function    import Function
+
+import re
+import sys
+
+# Compiler version, bump it whenever the emitted bytecode changes so cached
+# bytecode images are rebuilt
+COMPILER_VERSION = 14
+
+# Python frames one level of nesting takes while compiling, at most, a
+# statement goes through the block or the function it opens, an expression
+# through every precedence level
+STATEMENT_FRAMES  = 4
+EXPRESSION_FRAMES = 9
+UNARY_FRAMES      = 1
+
+# Python frames kept free for the callers of the compiler and for the
+# innermost level, code nested deeper than the recursion limit allows for
+# is a compile error instead of a RecursionError
+NESTING_RESERVE = 100
+
+# Most parameters of a function
+PARAMETERS_MAX = 0xFF
+
+# Most elements of an array literal on the stack at once, longer literals
+# are made a batch at a time
+ARRAY_BATCH = 64
+
+# Parser, every compile gets its own, so nothing is shared between runs
 class Parser():
 
-    previous = None
-    current  = None
+    # Initialize
+    def __init__(self, source, line = 1):
+
+        self.scanner = Scanner()
+        scanner_init(self.scanner, source, True, line)
+
+        self.previous = None
+        self.current  = None
+
+        self.had_error = False
 
-    had_error = False
+        # Python frames the nested expressions and statements being compiled
+        # take, roughly
+        self.nesting = 0
 
-parser = Parser()
+        # First error, and if errors are printed as soon as they are found
+        self.error_token   = None
+        self.error_message = None
+        self.report        = True
+
+        # Compiler being compiled into
+        self.compiler = None
 
 # Compiler
 class Compiler():
-    
-    chunk = Chunk()
-    scope_depth = 0
 
-    global_variables = []
-    local_variables  = []
+    # Initialize
+    def __init__(self):
+
+        self.chunk       = Chunk()
+        self.scope_depth = 0
+
+        self.global_variables = {}
+        self.local_variables  = []
 
-global current
-current = None
+        # Offsets of the jumps still waiting to be patched, by handle
+        self.jumps      = {}
+        self.jump_count = 0
+
+        # Offset of the last instruction emitted
+        self.last_instruction = None
+
+        # Function being compiled, None for the script
+        self.function = None
 
 # Initialize compiler
-def compiler_init(compiler):
+def compiler_init(parser, compiler):
 
     # Set current compiler
-    global current
-    current = compiler
+    parser.compiler = compiler
 
 # Get current chunk
-def current_chunk():
-    return current.chunk
+def current_chunk(parser):
+    return parser.compiler.chunk
 
 # Error at Token
-def error_at(kind, message, token):
+def error_at(parser, kind, message, token):
 
     # Already have an error? 
     if (parser.had_error): return
@@ -56,30 +110,50 @@ def error_at(kind, message, token):
         error_message += " at '{0}'".format(token.content)
 
     error_message += ":\n>>\t{0}".format(message)
-    print(failure(error_message))
+
+    parser.error_token   = token
+    parser.error_message = failure(error_message)
+
+    if (parser.report): print(parser.error_message)
 
 # Error at previous token
-def error(kind, message):
-    error_at(kind, message, parser.previous)
+def error(parser, kind, message):
+    error_at(parser, kind, message, parser.previous)
 
 # Error at current token
-def error_current(kind, message):
-    error_at(kind, message, parser.current)
+def error_current(parser, kind, message):
+    error_at(parser, kind, message, parser.current)
+
+# Enter nested code that takes up to frames Python frames, returns False if
+# it is nested too deep
+def enter_nesting(parser, frames):
+
+    parser.nesting += frames
+
+    if (parser.nesting > sys.getrecursionlimit() - NESTING_RESERVE):
+        error_current(parser, "Compile Error", "Code nested too deeply.")
+        return False
+
+    return True
+
+# Leave nested code
+def leave_nesting(parser, frames):
+    parser.nesting -= frames
 
 # Begin scope
-def begin_scope():
-    current.scope_depth += 1
+def begin_scope(parser):
+    parser.compiler.scope_depth += 1
 
 # End scope
-def end_scope():
-    current.scope_depth -= 1
+def end_scope(parser):
+    parser.compiler.scope_depth -= 1
 
     # Clear local variables array
-    if (current.scope_depth == 0):
-        current.local_variables = []
+    if (parser.compiler.scope_depth == 0):
+        parser.compiler.local_variables = []
 
 # Advance Token
-def advance():
+def advance(parser):
     
     # Get the previous token
     parser.previous = parser.current
@@ -88,400 +162,1023 @@ def advance():
     while (True):
         
         # Get the current token
-        parser.current = scan_token()
+        parser.current = scan_token(parser.scanner)
 
         # Error?
         if (parser.current.kind != TOKEN_ERROR): break
-        error_current("Error", parser.current.content) 
+        error_current(parser, "Error", parser.current.content) 
 
 # Check current kind
-def check(kind):
+def check(parser, kind):
 
     return (parser.current.kind == kind)
 
+# Get the line a token starts on, strings may span lines and carry the line
+# they end on
+def token_start_line(token):
+
+    if (token.kind == TOKEN_STRING): return token.line - token.content.count("\n")
+    return token.line
+
 # Consume Token
-def consume(kind, error, message):
+def consume(parser, kind, error, message):
 
     # Check current kind
-    if (check(kind)):
-        advance()
+    if (check(parser, kind)):
+        advance(parser)
         return
 
-    error_current(error, message)
+    error_current(parser, error, message)
 
 # Check if current kind match
-def match(kind):
+def match(parser, kind):
 
     # Check
-    if (not check(kind)): return False
+    if (not check(parser, kind)): return False
 
-    advance()
+    advance(parser)
     return True
 
 # Emit Byte
-def emit_byte(byte):
-    chunk_write(current_chunk(), byte, parser.previous.line, parser.previous.column)
+def emit_byte(parser, byte):
+    parser.compiler.last_instruction = current_chunk(parser).count
+    chunk_write(current_chunk(parser), byte, parser.previous.line, parser.previous.column)
 
 # Emit Bytes
-def emit_bytes(byte1, byte2):
-    emit_byte(byte1)
-    emit_byte(byte2)
+def emit_bytes(parser, byte1, byte2):
+    parser.compiler.last_instruction = current_chunk(parser).count
+    chunk_write_all(current_chunk(parser), (byte1, byte2), parser.previous.line, parser.previous.column)
 
 # Make Constant
-def make_constant(value):
+def make_constant(parser, value):
 
     # Add constant to chunk
-    constant = add_constant(current_chunk(), value)
+    constant = add_constant(current_chunk(parser), value)
+
+    # Too many constants?
+    if (constant > CODE_MAX):
+        error(parser, "Compile Error", "Too many constants in one chunk.")
+        return 0
+
     return constant
 
 # Emit Constant
-def emit_constant(value):
-    emit_bytes(OP_CONSTANT, make_constant(value))
+def emit_constant(parser, value):
+    emit_bytes(parser, OP_CONSTANT, make_constant(parser, value))
 
 # Emit Operator
-def emit_operator(kind):
-
-    if (kind == TOKEN_PLUS):          emit_byte(OP_ADD)
-    if (kind == TOKEN_MINUS):         emit_byte(OP_SUB)
-    if (kind == TOKEN_STAR):          emit_byte(OP_MUL)
-    if (kind == TOKEN_SLASH):         emit_byte(OP_DIV)
-    if (kind == TOKEN_BANG_EQUAL):    emit_byte(OP_NOT_EQUAL)
-    if (kind == TOKEN_GREATER):       emit_byte(OP_GREATER)
-    if (kind == TOKEN_GREATER_EQUAL): emit_byte(OP_GREATER_THAN)
-    if (kind == TOKEN_LESS):          emit_byte(OP_LESS)
-    if (kind == TOKEN_LESS_EQUAL):    emit_byte(OP_LESS_THAN)
-    if (kind == TOKEN_EQUAL_EQUAL):   emit_byte(OP_EQUALS)
-    if (kind == TOKEN_AND):           emit_byte(OP_AND)
-    if (kind == TOKEN_OR):            emit_byte(OP_OR)
+def emit_operator(parser, kind):
+
+    if (kind == TOKEN_PLUS):          emit_byte(parser, OP_ADD)
+    if (kind == TOKEN_MINUS):         emit_byte(parser, OP_SUB)
+    if (kind == TOKEN_STAR):          emit_byte(parser, OP_MUL)
+    if (kind == TOKEN_SLASH):         emit_byte(parser, OP_DIV)
+    if (kind == TOKEN_BANG_EQUAL):    emit_byte(parser, OP_NOT_EQUAL)
+    if (kind == TOKEN_GREATER):       emit_byte(parser, OP_GREATER)
+    if (kind == TOKEN_GREATER_EQUAL): emit_byte(parser, OP_GREATER_THAN)
+    if (kind == TOKEN_LESS):          emit_byte(parser, OP_LESS)
+    if (kind == TOKEN_LESS_EQUAL):    emit_byte(parser, OP_LESS_THAN)
+    if (kind == TOKEN_EQUAL_EQUAL):   emit_byte(parser, OP_EQUALS)
 
 # Emit Unary Operator
-def emit_unary_operator(kind):
+def emit_unary_operator(parser, kind):
+
+    if (kind == TOKEN_MINUS):  emit_byte(parser, OP_NEGATE)
+    elif (kind == TOKEN_BANG): emit_byte(parser, OP_NOT)
+
+# Get the constant loaded by the code between start and end
+def constant_between(parser, start, end):
+
+    code = current_chunk(parser).code
+
+    # One cell constants
+    if (end - start == 1):
+        if (code[start] == OP_TRUE):  return (True, True)
+        if (code[start] == OP_FALSE): return (True, False)
+        if (code[start] == OP_NULL):  return (True, None)
+
+    # Constant from the pool
+    if (end - start == 2 and code[start] == OP_CONSTANT):
+        return (True, current_chunk(parser).constants[code[start + 1]])
+
+    # Not a constant
+    return (False, None)
+
+# Fold operator, following the same type rules as the interpreter
+def fold_operator(kind, a, b):
+
+    # Anything that would be a runtime error is left for the interpreter, so
+    # the error is still reported at its original line and column
+    numbers  = (type(a) == float and type(b) == float)
+    same     = (type(a) == type(b) and type(a) in [float, str, bool])
+
+    if (kind == TOKEN_PLUS and same and type(a) != bool): return (True, a + b)
+
+    if (numbers):
+        if (kind == TOKEN_MINUS):         return (True, a - b)
+        if (kind == TOKEN_STAR):          return (True, a * b)
+        if (kind == TOKEN_SLASH and b != 0.0): return (True, a / b)
+        if (kind == TOKEN_GREATER):       return (True, a > b)
+        if (kind == TOKEN_GREATER_EQUAL): return (True, a >= b)
+        if (kind == TOKEN_LESS):          return (True, a < b)
+        if (kind == TOKEN_LESS_EQUAL):    return (True, a <= b)
+
+    if (same):
+        if (kind == TOKEN_EQUAL_EQUAL): return (True, a == b)
+        if (kind == TOKEN_BANG_EQUAL):  return (True, a != b)
+
+    # Can't fold
+    return (False, None)
+
+# Fold unary operator, following the same type rules as the interpreter
+def fold_unary_operator(kind, a):
+
+    if (kind == TOKEN_MINUS and type(a) == float): return (True, -a)
+    if (kind == TOKEN_BANG  and type(a) == bool):  return (True, not a)
+
+    # Can't fold
+    return (False, None)
+
+# Emit folded constant in place of the code emitted since start
+def emit_folded(parser, start, constants_count, value):
+
+    # Constants added since start are only used by the dropped code
+    chunk_truncate(current_chunk(parser), start, constants_count)
+
+    if (value is True):    emit_byte(parser, OP_TRUE)
+    elif (value is False): emit_byte(parser, OP_FALSE)
+    else:                  emit_constant(parser, value)
+
+# Emit Binary, folding it when both operands are constants
+def emit_binary(parser, kind, start, middle, constants_count):
+
+    a_constant, a = constant_between(parser, start, middle)
+    b_constant, b = constant_between(parser, middle, current_chunk(parser).count)
+
+    if (a_constant and b_constant):
+        folded, value = fold_operator(kind, a, b)
+
+        if (folded):
+            emit_folded(parser, start, constants_count, value)
+            return
+
+    emit_operator(parser, kind)
+
+# Emit Unary, folding it when the operand is a constant
+def emit_unary(parser, kind, start, constants_count):
+
+    a_constant, a = constant_between(parser, start, current_chunk(parser).count)
+
+    if (a_constant):
+        folded, value = fold_unary_operator(kind, a)
+
+        if (folded):
+            emit_folded(parser, start, constants_count, value)
+            return
+
+    emit_unary_operator(parser, kind)
+
+# Emit a check that the operand just compiled is a boolean, unless its last
+# instruction always leaves one
+def emit_check_boolean(parser):
+
+    chunk = current_chunk(parser)
+    last  = parser.compiler.last_instruction
+
+    if (last == chunk.count - 1 and chunk.code[last] in BOOLEAN_OPCODES): return
+
+    emit_byte(parser, OP_CHECK_BOOL)
+
+# Emit Logical, the right operand of && and || only runs when the left one
+# doesn't decide the result already
+def emit_logical(parser, kind, start, constants_count):
+
+    chunk = current_chunk(parser)
+
+    a_constant, a = constant_between(parser, start, chunk.count)
+
+    # Constant left operand, decided at compile time
+    if (a_constant and type(a) == bool):
+
+        # false && x, true || x
+        if (a == (kind == TOKEN_OR)):
+            addition(parser)
+            emit_folded(parser, start, constants_count, a)
+            return
+
+        # true && x, false || x
+        chunk_truncate(chunk, start, constants_count)
+
+        addition(parser)
+        emit_check_boolean(parser)
+        return
+
+    # Keep the left operand and skip the right one if it decides the result
+    handle = emit_jump(parser, OP_JUMP_IF_FALSE_OR_POP if (kind == TOKEN_AND) else OP_JUMP_IF_TRUE_OR_POP)
 
-    if (kind == TOKEN_MINUS):  emit_byte(OP_NEGATE)
-    elif (kind == TOKEN_BANG): emit_byte(OP_NOT)
+    addition(parser)
+    emit_check_boolean(parser)
+    patch_jump(parser, handle)
 
 # Emit Jump
-def emit_jump(byte):
+def emit_jump(parser, byte):
     
-    emit_byte(byte)
-    emit_byte(-1)   # Amount to jump
+    emit_bytes(parser, byte, CODE_MAX) # Amount to jump
 
-    # Return the offset of amount to jump
-    return current_chunk().count - 1
+    # Keep the offset of amount to jump, it moves if a jump before it grows
+    compiler = parser.compiler
+    handle   = compiler.jump_count
+
+    compiler.jumps[handle] = current_chunk(parser).count - 1
+    compiler.jump_count   += 1
+
+    return handle
 
 # Patch Jump
-def patch_jump(offset):
+def patch_jump(parser, handle):
+
+    chunk  = current_chunk(parser)
+    offset = parser.compiler.jumps.pop(handle)
 
     # Calculate the amount to jump
-    jump = current_chunk().count - offset - 1
+    jump = chunk.count - offset - 1
+
+    if (jump <= CODE_MAX):
+        chunk.code[offset] = jump
+        return
+
+    # Too far?
+    if (jump > 0xFFFFFFFF or chunk.code[offset - 1] not in LONG_OPCODES):
+        error(parser, "Compile Error", "Too much code to jump over.")
+        return
+
+    # Too far for one cell, make room for a second one right after it, the
+    # amount to jump stays the same since the target moves along
+    chunk.code.insert(offset + 1, 0)
+    chunk.lines.insert(offset + 1, chunk.lines[offset])
+    chunk.columns.insert(offset + 1, chunk.columns[offset])
+
+    chunk.code[offset - 1] = LONG_OPCODES[chunk.code[offset - 1]]
+    chunk.code[offset]     = jump >> 16
+    chunk.code[offset + 1] = jump & CODE_MAX
+
+    # Jumps still waiting to be patched after it moved along too
+    for other, position in parser.compiler.jumps.items():
+        if (position > offset): parser.compiler.jumps[other] = position + 1
+
+    # Loops after it that jump back over it are one cell longer now
+    index = offset + 2
+
+    while (index < chunk.count):
+
+        opcode = chunk.code[index]
+        end    = index + instruction_size(opcode)
+
+        if (opcode in LOOP_OPCODES and end - jump_offset(chunk.code, index) <= offset + 1):
+
+            loop = jump_offset(chunk.code, index) + 1
+
+            if (opcode == OP_LOOP_LONG):
+                chunk.code[index + 1] = loop >> 16
+                chunk.code[index + 2] = loop & CODE_MAX
+            elif (loop <= CODE_MAX):
+                chunk.code[index + 1] = loop
+            else:
+                error(parser, "Compile Error", "Loop body too large.")
 
-    # Set the amount to jump
-    current_chunk().code[offset] = jump
+        index = end
 
 # Emit loop
-def emit_loop(start):
-    
-    emit_byte(OP_LOOP)
+def emit_loop(parser, start):
+
+    # Get the loop offset, from the end of the loop instruction
+    offset = current_chunk(parser).count + 2 - start
+
+    if (offset <= CODE_MAX):
+        emit_bytes(parser, OP_LOOP, offset)
+        return
+
+    # Too far for one cell, split the offset over two
+    offset += 1
+
+    # Too far?
+    if (offset > 0xFFFFFFFF):
+        error(parser, "Compile Error", "Loop body too large.")
+        return
+
+    chunk_write_all(current_chunk(parser), (OP_LOOP_LONG, offset >> 16, offset & CODE_MAX), parser.previous.line, parser.previous.column)
 
-    # Get the loop offset
-    offset = current_chunk().count - start + 1
+# Escape sequences in string literals
+escapes = {"n": "\n", "t": "\t", "r": "\r", "\"": "\"", "\\": "\\"}
 
-    emit_byte(offset)
+escape_pattern = re.compile(r"\\(?:u\{([0-9A-Fa-f]{1,6})\}|u([0-9A-Fa-f]{4})|([\s\S]))")
 
 # Get token number
-def get_number():
+def get_number(parser):
 
     return float(parser.previous.content)
 
 # Get token string
-def get_string():
+def get_string(parser):
+
+    text = str(parser.previous.content[1 : -1])
+
+    # Nothing to decode
+    if ("\\" not in text): return text
+
+    invalid = []
+
+    # Decode one escape sequence
+    def decode(match):
+
+        # Unicode, \uXXXX or \u{X...}
+        code = match.group(1) or match.group(2)
+
+        if (code != None):
+            value = int(code, 16)
+            if (value <= 0x10FFFF and not (0xD800 <= value <= 0xDFFF)): return chr(value)
+
+        elif (match.group(3) in escapes):
+            return escapes[match.group(3)]
+
+        invalid.append(match.group(0))
+        return match.group(0)
 
-    return str(parser.previous.content[1 : parser.previous.length - 1])
+    text = escape_pattern.sub(decode, text)
+
+    if (len(invalid) > 0):
+        error(parser, "Compile Error", "Invalid escape sequence '{0}'.".format(invalid[0]))
+
+    return text
 
 # Get previous token
-def get_previous():
+def get_previous(parser):
 
     return parser.previous
 
 # Grouping Expression
-def grouping():
-    expression()
-    consume(TOKEN_RIGHT_PAREN, "Syntax Error", "Expect ')' after expression.")
+def grouping(parser):
+    expression(parser)
+    consume(parser, TOKEN_RIGHT_PAREN, "Syntax Error", "Expect ')' after expression.")
+
+# Arguments, returns how many there are
+def arguments(parser):
+
+    count = 0
+
+    if (not check(parser, TOKEN_RIGHT_PAREN)):
+        while (True):
+            expression(parser)
+            count += 1
+
+            if (count > PARAMETERS_MAX):
+                error(parser, "Compile Error", "Can't have more than {0} arguments.".format(PARAMETERS_MAX))
+
+            if (not match(parser, TOKEN_COMMA)): break
+
+    consume(parser, TOKEN_RIGHT_PAREN, "Syntax Error", "Expect ')' after arguments.")
+    return count
+
+# Calls and indexing after a value, like f(a)(b) or a[i]
+def finish_calls(parser):
+
+    while (True):
+
+        if (match(parser, TOKEN_LEFT_PAREN)):     # Call
+            emit_bytes(parser, OP_CALL, arguments(parser))
+        elif (match(parser, TOKEN_LEFT_BRACKET)): # Index
+            expression(parser)
+            consume(parser, TOKEN_RIGHT_BRACKET, "Syntax Error", "Expect ']' after index.")
+            emit_byte(parser, OP_INDEX)
+        else:
+            break
+
+# Array literal, like [1, 2, 3]
+def array_literal(parser):
+
+    count = 0
+    made  = False
+
+    if (not check(parser, TOKEN_RIGHT_BRACKET)):
+        while (True):
+            expression(parser)
+            count += 1
+
+            # Batch full, make the array or add the batch to it
+            if (count == ARRAY_BATCH):
+                emit_bytes(parser, OP_ARRAY_EXTEND if (made) else OP_ARRAY, count)
+
+                count = 0
+                made  = True
+
+            if (not match(parser, TOKEN_COMMA)): break
+
+    consume(parser, TOKEN_RIGHT_BRACKET, "Syntax Error", "Expect ']' after array elements.")
+
+    if (count > 0 or not made):
+        emit_bytes(parser, OP_ARRAY_EXTEND if (made) else OP_ARRAY, count)
+
+# Call
+def call(parser):
+
+    literal(parser)
+    finish_calls(parser)
 
 # Literal
-def literal():
-
-    if (match(TOKEN_FALSE)):        emit_byte(OP_FALSE)         # false
-    elif (match(TOKEN_TRUE)):       emit_byte(OP_TRUE)          # true
-    elif (match(TOKEN_NULL)):       emit_byte(OP_NULL)          # null
-    elif (match(TOKEN_NUMBER)):     emit_constant(get_number()) # Number
-    elif (match(TOKEN_STRING)):     emit_constant(get_string()) # String
-    elif (match(TOKEN_LEFT_PAREN)): grouping()                  # Grouping Expression
-    elif (match(TOKEN_IDENTIFIER)): variable_assignment(True)   # Variable
+def literal(parser):
+
+    if (match(parser, TOKEN_FALSE)):        emit_byte(parser, OP_FALSE)                 # false
+    elif (match(parser, TOKEN_TRUE)):       emit_byte(parser, OP_TRUE)                  # true
+    elif (match(parser, TOKEN_NULL)):       emit_byte(parser, OP_NULL)                  # null
+    elif (match(parser, TOKEN_NUMBER)):     emit_constant(parser, get_number(parser))   # Number
+    elif (match(parser, TOKEN_STRING)):     emit_constant(parser, get_string(parser))   # String
+    elif (match(parser, TOKEN_LEFT_PAREN)): grouping(parser)                            # Grouping Expression
+    elif (match(parser, TOKEN_LEFT_BRACKET)): array_literal(parser)                     # Array
+    elif (match(parser, TOKEN_IDENTIFIER)): variable_assignment(parser, True)           # Variable
     else:
-        error_current("Syntax Error", "Unexpected token.")
+        error_current(parser, "Syntax Error", "Unexpected token.")
 
 # Unary
-def unary():
+def unary(parser):
 
     # !, -
-    while (parser.current.kind in [TOKEN_BANG, TOKEN_MINUS]):
+    if (parser.current.kind in [TOKEN_BANG, TOKEN_MINUS]):
 
-        advance()
+        advance(parser)
 
         operator = parser.previous.kind
-        unary()
-        emit_unary_operator(operator)
+        start, constants_count = current_chunk(parser).count, current_chunk(parser).constants_count
 
-    literal()
+        if (enter_nesting(parser, UNARY_FRAMES)):
+            unary(parser)
+            emit_unary(parser, operator, start, constants_count)
+
+        leave_nesting(parser, UNARY_FRAMES)
+        return
+
+    call(parser)
 
 # Multiplication
-def multiplication():
+def multiplication(parser):
 
-    unary()
+    start, constants_count = current_chunk(parser).count, current_chunk(parser).constants_count
+    unary(parser)
 
     # /, *
     while (parser.current.kind in [TOKEN_SLASH, TOKEN_STAR]):
         
-        advance()
+        advance(parser)
 
         operator = parser.previous.kind
-        unary()
-        emit_operator(operator)
+        middle   = current_chunk(parser).count
+
+        unary(parser)
+        emit_binary(parser, operator, start, middle, constants_count)
 
 # Addition
-def addition():
+def addition(parser):
 
-    multiplication()
+    start, constants_count = current_chunk(parser).count, current_chunk(parser).constants_count
+    multiplication(parser)
 
     # -, +
     while (parser.current.kind in [TOKEN_MINUS, TOKEN_PLUS]):
         
-        advance()
+        advance(parser)
 
         operator = parser.previous.kind
-        multiplication()
-        emit_operator(operator)
+        middle   = current_chunk(parser).count
+
+        multiplication(parser)
+        emit_binary(parser, operator, start, middle, constants_count)
 
 # Comparison
-def comparison():
+def comparison(parser):
 
-    addition()
+    start, constants_count = current_chunk(parser).count, current_chunk(parser).constants_count
+    addition(parser)
 
     # >, >=, <, <=, &&, ||
     while (parser.current.kind in [TOKEN_GREATER, TOKEN_GREATER_EQUAL, TOKEN_LESS, TOKEN_LESS_EQUAL, TOKEN_OR, TOKEN_AND]):
         
-        advance()
+        advance(parser)
 
         operator = parser.previous.kind
-        addition()
-        emit_operator(operator)
+        middle   = current_chunk(parser).count
+
+        # Short-circuit
+        if (operator in [TOKEN_AND, TOKEN_OR]):
+            emit_logical(parser, operator, start, constants_count)
+            continue
+
+        addition(parser)
+        emit_binary(parser, operator, start, middle, constants_count)
 
 # Equality
-def equality():
+def equality(parser):
 
-    comparison()
+    start, constants_count = current_chunk(parser).count, current_chunk(parser).constants_count
+    comparison(parser)
 
     # !=, ==
     while (parser.current.kind in [TOKEN_BANG_EQUAL, TOKEN_EQUAL_EQUAL]):
         
-        advance()
+        advance(parser)
 
         operator = parser.previous.kind
-        comparison()
-        emit_operator(operator)
+        middle   = current_chunk(parser).count
+
+        comparison(parser)
+        emit_binary(parser, operator, start, middle, constants_count)
 
 
 # Expression
-def expression():
-    
-    equality()
+def expression(parser):
+
+    if (enter_nesting(parser, EXPRESSION_FRAMES)):
+        equality(parser)
+
+    leave_nesting(parser, EXPRESSION_FRAMES)
 
 # Print Statement
-def print_statement():
+def print_statement(parser):
     
-    expression()
-    emit_byte(OP_PRINT)
+    expression(parser)
+    emit_byte(parser, OP_PRINT)
 
     # Optional Semicolon
-    match(TOKEN_SEMICOLON)
+    match(parser, TOKEN_SEMICOLON)
 
 # Block
-def block():
+def block(parser):
 
     # Begin scope
-    begin_scope()
+    begin_scope(parser)
 
     # Loop until a matching '}'
-    while (not match(TOKEN_RIGHT_BRACE) and not match(TOKEN_END)):
-        statement()
+    while (not match(parser, TOKEN_RIGHT_BRACE) and not match(parser, TOKEN_END)):
+        statement(parser)
 
     # No '}' found?
     if (parser.previous.kind == TOKEN_END):
-        error_current("Syntax Error", "Expect '}' after statement.")
+        error_current(parser, "Syntax Error", "Expect '}' after statement.")
 
     # End scope
-    end_scope()
+    end_scope(parser)
 
 # If Statement
-def if_statement():
+def if_statement(parser):
 
     # Expect '(' after 'if' keyword
-    consume(TOKEN_LEFT_PAREN, "Syntax Error", "Expect '(' after 'if'.")
+    consume(parser, TOKEN_LEFT_PAREN, "Syntax Error", "Expect '(' after 'if'.")
 
     # Condition
-    grouping()
+    grouping(parser)
 
     # Emit body jump
-    then_jump = emit_jump(OP_JUMP_IF_FALSE)
-    emit_byte(OP_POP)
+    then_jump = emit_jump(parser, OP_JUMP_IF_FALSE)
+    emit_byte(parser, OP_POP)
 
     # Statement
-    statement()
+    statement(parser)
 
     # Emit else jump
-    else_jump = emit_jump(OP_JUMP)
+    else_jump = emit_jump(parser, OP_JUMP)
 
     # Patch body jump
-    patch_jump(then_jump)
-    emit_byte(OP_POP)
+    patch_jump(parser, then_jump)
+    emit_byte(parser, OP_POP)
 
     # Else Statement?
-    if (match(TOKEN_ELSE)):
-        statement()
+    if (match(parser, TOKEN_ELSE)):
+        statement(parser)
 
     # Patch else jump
-    patch_jump(else_jump)
+    patch_jump(parser, else_jump)
+
+# While Statement
+def while_statement(parser):
+
+    # The condition runs before every iteration
+    loop_start = current_chunk(parser).count
+
+    # Expect '(' after 'while' keyword
+    consume(parser, TOKEN_LEFT_PAREN, "Syntax Error", "Expect '(' after 'while'.")
+
+    # Condition
+    grouping(parser)
+
+    # Emit exit jump
+    exit_jump = emit_jump(parser, OP_JUMP_IF_FALSE)
+    emit_byte(parser, OP_POP)
+
+    # Body
+    statement(parser)
+    emit_loop(parser, loop_start)
+
+    # Patch exit jump
+    patch_jump(parser, exit_jump)
+    emit_byte(parser, OP_POP)
+
+# For Statement
+def for_statement(parser):
+
+    # Variables declared in the loop are local to it, end_scope() only
+    # forgets locals at the top level, so drop them here
+    locals_count = len(parser.compiler.local_variables)
+
+    begin_scope(parser)
+
+    # Expect '(' after 'for' keyword
+    consume(parser, TOKEN_LEFT_PAREN, "Syntax Error", "Expect '(' after 'for'.")
+
+    # Initializer
+    if (match(parser, TOKEN_VAR)):
+        variable_declaration(parser)
+    elif (not match(parser, TOKEN_SEMICOLON)):
+        expression(parser)
+        emit_byte(parser, OP_POP)
+
+        consume(parser, TOKEN_SEMICOLON, "Syntax Error", "Expect ';' after loop initializer.")
+
+    # The condition runs before every iteration
+    loop_start = current_chunk(parser).count
+    exit_jump  = None
+
+    # Condition
+    if (not match(parser, TOKEN_SEMICOLON)):
+        expression(parser)
+        consume(parser, TOKEN_SEMICOLON, "Syntax Error", "Expect ';' after loop condition.")
+
+        # Emit exit jump
+        exit_jump = emit_jump(parser, OP_JUMP_IF_FALSE)
+        emit_byte(parser, OP_POP)
+
+    # Increment, compiled here and moved after the body, so every iteration
+    # only jumps back once
+    increment = None
+
+    if (not check(parser, TOKEN_RIGHT_PAREN)):
+        increment_start = current_chunk(parser).count
+
+        expression(parser)
+        emit_byte(parser, OP_POP)
+
+        increment = chunk_cut(current_chunk(parser), increment_start)
+
+    consume(parser, TOKEN_RIGHT_PAREN, "Syntax Error", "Expect ')' after for clauses.")
+
+    # Body
+    statement(parser)
+
+    if (increment != None):
+        chunk_paste(current_chunk(parser), increment)
+
+    emit_loop(parser, loop_start)
+
+    # Patch exit jump
+    if (exit_jump != None):
+        patch_jump(parser, exit_jump)
+        emit_byte(parser, OP_POP)
+
+    end_scope(parser)
+
+    del parser.compiler.local_variables[locals_count:]
+
+# Resolve variable
+def resolve_variable(parser, name):
+
+    # Local?
+    if (name in parser.compiler.local_variables):
+        return (OP_SET_LOCAL, OP_GET_LOCAL, parser.compiler.local_variables.index(name))
+
+    # Global?
+    if (name in parser.compiler.global_variables):
+        return (OP_SET_GLOBAL, OP_GET_GLOBAL, parser.compiler.global_variables[name])
+
+    # Not declared
+    return None
+
+# Declare variable
+def declare_variable(parser, name, is_global):
+
+    # Local
+    if (not is_global):
+        parser.compiler.local_variables.append(name)
+
+        # Keep track of how many local slots the chunk needs
+        slot = len(parser.compiler.local_variables) - 1
+        current_chunk(parser).local_count = max(current_chunk(parser).local_count, slot + 1)
+
+        return (OP_SET_LOCAL, slot)
+
+    # Global
+    slot = len(parser.compiler.global_variables)
+
+    parser.compiler.global_variables[name] = slot
+    current_chunk(parser).global_names.append(name)
+
+    return (OP_SET_GLOBAL, slot)
 
 # Variable assignment
-def variable_assignment(is_expression = False):
+def variable_assignment(parser, is_expression = False):
 
     # Check if variable exists
-    if (not (parser.previous.content in current.global_variables or parser.previous.content in current.local_variables)):
-        error("Compile Error", "The variable '{0}' is not declared!".format(parser.previous.content))
-        return
+    variable = resolve_variable(parser, parser.previous.content)
 
-    # Make the variable
-    variable = make_constant(parser.previous.content)
+    if (variable == None):
+        error(parser, "Compile Error", "The variable '{0}' is not declared!".format(parser.previous.content))
+        return
 
-    # Get the opcodes
-    opcode_set = OP_SET_GLOBAL
-    opcode_get = OP_GET_GLOBAL
+    # Get the opcodes and the slot
+    opcode_set, opcode_get, slot = variable
 
-    if (current.scope_depth > 0): # Local
-        opcode_set = OP_SET_LOCAL
-        opcode_get = OP_GET_LOCAL
+    # Too many slots?
+    if (slot > CODE_MAX):
+        error(parser, "Compile Error", "Too many variables in one chunk.")
+        return
 
     # Declare the variable
-    if (match(TOKEN_EQUAL)): 
-        expression()
-        emit_bytes(opcode_set, variable)
+    if (match(parser, TOKEN_EQUAL)): 
+        expression(parser)
+        emit_bytes(parser, opcode_set, slot)
 
         # Is assigning inside an expression
         if (is_expression):
-            emit_bytes(opcode_get, variable)
+            emit_bytes(parser, opcode_get, slot)
         else:
             # Optional Semicolon
-            match(TOKEN_SEMICOLON)
+            match(parser, TOKEN_SEMICOLON)
     else:
-        emit_bytes(opcode_get, variable)
+        emit_bytes(parser, opcode_get, slot)
 
 # Variable declaration
-def variable_declaration(force_global = False):
-
-    # Check if variable exists
-    if (parser.previous.content in current.global_variables or parser.previous.content in current.local_variables):
-        error("Compile Error", "The variable '{0}' is already declared!".format(parser.previous.content))
-        return
+def variable_declaration(parser, force_global = False):
 
     # Expect identifier
     if (force_global):
-        consume(TOKEN_IDENTIFIER, "Syntax Error", "Expect variable name after 'global'.")
+        consume(parser, TOKEN_IDENTIFIER, "Syntax Error", "Expect variable name after 'global'.")
     else:
-        consume(TOKEN_IDENTIFIER, "Syntax Error", "Expect variable name after 'var'.")
-
-    # Make the variable
-    variable = make_constant(parser.previous.content)
+        consume(parser, TOKEN_IDENTIFIER, "Syntax Error", "Expect variable name after 'var'.")
 
-    # Get the opcode
-    opcode_set = OP_SET_GLOBAL
-
-    if (current.scope_depth > 0 and not force_global): # Local
-        opcode_set = OP_SET_LOCAL
+    # Check if variable exists
+    if (resolve_variable(parser, parser.previous.content) != None):
+        error(parser, "Compile Error", "The variable '{0}' is already declared!".format(parser.previous.content))
+        return
 
     # Declare the variable
-    if (current.scope_depth > 0 and not force_global):
-        current.local_variables.append(parser.previous.content)
-    else:
-        current.global_variables.append(parser.previous.content)
+    opcode_set, slot = declare_variable(parser, parser.previous.content, parser.compiler.scope_depth == 0 or force_global)
+
+    # Too many slots?
+    if (slot > CODE_MAX):
+        error(parser, "Compile Error", "Too many variables in one chunk.")
+        return
 
     # Assignment?
-    if (match(TOKEN_EQUAL)): 
-        expression()
-        emit_bytes(opcode_set, variable)
+    if (match(parser, TOKEN_EQUAL)): 
+        expression(parser)
+        emit_bytes(parser, opcode_set, slot)
 
         # Optional Semicolon
-        match(TOKEN_SEMICOLON)
+        match(parser, TOKEN_SEMICOLON)
     else:
-        emit_byte(OP_NULL)
-        emit_bytes(opcode_set, variable)
+        emit_byte(parser, OP_NULL)
+        emit_bytes(parser, opcode_set, slot)
 
         # Optional Semicolon
-        match(TOKEN_SEMICOLON)
+        match(parser, TOKEN_SEMICOLON)
+
+# Function body, compiled into its own chunk, returns the function
+def function_body(parser, name):
+
+    enclosing = parser.compiler
+    function  = Function(name)
+
+    # Globals are shared with the script, locals start over with the arguments
+    compiler = Compiler()
+    compiler.chunk            = function.chunk
+    compiler.function         = function
+    compiler.global_variables = enclosing.global_variables
+
+    function.chunk.global_names = enclosing.chunk.global_names
+
+    parser.compiler = compiler
+
+    # Parameters
+    consume(parser, TOKEN_LEFT_PAREN, "Syntax Error", "Expect '(' after function name.")
+
+    if (not check(parser, TOKEN_RIGHT_PAREN)):
+        while (True):
+            consume(parser, TOKEN_IDENTIFIER, "Syntax Error", "Expect parameter name.")
+
+            if (parser.previous.content in compiler.local_variables):
+                error(parser, "Compile Error", "The parameter '{0}' is already declared!".format(parser.previous.content))
+
+            declare_variable(parser, parser.previous.content, False)
+            function.arity += 1
+
+            if (function.arity > PARAMETERS_MAX):
+                error(parser, "Compile Error", "Can't have more than {0} parameters.".format(PARAMETERS_MAX))
+
+            if (not match(parser, TOKEN_COMMA)): break
+
+    consume(parser, TOKEN_RIGHT_PAREN, "Syntax Error", "Expect ')' after parameters.")
+    consume(parser, TOKEN_LEFT_BRACE, "Syntax Error", "Expect '{' before function body.")
+
+    # Body, returns null if it runs off the end
+    block(parser)
+
+    emit_byte(parser, OP_NULL)
+    emit_byte(parser, OP_RETURN)
+
+    parser.compiler = enclosing
+
+    if (parser.had_error): return function
+
+    # Work out how big the stack has to be, on top of the locals
+    chunk = function.chunk
+
+    chunk.stack_size = stack_depth(chunk)[0]
+    function.pure    = is_pure(chunk)
+
+    return function
+
+# Function Declaration
+def function_declaration(parser):
+
+    consume(parser, TOKEN_IDENTIFIER, "Syntax Error", "Expect function name after 'function'.")
+
+    name = parser.previous.content
+
+    # Check if variable exists
+    if (resolve_variable(parser, name) != None):
+        error(parser, "Compile Error", "The variable '{0}' is already declared!".format(name))
+        return
+
+    # Declared before the body, so a global function can call itself
+    opcode_set, slot = declare_variable(parser, name, parser.compiler.scope_depth == 0)
+
+    # Too many slots?
+    if (slot > CODE_MAX):
+        error(parser, "Compile Error", "Too many variables in one chunk.")
+        return
+
+    function = function_body(parser, name)
+
+    emit_constant(parser, function)
+    emit_bytes(parser, opcode_set, slot)
+
+# Return Statement
+def return_statement(parser):
+
+    if (parser.compiler.function == None):
+        error(parser, "Compile Error", "Can't return from top-level code.")
+        return
+
+    # Return value, null if there is none, the value starts on the same line
+    # as the return, a bare return at the end of a line doesn't take the next
+    # statement for it
+    if (check(parser, TOKEN_SEMICOLON) or check(parser, TOKEN_RIGHT_BRACE) or check(parser, TOKEN_END) or
+        token_start_line(parser.current) != parser.previous.line):
+        emit_byte(parser, OP_NULL)
+    else:
+        expression(parser)
+
+    emit_byte(parser, OP_RETURN)
+
+    # Optional Semicolon
+    match(parser, TOKEN_SEMICOLON)
+
+# Call Statement, the result is thrown away
+def call_statement(parser):
+
+    variable_assignment(parser, True)
+    finish_calls(parser)
+
+    emit_byte(parser, OP_POP)
+
+    # Optional Semicolon
+    match(parser, TOKEN_SEMICOLON)
 
 # Expression Statement
-def expression_statement():
+def expression_statement(parser):
 
-    expression()
+    expression(parser)
 
     # Optional Semicolon
-    match(TOKEN_SEMICOLON)
+    match(parser, TOKEN_SEMICOLON)
 
 # Statement
-def statement():
+def statement(parser):
 
     # Advance
-    advance()
+    advance(parser)
+
+    # Nested too deep?
+    if (not enter_nesting(parser, STATEMENT_FRAMES)):
+        leave_nesting(parser, STATEMENT_FRAMES)
+        return
 
     # Check token kind
     token = parser.previous.kind
 
     if (token == TOKEN_PRINT):        # Print Statement
-        print_statement()
+        print_statement(parser)
     elif (token == TOKEN_IF):         # If Statement
-        if_statement()
+        if_statement(parser)
+    elif (token == TOKEN_WHILE):      # While Statement
+        while_statement(parser)
+    elif (token == TOKEN_FOR):        # For Statement
+        for_statement(parser)
     elif (token == TOKEN_LEFT_BRACE): # Block
-        block()
+        block(parser)
+    elif (token == TOKEN_FUNCTION):   # Function Declaration
+        function_declaration(parser)
+    elif (token == TOKEN_RETURN):     # Return Statement
+        return_statement(parser)
+    elif (token == TOKEN_IDENTIFIER and check(parser, TOKEN_LEFT_PAREN)): # Call Statement
+        call_statement(parser)
     elif (token == TOKEN_IDENTIFIER): # Variable Assignment
-        variable_assignment()
+        variable_assignment(parser)
     elif (token == TOKEN_VAR):        # Variable Declaration
-        variable_declaration()
+        variable_declaration(parser)
     elif (token == TOKEN_GLOBAL):     # Global Variable Declaration
-        variable_declaration(True)
+        variable_declaration(parser, True)
     else:
-        error_current("Compile Error", "Expect statement.")
+        error_current(parser, "Compile Error", "Expect statement.")
 
-# Compile
-def compile(source):
+    leave_nesting(parser, STATEMENT_FRAMES)
 
-    # Initialize scanner
-    scanner_init(source)
+# Compile source, appending to the chunk of compiler, returns the parser, line
+# is where the source starts
+def compile_source(compiler, source, report = True, line = 1):
 
-    # Initialize compiler
-    compiler = Compiler()
-    compiler_init(compiler)
+    # Initialize parser, it owns the scanner
+    parser = Parser(source, line)
+    parser.report = report
+
+    compiler_init(parser, compiler)
+
+    start = current_chunk(parser).count
 
     # Start Compiling
-    advance()
+    advance(parser)
 
     # Loop until source end
-    while (not match(TOKEN_END) and not parser.had_error):
-        statement()
+    while (not match(parser, TOKEN_END) and not parser.had_error):
+        statement(parser)
 
     # Emit OP_EXIT
-    emit_byte(OP_EXIT)
+    emit_byte(parser, OP_EXIT)
+
+    if (parser.had_error): return parser
+
+    # Work out how big the stack has to be, every input of a session shares it
+    chunk = current_chunk(parser)
+    chunk.stack_size = max(chunk.stack_size, stack_depth(chunk, start)[0])
+
+    return parser
+
+# Get a chunk and the chunks of every function in it
+def chunk_functions(chunk):
+
+    chunks = [chunk]
+
+    for constant in chunk.constants:
+        if (type(constant) == Function):
+            chunks.extend(chunk_functions(constant.chunk))
+
+    return chunks
+
+# Compile
+def compile(source, optimize = True):
+
+    # Initialize compiler
+    compiler = Compiler()
+    parser   = compile_source(compiler, source)
+
+    # Failed to compile?
+    if (parser.had_error): return None
+
+    # Peephole optimize, the functions too
+    if (optimize):
+        for chunk in chunk_functions(current_chunk(parser)):
+            peephole(chunk)
+
+            # The rewritten code needs its own stack size
+            chunk.stack_size = stack_depth(chunk)[0]
+
+    # Return the compiled chunk
+    return current_chunk(parser)
+
+# Run
+def run(source):
+
+    # Compile
+    chunk = compile(source)
 
     # Interpret chunk
-    if (not parser.had_error):
-        interpreter_init(current_chunk())
-        interpret()
\ No newline at end of file
+    if (chunk != None):
+        interpreter = Interpreter()
+        interpreter_init(interpreter, chunk)
+        interpret(interpreter)
\ No newline at end of file
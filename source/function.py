@@ -0,0 +1,15 @@
+from chunk import Chunk
+
+# Function, compiled into its own chunk
+class Function():
+
+    # Initialize
+    def __init__(self, name):
+
+        self.name  = name
+        self.arity = 0
+        self.chunk = Chunk()
+
+        # Only touches its arguments and locals, so the same arguments always
+        # give the same result
+        self.pure = False
@@ -1,361 +1,1108 @@
 from opcodes  import *
 from coloring import failure, success, warning
 from utils    import to_number
+from chunk    import chunk_view, constant_key
+from output   import Output, output_write, output_flush, format_value
+from function import Function
+from rope     import Rope, ROPE_MIN, rope_text, concat
 
-# Interpreter
+from collections import OrderedDict
+from itertools   import repeat
+from array       import array
+
+import operator
+
+# Most calls in progress at once, every call also takes a few Python frames
+FRAMES_MAX = 255
+
+# Results kept per memoized function, once memoization is turned on
+MEMO_SIZE = 256
+
+# Operands of element-wise operators, at least one of them an array
+NUMERIC = (float, array)
+
+# Text values, a long string built with + is kept as a rope
+TEXT = (str, Rope)
+
+# Call frame, the function running and where its locals start on the stack
+class Frame():
+
+    __slots__ = ("function", "base")
+
+    # Initialize
+    def __init__(self, function, base):
+
+        self.function = function
+        self.base     = base
+
+# Interpreter, every run gets its own, so nothing is shared between runs
 class Interpreter():
 
-    stack       = []
-    stack_count = 0
+    # Initialize
+    def __init__(self):
+
+        self.stack = []
+
+        self.chunk = None
+
+        self.index     = 0
+        self.had_error = False
 
-    chunk = None
+        self.global_variables = []
+        self.global_slots     = {}
+        self.local_variables  = []
 
-    index     = 0
-    had_error = False
+        # Calls in progress, and the handlers made for each function
+        self.frames = []
+        self.calls  = {}
 
-    global_variables = {}
-    local_variables  = []
+        # Results of pure functions by arguments, off until memo_size is set
+        self.memo_size = 0
+        self.memos     = {}
 
-interpreter = Interpreter()
+        # Runs the dispatch loop of a call, given the handlers, the code and
+        # the index to start at, None for the plain loop. The profiler swaps
+        # in its own, so the opcodes of functions are counted too.
+        self.dispatch = None
+
+        # Where print writes to, it outlives interpreter_init
+        self.output = Output()
 
 # Runtime Error
-def runtime_error(message):
+def runtime_error(interpreter, message):
 
     # Set had error to true
     interpreter.had_error = True
 
-    # Get line and column
-    line   = interpreter.chunk.lines[interpreter.index - 1]
-    column = interpreter.chunk.columns[interpreter.index - 1]
+    # Get line and column, in the chunk of the function running if any
+    chunk = interpreter.frames[-1].function.chunk if (len(interpreter.frames) > 0) else interpreter.chunk
+
+    line   = chunk.lines[interpreter.index - 1]
+    column = chunk.columns[interpreter.index - 1]
+
+    # Show the error message, after everything printed before it
+    output_flush(interpreter.output)
 
-    # Show the error message
     error_message = "[{0}:{1}] Runtime Error:".format(line, column)
     error_message += "\n>>\t{0}".format(message)
     print(failure(error_message))
 
-# Push to the stack
-def push(value):
-    
-    # Set that stack slot to the push value and increase stack count
-    interpreter.stack[interpreter.stack_count] = value
-    interpreter.stack_count += 1
+# Runtime Error at index
+def runtime_error_at(interpreter, index, message):
 
-# Pop from the stack
-def pop():
+    # Point the error at the instruction that was just read
+    interpreter.index = index
+    runtime_error(interpreter, message)
 
-    # Get the pop value
-    value = interpreter.stack[interpreter.stack_count - 1]
+    # Stop the dispatch loop
+    return -1
 
-    # Decrease stack count and set that stack slot to 0
-    interpreter.stack_count -= 1
-    interpreter.stack[interpreter.stack_count] = 0
+# Initialize Interpreter
+def interpreter_init(interpreter, chunk):
 
-    # Return the pop value
-    return value
+    interpreter.chunk     = chunk
+    interpreter.index     = 0
+    interpreter.had_error = False
+    interpreter.stack     = []
 
-# Peek
-def peek(distance):
+    # One value per global slot, names are only kept for the fallback path
+    interpreter.global_variables = [None] * len(chunk.global_names)
+    interpreter.global_slots     = {name: slot for slot, name in enumerate(chunk.global_names)}
 
-    # Get the value at distance
-    return interpreter.stack[(interpreter.stack_count - 1) - distance]
+    interpreter.local_variables = [None] * chunk.local_count
 
-# Read byte
-def read_byte():
+    # Handlers and results were made for the old stack and globals
+    interpreter.frames = []
+    interpreter.calls  = {}
+    interpreter.memos  = {}
 
-    # Increase index and return the old index value
-    interpreter.index += 1
-    return interpreter.chunk.code[interpreter.index - 1]
+# Make room in the interpreter for the slots the chunk gained since it was
+# initialized, the values already stored are kept
+def interpreter_grow(interpreter):
 
-# Read Jump
-def read_jump():
+    chunk = interpreter.chunk
 
-    # Increase index and return the old index value
-    interpreter.index += 1
-    return (interpreter.chunk.code[interpreter.index - 1])
+    for slot in range(len(interpreter.global_variables), len(chunk.global_names)):
+        interpreter.global_variables.append(None)
+        interpreter.global_slots[chunk.global_names[slot]] = slot
 
-# Read Constant
-def read_constant():
+    interpreter.local_variables.extend([None] * (chunk.local_count - len(interpreter.local_variables)))
 
-    # Read constant and return it
-    return interpreter.chunk.constants[read_byte()]
+# Element-wise, applies an operator to every element when either operand
+# is an array, a number goes with every element. Returns the resulting
+# array, or None after reporting message if the operands don't fit.
+def elementwise(interpreter, index, compute, a, b, message):
 
-# Binary Op
-def binary_op(operator):
+    if (type(a) not in NUMERIC or type(b) not in NUMERIC or (type(a) != array and type(b) != array)):
+        runtime_error_at(interpreter, index, message)
+        return None
 
-    # Type checking
-    if (type(peek(0)) != float or type(peek(1)) != float):
-        runtime_error("Operands must be two numbers.")
-        return
+    if (type(a) != array):   a = repeat(a, len(b))
+    elif (type(b) != array): b = repeat(b, len(a))
+    elif (len(a) != len(b)):
+        runtime_error_at(interpreter, index, "Arrays must be the same length.")
+        return None
 
-    # Pop values to be calculated
-    b = float(pop())
-    a = float(pop())
+    try:
+        return array("d", map(compute, a, b))
+    except ZeroDivisionError:
+        runtime_error_at(interpreter, index, "Division by zero.")
+        return None
 
-    # Calculate
-    if (operator == OP_ADD): push(float(a + b)) # Addition
-    if (operator == OP_SUB): push(float(a - b)) # Subtraction
-    if (operator == OP_MUL): push(float(a * b)) # Multiplication
-    if (operator == OP_DIV): push(float(a / b)) # Division
+# Add anything but two numbers, strings and ropes are concatenated and
+# arrays added element-wise. Returns the result, or None after reporting
+# message if the operands don't fit.
+def add_values(interpreter, index, a, b, message):
 
-    if (operator == OP_LESS):         push(bool(a <  b)) # Less
-    if (operator == OP_LESS_THAN):    push(bool(a <= b)) # Less than
-    if (operator == OP_GREATER):      push(bool(a >  b)) # Greater
-    if (operator == OP_GREATER_THAN): push(bool(a >= b)) # Greater than
+    if (type(a) in TEXT and type(b) in TEXT): return concat(a, b)
 
-# Unary Op
-def unary_op(operator):
+    return elementwise(interpreter, index, operator.add, a, b, message)
 
-    # Type checking
-    if (type(peek(0)) != float):
-        runtime_error("Operand must be a number.")
-        return
+# Make handlers, for the script or for a function
+def make_handlers(interpreter, code, function = None):
 
-    # Pop value to be calculated
-    a = float(pop())
+    # Every handler receives the index right after its opcode and returns the
+    # index of the next opcode, or -1 to stop the dispatch loop. The hot
+    # attributes are cached here once, so the handlers only touch locals.
+    constants = interpreter.chunk.constants if (function == None) else function.chunk.constants
+    stack     = interpreter.stack
+    push      = stack.append
+    pop       = stack.pop
 
-    # Calculate
-    if (operator == OP_NEGATE): push(float(-a)) # Negative
+    global_variables = interpreter.global_variables
+    global_slots     = interpreter.global_slots
+    local_variables  = interpreter.local_variables
 
-# Initialize Interpreter
-def interpreter_init(chunk):
+    output = interpreter.output
+    frames = interpreter.frames
 
-    interpreter.chunk = chunk
+    # Sites whose specialized opcode failed its type guard, they stay generic
+    generic_sites = set()
 
-    for i in range(255):
-        i = i
-        interpreter.stack.append(0)
-        interpreter.local_variables.append(0.0)
+    # Quicken, rewrites the opcode right before index into a specialized one
+    def quicken(index, opcode):
+        if (index not in generic_sites): code[index - 1] = opcode
 
-# Interpret bytecode
-def interpret():
+    # Deoptimize, rewrites the opcode right before index back into the
+    # generic one for good
+    def deoptimize(index, opcode):
+        generic_sites.add(index)
+        code[index - 1] = opcode
 
-    # Start interpreting
-    while (not interpreter.had_error):
+    # Add the two values on top of the stack, the slow path of op_add
+    def op_add_values(index, message):
 
-        # Get OpCode
-        byte = read_byte()
+        result = add_values(interpreter, index, stack[-2], stack[-1], message)
+        if (result is None): return -1
 
-        # Constant
-        if (byte == OP_CONSTANT): push(read_constant())
+        pop()
+        stack[-1] = result
+        return index
 
-        # Boolean Constants
-        if (byte == OP_TRUE):  push(True)  # true
-        if (byte == OP_FALSE): push(False) # false
-        if (byte == OP_NULL):  push(None)  # null
+    # Replace ropes in the two values on top of the stack with their text,
+    # returns True if there were any
+    def flatten_top():
 
-        # Add
-        if (byte == OP_ADD):
+        flattened = False
 
-            # Type checking
-            if (not(type(peek(0)) == type(peek(1)))):
-                runtime_error("Operands must be the same type.")
-                return
+        for i in [-1, -2]:
+            if (type(stack[i]) == Rope):
+                stack[i]  = rope_text(stack[i])
+                flattened = True
 
-            # Pop values to be calculated
-            b = pop()
-            a = pop()
+        return flattened
 
-            # Calculate
-            if (type(a) == str):   push(str(a + b))   # String
-            if (type(a) == float): push(float(a + b)) # Number
+    # Element-wise binary operator on the two values on top of the stack
+    def op_elementwise(index, compute, message):
 
-        # Subtract
-        if (byte == OP_SUB): binary_op(OP_SUB)
+        result = elementwise(interpreter, index, compute, stack[-2], stack[-1], message)
+        if (result is None): return -1
 
-        # Multiply
-        if (byte == OP_MUL): binary_op(OP_MUL)
+        pop()
+        stack[-1] = result
+        return index
 
-        # Divide
-        if (byte == OP_DIV): binary_op(OP_DIV)
+    # Constant
+    def op_constant(index):
+        push(constants[code[index]])
+        return index + 1
 
-        # Negate
-        if (byte == OP_NEGATE): unary_op(OP_NEGATE)
+    # Boolean Constants
+    def op_true(index):
+        push(True)
+        return index
 
-        # Not
-        if (byte == OP_NOT): 
-            
-            # Type checking
-            if (type(peek(0)) != bool):
-                runtime_error("Operand must be a boolean.")
-                return
+    def op_false(index):
+        push(False)
+        return index
 
-            # Pop value to be compared
-            a = bool(pop())
+    def op_null(index):
+        push(None)
+        return index
 
-            # Push new boolean
-            push(bool(not a))
+    # Add
+    def op_add(index):
 
-        # Not Equal
-        if (byte == OP_NOT_EQUAL):
+        # Type checking
+        b = stack[-1]
+        a = stack[-2]
 
-            # Type checking
-            if (not(type(peek(0)) == type(peek(1)))):
-                runtime_error("Operands must be the same type.")
-                return
+        if (type(a) != type(b)):
+            return op_add_values(index, "Operands must be the same type.")
 
-            # Pop values to be compared
-            b = pop()
-            a = pop()
+        if (type(a) == float):
+            quicken(index, OP_ADD_NUM)
+        elif (type(a) == str):
+            quicken(index, OP_ADD_STR)
+        else:
+            return op_add_values(index, "Operands must be two numbers or two strings.")
 
-            # Compare
-            if (type(a) == str):   push(bool(not (a == b))) # String
-            if (type(a) == float): push(bool(not (a == b))) # Number
+        # Calculate
+        pop()
+        stack[-1] = a + b if (type(a) == float) else concat(a, b)
+        return index
 
-        # Less
-        if (byte == OP_LESS): binary_op(OP_LESS)
-        
-        # Less Than
-        if (byte == OP_LESS_THAN): binary_op(OP_LESS_THAN)
+    # Add two numbers
+    def op_add_num(index):
 
-        # Greater
-        if (byte == OP_GREATER): binary_op(OP_GREATER)
+        # Type guard
+        b = stack[-1]
+        a = stack[-2]
 
-        # Greater Than
-        if (byte == OP_GREATER_THAN): binary_op(OP_GREATER_THAN)
+        if (type(a) != float or type(b) != float):
+            deoptimize(index, OP_ADD)
+            return op_add(index)
 
-        # Equals
-        if (byte == OP_EQUALS):
+        pop()
+        stack[-1] = a + b
+        return index
 
-            # Type checking
-            if (not(type(peek(0)) == type(peek(1)))):
-                runtime_error("Operands must be the same type.")
-                return
-
-            # Pop values to be compared
-            b = pop()
-            a = pop()
-
-            # Compare
-            if (type(a) == float):  # Numbers
-                push(bool(a == b))
-            elif (type(a) == str):  # Strings
-                push(bool(a == b))
-            elif (type(a) == bool): # Booleans
-                push(bool(a == b))
-            else:
-                runtime_error("Operands must be two numbers, two strings or two booleans.")
-        
-        # And
-        if (byte == OP_AND):
+    # Add two strings
+    def op_add_str(index):
 
-            # Type checking
-            if (type(peek(0)) != bool or type(peek(1)) != bool):
-                runtime_error("Operands must be two booleans.")
-                return
+        # Type guard
+        b = stack[-1]
+        a = stack[-2]
 
-            # Pop values to be compared
-            b = pop()
-            a = pop()
+        if (type(a) != str or type(b) != str):
+            deoptimize(index, OP_ADD)
+            return op_add(index)
 
-            # Push new boolean
-            push(bool(a and b))
+        # Long text becomes a rope, so building it up doesn't copy it
+        pop()
+        stack[-1] = a + b if (len(a) < ROPE_MIN) else concat(a, b)
+        return index
 
-        # Or
-        if (byte == OP_OR):
+    # Subtract
+    def op_sub(index):
 
-            # Type checking
-            if (type(peek(0)) != bool or type(peek(1)) != bool):
-                runtime_error("Operands must be two booleans.")
-                return
+        b = stack[-1]
+        a = stack[-2]
 
-            # Pop values to be compared
-            b = pop()
-            a = pop()
+        if (type(a) != float or type(b) != float):
+            return op_elementwise(index, operator.sub, "Operands must be two numbers.")
 
-            # Push new boolean
-            push(bool(a or b))
+        pop()
+        stack[-1] = a - b
+        return index
 
-        # Jump If False
-        if (byte == OP_JUMP_IF_FALSE):
+    # Multiply
+    def op_mul(index):
 
-            # Read jump offset
-            offset = read_jump()
+        b = stack[-1]
+        a = stack[-2]
 
-            # If false, jump to that offset
-            if (not bool(peek(0))): 
-                interpreter.index += offset
+        if (type(a) != float or type(b) != float):
+            return op_elementwise(index, operator.mul, "Operands must be two numbers.")
+
+        pop()
+        stack[-1] = a * b
+        return index
+
+    # Divide
+    def op_div(index):
+
+        b = stack[-1]
+        a = stack[-2]
+
+        if (type(a) != float or type(b) != float):
+            return op_elementwise(index, operator.truediv, "Operands must be two numbers.")
+
+        if (b == 0.0):
+            return runtime_error_at(interpreter, index, "Division by zero.")
+
+        pop()
+        stack[-1] = a / b
+        return index
+
+    # Less
+    def op_less(index):
+
+        b = stack[-1]
+        a = stack[-2]
+
+        if (type(a) != float or type(b) != float):
+            return op_elementwise(index, operator.lt, "Operands must be two numbers.")
+
+        pop()
+        stack[-1] = a < b
+        return index
+
+    # Less Than
+    def op_less_than(index):
+
+        b = stack[-1]
+        a = stack[-2]
+
+        if (type(a) != float or type(b) != float):
+            return op_elementwise(index, operator.le, "Operands must be two numbers.")
+
+        pop()
+        stack[-1] = a <= b
+        return index
+
+    # Greater
+    def op_greater(index):
+
+        b = stack[-1]
+        a = stack[-2]
+
+        if (type(a) != float or type(b) != float):
+            return op_elementwise(index, operator.gt, "Operands must be two numbers.")
+
+        pop()
+        stack[-1] = a > b
+        return index
+
+    # Greater Than
+    def op_greater_than(index):
+
+        b = stack[-1]
+        a = stack[-2]
+
+        if (type(a) != float or type(b) != float):
+            return op_elementwise(index, operator.ge, "Operands must be two numbers.")
+
+        pop()
+        stack[-1] = a >= b
+        return index
+
+    # Negate
+    def op_negate(index):
+
+        # Type checking
+        if (type(stack[-1]) != float):
 
-        # Jump
-        if (byte == OP_JUMP):
+            # Every element of an array
+            if (type(stack[-1]) == array):
+                stack[-1] = array("d", map(operator.neg, stack[-1]))
+                return index
 
-            # Read jump offset
-            offset = read_jump()
+            return runtime_error_at(interpreter, index, "Operand must be a number.")
 
-            # Jump to that offset
-            interpreter.index += offset
+        stack[-1] = -stack[-1]
+        return index
 
-        # Pop
-        if (byte == OP_POP):
+    # Not
+    def op_not(index):
+
+        # Type checking
+        if (type(stack[-1]) != bool):
+            return runtime_error_at(interpreter, index, "Operand must be a boolean.")
+
+        stack[-1] = not stack[-1]
+        return index
+
+    # Equals
+    def op_equals(index):
+
+        # Type checking
+        b = stack[-1]
+        a = stack[-2]
+
+        if (type(a) != type(b)):
+            if (flatten_top()): return op_equals(index)
+            return op_elementwise(index, operator.eq, "Operands must be the same type.")
+
+        if (type(a) == float):
+            quicken(index, OP_EQUALS_NUM)
+        elif (type(a) == str):
+            quicken(index, OP_EQUALS_STR)
+        elif (type(a) != bool):
+            if (flatten_top()): return op_equals(index)
+            return op_elementwise(index, operator.eq, "Operands must be two numbers, two strings or two booleans.")
+
+        # Compare
+        pop()
+        stack[-1] = a == b
+        return index
+
+    # Not Equal
+    def op_not_equal(index):
+
+        # Type checking
+        b = stack[-1]
+        a = stack[-2]
+
+        if (type(a) != type(b)):
+            if (flatten_top()): return op_not_equal(index)
+            return op_elementwise(index, operator.ne, "Operands must be the same type.")
+
+        if (type(a) == float):
+            quicken(index, OP_NOT_EQUAL_NUM)
+        elif (type(a) == str):
+            quicken(index, OP_NOT_EQUAL_STR)
+        elif (type(a) != bool):
+            if (flatten_top()): return op_not_equal(index)
+            return op_elementwise(index, operator.ne, "Operands must be two numbers, two strings or two booleans.")
+
+        # Compare
+        pop()
+        stack[-1] = a != b
+        return index
+
+    # Make Specialized Compare, compares two values of one type and falls
+    # back to the generic opcode when they are not of that type
+    def make_specialized_compare(compare, kind, generic, handler):
+
+        def op_specialized_compare(index):
+
+            # Type guard
+            b = stack[-1]
+            a = stack[-2]
+
+            if (type(a) != kind or type(b) != kind):
+                deoptimize(index, generic)
+                return handler(index)
 
-            # Just pop
             pop()
+            stack[-1] = compare(a, b)
+            return index
 
-        # Set Global
-        if (byte == OP_SET_GLOBAL):
+        return op_specialized_compare
 
-            # Read variable name
-            name = str(read_constant())
+    # And
+    def op_and(index):
 
-            # Set variable value
-            interpreter.global_variables[name] = pop()
+        # Type checking
+        b = stack[-1]
+        a = stack[-2]
 
-        # Get Global
-        if (byte == OP_GET_GLOBAL):
+        if (type(a) != bool or type(b) != bool):
+            return runtime_error_at(interpreter, index, "Operands must be two booleans.")
 
-            # Read variable name
-            name = str(read_constant())
+        pop()
+        stack[-1] = a and b
+        return index
 
-            # Push variable value
-            push(interpreter.global_variables[name])
+    # Or
+    def op_or(index):
 
-        # Set Local
-        if (byte == OP_SET_LOCAL):
+        # Type checking
+        b = stack[-1]
+        a = stack[-2]
+
+        if (type(a) != bool or type(b) != bool):
+            return runtime_error_at(interpreter, index, "Operands must be two booleans.")
+
+        pop()
+        stack[-1] = a or b
+        return index
+
+    # Jump If False
+    def op_jump_if_false(index):
+
+        # If false, jump to that offset
+        if (not stack[-1]):
+            return index + 1 + code[index]
+
+        return index + 1
+
+    # Jump If True, fused from Not and Jump If False so it keeps the type check
+    def op_jump_if_true(index):
+
+        # Type checking
+        if (type(stack[-1]) != bool):
+            return runtime_error_at(interpreter, index, "Operand must be a boolean.")
+
+        # If true, jump to that offset
+        if (stack[-1]):
+            return index + 1 + code[index]
+
+        return index + 1
+
+    # Jump If False Or Pop, for &&, a false left operand is the result
+    def op_jump_if_false_or_pop(index):
+
+        # Type checking
+        if (type(stack[-1]) != bool):
+            return runtime_error_at(interpreter, index, "Operands must be two booleans.")
+
+        # If false, jump to that offset and keep it
+        if (not stack[-1]):
+            return index + 1 + code[index]
+
+        pop()
+        return index + 1
+
+    # Jump If True Or Pop, for ||, a true left operand is the result
+    def op_jump_if_true_or_pop(index):
+
+        # Type checking
+        if (type(stack[-1]) != bool):
+            return runtime_error_at(interpreter, index, "Operands must be two booleans.")
+
+        # If true, jump to that offset and keep it
+        if (stack[-1]):
+            return index + 1 + code[index]
+
+        pop()
+        return index + 1
+
+    # Long forms of the short-circuit jumps
+    def op_jump_if_false_or_pop_long(index):
+
+        if (type(stack[-1]) != bool):
+            return runtime_error_at(interpreter, index, "Operands must be two booleans.")
+
+        if (not stack[-1]):
+            return index + 2 + ((code[index] << 16) | code[index + 1])
+
+        pop()
+        return index + 2
+
+    def op_jump_if_true_or_pop_long(index):
+
+        if (type(stack[-1]) != bool):
+            return runtime_error_at(interpreter, index, "Operands must be two booleans.")
+
+        if (stack[-1]):
+            return index + 2 + ((code[index] << 16) | code[index + 1])
+
+        pop()
+        return index + 2
+
+    # Check Bool, the right operand of && and || must be a boolean too
+    def op_check_bool(index):
+
+        # Type checking
+        if (type(stack[-1]) != bool):
+            return runtime_error_at(interpreter, index, "Operands must be two booleans.")
+
+        return index
+
+    # Jump
+    def op_jump(index):
+        return index + 1 + code[index]
+
+    # Loop
+    def op_loop(index):
+        return index + 1 - code[index]
+
+    # Long jumps, the offset takes two cells
+    def op_loop_long(index):
+        return index + 2 - ((code[index] << 16) | code[index + 1])
+
+    def op_jump_long(index):
+        return index + 2 + ((code[index] << 16) | code[index + 1])
+
+    def op_jump_if_false_long(index):
 
-            # Read variable slot
-            slot = read_byte()
+        # If false, jump to that offset
+        if (not stack[-1]):
+            return index + 2 + ((code[index] << 16) | code[index + 1])
 
-            # Set variable value
-            interpreter.local_variables[slot] = pop()
+        return index + 2
+
+    # Pop
+    def op_pop(index):
+        pop()
+        return index
+
+    # Set Global
+    def op_set_global(index):
+        global_variables[code[index]] = pop()
+        return index + 1
+
+    # Get Global
+    def op_get_global(index):
+        push(global_variables[code[index]])
+        return index + 1
+
+    # Tee Global, sets the variable and keeps the value on the stack
+    def op_tee_global(index):
+        global_variables[code[index]] = stack[-1]
+        return index + 1
+
+    # Set Global by name, for names not resolved at compile time
+    def op_set_global_name(index):
+
+        name = constants[code[index]]
+        slot = global_slots.get(name)
+
+        # New global?
+        if (slot == None):
+            slot = len(global_variables)
+            global_slots[name] = slot
+            global_variables.append(None)
+
+        global_variables[slot] = pop()
+        return index + 1
+
+    # Get Global by name, for names not resolved at compile time
+    def op_get_global_name(index):
+
+        name = constants[code[index]]
+        slot = global_slots.get(name)
+
+        # Undefined?
+        if (slot == None):
+            return runtime_error_at(interpreter, index, "The variable '{0}' is not declared!".format(name))
+
+        push(global_variables[slot])
+        return index + 1
+
+    # Set Local
+    def op_set_local(index):
+        local_variables[code[index]] = pop()
+        return index + 1
+
+    # Get Local
+    def op_get_local(index):
+        push(local_variables[code[index]])
+        return index + 1
+
+    # Tee Local, sets the variable and keeps the value on the stack
+    def op_tee_local(index):
+        local_variables[code[index]] = stack[-1]
+        return index + 1
+
+    # Print
+    def op_print(index):
+
+        # Pop value to be printed, and buffer its text
+        output_write(output, format_value(pop()))
+
+        return index
+
+    # Add Constant
+    def op_add_constant(index):
+
+        # Type checking
+        b = constants[code[index]]
+        a = stack[-1]
+
+        if (type(a) != type(b) or type(a) != float):
+            result = add_values(interpreter, index, a, b, "Operands must be the same type.")
+            if (result is None): return -1
+
+            stack[-1] = result
+            return index + 1
+
+        stack[-1] = a + b
+        return index + 1
+
+    # Increment Global
+    def op_increment_global(index):
+
+        # Type checking
+        slot = code[index]
+        b    = constants[code[index + 1]]
+        a    = global_variables[slot]
+
+        if (type(a) != type(b) or type(a) != float):
+            a = add_values(interpreter, index, a, b, "Operands must be the same type.")
+            if (a is None): return -1
+
+            global_variables[slot] = a
+            return index + 2
+
+        global_variables[slot] = a + b
+        return index + 2
+
+    # Increment Local
+    def op_increment_local(index):
+
+        # Type checking
+        slot = code[index]
+        b    = constants[code[index + 1]]
+        a    = local_variables[slot]
+
+        if (type(a) != type(b) or type(a) != float):
+            a = add_values(interpreter, index, a, b, "Operands must be the same type.")
+            if (a is None): return -1
+
+            local_variables[slot] = a
+            return index + 2
+
+        local_variables[slot] = a + b
+        return index + 2
+
+    # Pop Jump If False
+    def op_pop_jump_if_false(index):
+
+        # If false, jump to that offset
+        if (not pop()):
+            return index + 1 + code[index]
+
+        return index + 1
+
+    # Pop Jump If True, keeps the type check of the Not it was fused from
+    def op_pop_jump_if_true(index):
+
+        # Type checking
+        if (type(stack[-1]) != bool):
+            return runtime_error_at(interpreter, index, "Operand must be a boolean.")
+
+        # If true, jump to that offset
+        if (pop()):
+            return index + 1 + code[index]
+
+        return index + 1
+
+    # Element-wise compare, then jump if the resulting array is false, the
+    # same as the compare and jump it was fused from
+    def op_elementwise_jump(index, compare, message):
+
+        result = elementwise(interpreter, index, compare, stack[-2], stack[-1], message)
+        if (result is None): return -1
+
+        del stack[-2:]
+
+        # If false, jump to that offset
+        if (not result):
+            return index + 1 + code[index]
+
+        return index + 1
+
+    # Make Compare Jump, compares the two values on top of the stack, pops
+    # them and jumps if the comparison is false
+    def make_compare_jump(compare, types, same_message, types_message):
+
+        def op_compare_jump(index):
+
+            # Type checking
+            b = stack[-1]
+            a = stack[-2]
+
+            if (type(a) != type(b)):
+                if (flatten_top()): return op_compare_jump(index)
+                return op_elementwise_jump(index, compare, same_message)
+
+            if (type(a) not in types):
+                if (flatten_top()): return op_compare_jump(index)
+                return op_elementwise_jump(index, compare, types_message)
+
+            del stack[-2:]
+
+            # If false, jump to that offset
+            if (not compare(a, b)):
+                return index + 1 + code[index]
+
+            return index + 1
+
+        return op_compare_jump
+
+    # Exit
+    def op_exit(index):
+        return -1
+
+    # Array, made from the numbers on top of the stack
+    def op_array(index):
+
+        count  = code[index]
+        values = stack[len(stack) - count:]
+
+        # Type checking
+        for value in values:
+            if (type(value) != float):
+                return runtime_error_at(interpreter, index, "Array elements must be numbers.")
+
+        del stack[len(stack) - count:]
+
+        push(array("d", values))
+        return index + 1
+
+    # Array Extend, adds the numbers on top of the stack to the array below
+    # them, long array literals are made a batch at a time
+    def op_array_extend(index):
+
+        count  = code[index]
+        values = stack[len(stack) - count:]
+
+        # Type checking
+        for value in values:
+            if (type(value) != float):
+                return runtime_error_at(interpreter, index, "Array elements must be numbers.")
+
+        del stack[len(stack) - count:]
+
+        stack[-1].extend(values)
+        return index + 1
+
+    # Index
+    def op_index(index):
+
+        # Type checking
+        position = stack[-1]
+        a        = stack[-2]
+
+        if (type(a) != array):
+            return runtime_error_at(interpreter, index, "Can only index arrays.")
+
+        if (type(position) != float or not position.is_integer()):
+            return runtime_error_at(interpreter, index, "Index must be a whole number.")
+
+        if (position < 0 or position >= len(a)):
+            return runtime_error_at(interpreter, index, "Index out of range.")
+
+        pop()
+        stack[-1] = a[int(position)]
+        return index
+
+    # Call, the arguments stay where they are and become the first locals of
+    # the function
+    def op_call(index):
+
+        count  = code[index]
+        callee = stack[-1 - count]
+
+        if (type(callee) != Function):
+            return runtime_error_at(interpreter, index, "Can only call functions.")
+
+        if (count != callee.arity):
+            return runtime_error_at(interpreter, index, "Expected {0} arguments but got {1}.".format(callee.arity, count))
+
+        if (len(frames) == FRAMES_MAX):
+            return runtime_error_at(interpreter, index, "Stack overflow.")
+
+        call_function(interpreter, callee, len(stack) - count)
+
+        if (interpreter.had_error): return -1
+        return index + 1
+
+    # Return, the result is left on top for call_function
+    def op_return(index):
+        return -1
+
+    # The locals of a function are a window of the stack, starting at the
+    # base of its frame
+    if (function != None):
+
+        # Set Local
+        def op_set_local(index):
+            stack[frames[-1].base + code[index]] = pop()
+            return index + 1
 
         # Get Local
-        if (byte == OP_GET_LOCAL):
-
-            # Read variable slot
-            slot = read_byte()
-
-            # Push variable value
-            push(interpreter.local_variables[slot])
-            
-        # Print
-        if (byte == OP_PRINT): 
-            
-            # Pop value to be printed
-            a = pop()
-
-            # Print
-            if (a == None):                        print("null")  # null
-            elif (a == True  and type(a) == bool): print("true")  # true
-            elif (a == False and type(a) == bool): print("false") # false
-            elif (type(a) == str):                                # String
-
-                # Split all new lines and print each one
-                a = a.split("\\n")
-
-                for i in range(len(a)):
-                    print(a[i])
-            else: # Anything
-                print(a)
-
-        # Loop
-        if (byte == OP_LOOP):
-            
-            # Read jump offset
-            offset = read_jump()
-
-            # Go back to that offset
-            interpreter.index -= offset
-
-        # Exit
-        if (byte == OP_EXIT):
-            # Do nothing, just leave the loop
-            break
\ No newline at end of file
+        def op_get_local(index):
+            push(stack[frames[-1].base + code[index]])
+            return index + 1
+
+        # Tee Local
+        def op_tee_local(index):
+            stack[frames[-1].base + code[index]] = stack[-1]
+            return index + 1
+
+        # Increment Local
+        def op_increment_local(index):
+
+            # Type checking
+            slot = frames[-1].base + code[index]
+            b    = constants[code[index + 1]]
+            a    = stack[slot]
+
+            if (type(a) != type(b) or type(a) != float):
+                a = add_values(interpreter, index, a, b, "Operands must be the same type.")
+                if (a is None): return -1
+
+                stack[slot] = a
+                return index + 2
+
+            stack[slot] = a + b
+            return index + 2
+
+    # Unknown opcode
+    def op_unknown(index):
+        return runtime_error_at(interpreter, index, "Unknown opcode '{0}'.".format(code[index - 1]))
+
+    # Build the table, indexed directly by opcode number
+    handlers = [op_unknown] * OP_COUNT
+
+    handlers[OP_CONSTANT]      = op_constant
+    handlers[OP_TRUE]          = op_true
+    handlers[OP_FALSE]         = op_false
+    handlers[OP_NULL]          = op_null
+    handlers[OP_ADD]           = op_add
+    handlers[OP_SUB]           = op_sub
+    handlers[OP_MUL]           = op_mul
+    handlers[OP_DIV]           = op_div
+    handlers[OP_NEGATE]        = op_negate
+    handlers[OP_NOT]           = op_not
+    handlers[OP_NOT_EQUAL]     = op_not_equal
+    handlers[OP_LESS]          = op_less
+    handlers[OP_LESS_THAN]     = op_less_than
+    handlers[OP_GREATER]       = op_greater
+    handlers[OP_GREATER_THAN]  = op_greater_than
+    handlers[OP_EQUALS]        = op_equals
+    handlers[OP_AND]           = op_and
+    handlers[OP_OR]            = op_or
+    handlers[OP_JUMP_IF_FALSE] = op_jump_if_false
+    handlers[OP_JUMP]          = op_jump
+    handlers[OP_JUMP_IF_TRUE]  = op_jump_if_true
+    handlers[OP_LOOP]          = op_loop
+    handlers[OP_LOOP_LONG]     = op_loop_long
+    handlers[OP_JUMP_LONG]     = op_jump_long
+    handlers[OP_JUMP_IF_FALSE_LONG] = op_jump_if_false_long
+
+    # Short-circuit
+    handlers[OP_JUMP_IF_FALSE_OR_POP] = op_jump_if_false_or_pop
+    handlers[OP_JUMP_IF_TRUE_OR_POP]  = op_jump_if_true_or_pop
+
+    handlers[OP_JUMP_IF_FALSE_OR_POP_LONG] = op_jump_if_false_or_pop_long
+    handlers[OP_JUMP_IF_TRUE_OR_POP_LONG]  = op_jump_if_true_or_pop_long
+    handlers[OP_CHECK_BOOL]           = op_check_bool
+    handlers[OP_POP]           = op_pop
+    handlers[OP_SET_GLOBAL]    = op_set_global
+    handlers[OP_GET_GLOBAL]    = op_get_global
+    handlers[OP_SET_GLOBAL_NAME] = op_set_global_name
+    handlers[OP_GET_GLOBAL_NAME] = op_get_global_name
+    handlers[OP_SET_LOCAL]     = op_set_local
+    handlers[OP_GET_LOCAL]     = op_get_local
+    handlers[OP_TEE_GLOBAL]    = op_tee_global
+    handlers[OP_TEE_LOCAL]     = op_tee_local
+    handlers[OP_PRINT]         = op_print
+    handlers[OP_EXIT]          = op_exit
+    handlers[OP_CALL]          = op_call
+    handlers[OP_ARRAY]         = op_array
+    handlers[OP_ARRAY_EXTEND]  = op_array_extend
+    handlers[OP_INDEX]         = op_index
+    handlers[OP_RETURN]        = op_return
+
+    # Superinstructions
+    handlers[OP_ADD_CONSTANT]      = op_add_constant
+    handlers[OP_INCREMENT_GLOBAL]  = op_increment_global
+    handlers[OP_INCREMENT_LOCAL]   = op_increment_local
+    handlers[OP_POP_JUMP_IF_FALSE] = op_pop_jump_if_false
+    handlers[OP_POP_JUMP_IF_TRUE]  = op_pop_jump_if_true
+
+    # Specialized opcodes
+    handlers[OP_ADD_NUM]       = op_add_num
+    handlers[OP_ADD_STR]       = op_add_str
+    handlers[OP_EQUALS_NUM]    = make_specialized_compare(operator.eq, float, OP_EQUALS,    op_equals)
+    handlers[OP_EQUALS_STR]    = make_specialized_compare(operator.eq, str,   OP_EQUALS,    op_equals)
+    handlers[OP_NOT_EQUAL_NUM] = make_specialized_compare(operator.ne, float, OP_NOT_EQUAL, op_not_equal)
+    handlers[OP_NOT_EQUAL_STR] = make_specialized_compare(operator.ne, str,   OP_NOT_EQUAL, op_not_equal)
+
+    numbers = (float,)
+    values  = (float, str, bool)
+
+    number_message = "Operands must be two numbers."
+    same_message   = "Operands must be the same type."
+    values_message = "Operands must be two numbers, two strings or two booleans."
+
+    handlers[OP_LESS_JUMP_IF_FALSE]         = make_compare_jump(operator.lt, numbers, number_message, number_message)
+    handlers[OP_LESS_THAN_JUMP_IF_FALSE]    = make_compare_jump(operator.le, numbers, number_message, number_message)
+    handlers[OP_GREATER_JUMP_IF_FALSE]      = make_compare_jump(operator.gt, numbers, number_message, number_message)
+    handlers[OP_GREATER_THAN_JUMP_IF_FALSE] = make_compare_jump(operator.ge, numbers, number_message, number_message)
+    handlers[OP_EQUALS_JUMP_IF_FALSE]       = make_compare_jump(operator.eq, values,  same_message,   values_message)
+    handlers[OP_NOT_EQUAL_JUMP_IF_FALSE]    = make_compare_jump(operator.ne, values,  same_message,   values_message)
+
+    return handlers
+
+# Key of the arguments in a memo, keyed like constants so 1.0 and true and
+# 0.0 and -0.0 differ, ropes are keyed by their text
+def memo_key(arguments):
+    return tuple(constant_key(rope_text(x) if (type(x) == Rope) else x) for x in arguments)
+
+# Call function, its frame starts at base, right where the caller pushed the
+# arguments, and the result takes the place of the function and arguments
+def call_function(interpreter, function, base):
+
+    stack = interpreter.stack
+
+    # Pure functions give the same result for the same arguments
+    memo = None
+
+    if (function.pure and interpreter.memo_size > 0):
+
+        memo = interpreter.memos.get(function)
+        key  = memo_key(stack[base:])
+
+        if (memo == None):
+            memo = interpreter.memos[function] = OrderedDict()
+
+        # Arrays can't be keys, calls with them always run
+        try:
+            hash(key)
+        except TypeError:
+            memo = None
+
+        # Seen these arguments before?
+        if (memo != None and key in memo):
+            memo.move_to_end(key)
+
+            del stack[base - 1:]
+            stack.append(memo[key])
+            return
+
+    # Handlers of the function, made on its first call
+    chunk = function.chunk
+    table = interpreter.calls.get(function)
+
+    if (table == None):
+        table = interpreter.calls[function] = make_handlers(interpreter, chunk.code, function)
+
+    # Room for the locals after the arguments
+    stack.extend([None] * (chunk.local_count - function.arity))
+    interpreter.frames.append(Frame(function, base))
+
+    code  = chunk.code
+    index = 0
+
+    # The frame goes even if Python raised, the loop that made the call
+    # writes the buffered output on its way out
+    try:
+        if (interpreter.dispatch != None):
+            interpreter.dispatch(table, code, index)
+        else:
+            while (index >= 0):
+                index = table[code[index]](index + 1)
+
+    finally:
+        interpreter.frames.pop()
+
+    if (interpreter.had_error): return
+
+    result = stack[-1]
+
+    del stack[base - 1:]
+    stack.append(result)
+
+    # Remember the result, forgetting the least recently used one if full
+    if (memo != None):
+        memo[key] = result
+
+        if (len(memo) > interpreter.memo_size): memo.popitem(last = False)
+
+# Interpret bytecode
+def interpret(interpreter):
+
+    # Cache the hot attributes in locals for the whole loop
+    code     = chunk_view(interpreter.chunk)
+    handlers = make_handlers(interpreter, code)
+    index    = interpreter.index
+
+    # Start interpreting, every opcode indexes the handler table directly
+    try:
+        while (index >= 0):
+            index = handlers[code[index]](index + 1)
+
+    # Even if Python raised, what was printed before it still shows up
+    finally:
+
+        # Release the view, so the chunk can grow again
+        code.release()
+
+        # Write whatever is still buffered
+        output_flush(interpreter.output)
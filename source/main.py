@@ -1,41 +1,208 @@
-from compiler import compile
-from coloring import success
-from pathlib  import Path
+from cache       import compile_file
+from scanner     import open_source
+from interpreter import Interpreter, interpreter_init, interpret, MEMO_SIZE
+from closure     import interpret_closures
+from profiler    import interpret_profile, profile_table, profile_json
+from batch       import RunOptions, find_scripts, scripts_root, run_batch, batch_report
+from repl        import Session, session_run, INPUT_INCOMPLETE
+from output      import Output
+from coloring    import success
+from utils       import ensure_recursion_limit
+from pathlib     import Path
 
+import os
 import sys
+import time
 
-# Get command line arguments
-if (len(sys.argv) == 1): # REPL
-    
-    # Get code input
-    code = ""
-    done = False
-    line = 1
+# Recursion limit the command line runs with, the compiler nests a few Python
+# frames per level of nesting, so the default limit only allows shallow code
+RECURSION_LIMIT = 10000
 
-    while (not done):
+# Get command line options and arguments
+options   = [x for x in sys.argv[1:] if (x.startswith("--"))]
+arguments = [x for x in sys.argv[1:] if (not x.startswith("--"))]
 
-        x = input("{0}. ".format(line))
-        if (x == "\\0"):
-            done = True
+# Get option value, like --name=value
+def get_option(name):
+
+    for option in options:
+        if (option == name):                return ""
+        if (option.startswith(name + "=")): return option[len(name) + 1:]
+
+    return None
+
+# Get the run options, returns None if they are wrong
+def get_run_options():
+
+    buffer_size = get_option("--buffer-size")
+    memoize     = get_option("--memoize")
+    backend     = get_option("--backend")
+
+    if (backend != None and backend not in ("vm", "closure")):
+        print("Unknown backend: '{0}', expected vm or closure.".format(backend))
+        return None
+
+    options = RunOptions()
+
+    # 0 writes every print straight away
+    if (buffer_size):
+        options.buffer_size = int(buffer_size)
+
+    # Remember the results of pure functions, up to N per function
+    if (memoize != None):
+        options.memo_size = int(memoize) if (memoize) else MEMO_SIZE
+
+    if (backend != None):
+        options.backend = backend
+
+    return options
+
+# Run chunk, profiled if asked for
+def run_chunk(chunk):
+
+    profile      = get_option("--profile") != None
+    profile_path = get_option("--profile-json")
+    options      = get_run_options()
+
+    if (options == None): return
+
+    # The profiler times the opcodes of the dispatch loop, closures have none
+    if ((profile or profile_path != None) and options.backend == "closure"):
+        print("--profile and --profile-json only work with --backend=vm.")
+        return
+
+    interpreter = Interpreter()
+    interpreter_init(interpreter, chunk)
+
+    if (options.buffer_size != None):
+        interpreter.output = Output(None, options.buffer_size)
+
+    interpreter.memo_size = options.memo_size
+
+    # No profiling, closures compiled from the bytecode or the dispatch loop
+    if (not profile and profile_path == None):
+        if (options.backend == "closure"):
+            interpret_closures(interpreter)
+        else:
+            interpret(interpreter)
+
+        return
+
+    result = interpret_profile(interpreter)
+
+    # Table goes to stderr, so it doesn't mix with the script output
+    if (profile):
+        print(profile_table(result), file = sys.stderr)
+
+    if (profile_path != None):
+        with open(profile_path, "w") as f:
+            f.write(profile_json(result))
+
+# Run many scripts in parallel, returns if all of them succeeded
+def run_scripts(path):
+
+    workers    = get_option("--workers")
+    chunk_size = get_option("--chunk-size")
+    output     = get_option("--output")
+    options    = get_run_options()
+
+    if (options == None): return False
+
+    file_names = find_scripts(path)
+
+    if (len(file_names) == 0):
+        print("No scripts found: '{0}'.".format(path))
+        return False
+
+    start   = time.perf_counter()
+    results = run_batch(file_names, int(workers) if (workers) else None, int(chunk_size) if (chunk_size) else 1, options)
+    elapsed = time.perf_counter() - start
+
+    root = scripts_root(path, file_names)
+
+    for result in results:
+
+        # Write each output to its own file, at the script's path under the
+        # batch root, or print them one after another
+        if (output):
+            output_path = os.path.join(output, os.path.splitext(os.path.relpath(result.file_name, root))[0] + ".out")
+
+            os.makedirs(os.path.dirname(output_path), exist_ok = True)
+
+            with open(output_path, "w") as f:
+                f.write(result.output)
         else:
+            print("==> {0} <==".format(result.file_name))
+            print(result.output, end = "")
+
+    # Report goes to stderr, so it doesn't mix with the script output
+    print(batch_report(results, elapsed), file = sys.stderr)
+
+    return all(result.error == None for result in results)
+
+# Main
+def main():
+
+    # Deep code needs more Python stack than the default limit gives
+    ensure_recursion_limit(RECURSION_LIMIT)
+
+    # Get command line arguments
+    if (get_option("--batch") != None and len(arguments) == 1): # Run many files
+
+        if (not run_scripts(arguments[0])):
+            sys.exit(1)
+    elif (len(arguments) == 0): # REPL
+
+        # Every input is compiled and run as soon as it is complete, the
+        # variables stay alive for the next ones
+        session = Session()
+
+        code = ""
+        line = 1
+
+        while (True):
+
+            # Get code input, until '\0' or the end of input
+            try:
+                x = input("{0}. ".format(line))
+            except EOFError:
+                break
+
+            if (x == "\\0"): break
+
             code += x + "\n"
             line += 1
 
-    # Compile
-    compile(code)
-elif (len(sys.argv) == 2): # Run file
+            # Compile and run, or wait for the rest of the statement
+            if (session_run(session, code) != INPUT_INCOMPLETE):
+                code = ""
+    elif (len(arguments) == 1): # Run file
+
+        # Get file name
+        file_name = arguments[0]
+
+        # Map file, the scanner reads tokens straight from it
+        try:
+            code = open_source(file_name)
+        except OSError:
+            code = None
+            print("Failed to read file: '{0}'.".format(file_name))
+
+        if (code != None):
+
+            # Compile, or load the cached bytecode
+            chunk = compile_file(file_name, code)
 
-    # Get file name
-    file_name = sys.argv[1]
+            # Done with the source
+            if (type(code) != bytes): code.close()
 
-    # Read file
-    try:
-        f    = open(file_name, "r")
-        code = f.read()
+            # Run
+            if (chunk != None):
+                run_chunk(chunk)
+    else:
+        print("Usage:\n\n\t- python main.py\n\t- python main.py file.pr [--buffer-size=N] [--memoize[=N]] [--backend=vm|closure] [--profile] [--profile-json=file.json]"
+              "\n\t- python main.py --batch directory|glob [--workers=N] [--chunk-size=N] [--output=directory] [--buffer-size=N] [--memoize[=N]] [--backend=vm|closure]")
 
-        # Compile
-        compile(code)
-    except FileNotFoundError:
-        print("Failed to read file: '{0}'.".format(file_name))
-else:
-    print("Usage:\n\n\t- python main.py\n\t- python main.py file.pr")
\ No newline at end of file
+# Worker processes may import this module too, only the main process runs it
+if (__name__ == "__main__"):
+    main()
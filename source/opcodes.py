@@ -27,4 +27,156 @@ OP_GET_GLOBAL      = 24
 OP_SET_LOCAL       = 25
 OP_GET_LOCAL       = 26
 OP_LOOP            = 27
-OP_EXIT            = 28
\ No newline at end of file
+OP_EXIT            = 28
+OP_SET_GLOBAL_NAME = 29
+OP_GET_GLOBAL_NAME = 30
+OP_TEE_GLOBAL      = 31
+OP_TEE_LOCAL       = 32
+OP_JUMP_IF_TRUE    = 33
+
+# Superinstructions, fused from common opcode sequences
+OP_ADD_CONSTANT               = 34 # CONSTANT k; ADD
+OP_INCREMENT_GLOBAL           = 35 # GET_GLOBAL x; CONSTANT k; ADD; SET_GLOBAL x
+OP_INCREMENT_LOCAL            = 36 # GET_LOCAL x; CONSTANT k; ADD; SET_LOCAL x
+OP_POP_JUMP_IF_FALSE          = 37 # JUMP_IF_FALSE; POP, and the POP at the target
+OP_POP_JUMP_IF_TRUE           = 38 # JUMP_IF_TRUE; POP, and the POP at the target
+OP_LESS_JUMP_IF_FALSE         = 39 # LESS; POP_JUMP_IF_FALSE
+OP_LESS_THAN_JUMP_IF_FALSE    = 40 # LESS_THAN; POP_JUMP_IF_FALSE
+OP_GREATER_JUMP_IF_FALSE      = 41 # GREATER; POP_JUMP_IF_FALSE
+OP_GREATER_THAN_JUMP_IF_FALSE = 42 # GREATER_THAN; POP_JUMP_IF_FALSE
+OP_EQUALS_JUMP_IF_FALSE       = 43 # EQUALS; POP_JUMP_IF_FALSE
+OP_NOT_EQUAL_JUMP_IF_FALSE    = 44 # NOT_EQUAL; POP_JUMP_IF_FALSE
+
+# Specialized opcodes, the interpreter rewrites generic opcodes into these once
+# it has seen their operand types, they go back to the generic opcode when
+# their type guard fails
+OP_ADD_NUM       = 45 # ADD, two numbers
+OP_ADD_STR       = 46 # ADD, two strings
+OP_EQUALS_NUM    = 47 # EQUALS, two numbers
+OP_EQUALS_STR    = 48 # EQUALS, two strings
+OP_NOT_EQUAL_NUM = 49 # NOT_EQUAL, two numbers
+OP_NOT_EQUAL_STR = 50 # NOT_EQUAL, two strings
+
+# Jumps with a 32-bit offset, high cell first, for code too long for the
+# one cell offset
+OP_LOOP_LONG          = 51
+OP_JUMP_LONG          = 52
+OP_JUMP_IF_FALSE_LONG = 53
+
+# Short-circuit opcodes, for && and ||
+OP_JUMP_IF_FALSE_OR_POP = 54 # Keeps a false and jumps, or pops
+OP_JUMP_IF_TRUE_OR_POP  = 55 # Keeps a true and jumps, or pops
+OP_CHECK_BOOL           = 56 # Right operand must be a boolean too
+
+# Function opcodes
+OP_CALL = 57 # Calls the function below its arguments
+
+# Array opcodes
+OP_ARRAY = 58 # Makes an array out of the numbers on top of the stack
+OP_INDEX = 59 # Gets an element of an array
+
+OP_ARRAY_EXTEND = 60 # Adds the numbers on top of the stack to the array below them
+
+# Short-circuit opcodes with a 32-bit offset, for a right operand too long for
+# the one cell offset
+OP_JUMP_IF_FALSE_OR_POP_LONG = 61
+OP_JUMP_IF_TRUE_OR_POP_LONG  = 62
+
+# Number of opcodes
+OP_COUNT = 63
+
+# Number of operand cells after each opcode, if any
+OPERAND_COUNTS = {
+    OP_CONSTANT:        1, OP_JUMP_IF_FALSE:   1, OP_JUMP:            1,
+    OP_SET_GLOBAL:      1, OP_GET_GLOBAL:      1, OP_SET_LOCAL:       1,
+    OP_GET_LOCAL:       1, OP_LOOP:            1, OP_SET_GLOBAL_NAME: 1,
+    OP_GET_GLOBAL_NAME: 1, OP_TEE_GLOBAL:      1, OP_TEE_LOCAL:       1,
+    OP_JUMP_IF_TRUE:    1, OP_ADD_CONSTANT:    1,
+
+    OP_INCREMENT_GLOBAL: 2, OP_INCREMENT_LOCAL: 2,
+
+    OP_LOOP_LONG: 2, OP_JUMP_LONG: 2, OP_JUMP_IF_FALSE_LONG: 2,
+
+    OP_JUMP_IF_FALSE_OR_POP: 1, OP_JUMP_IF_TRUE_OR_POP: 1,
+
+    OP_JUMP_IF_FALSE_OR_POP_LONG: 2, OP_JUMP_IF_TRUE_OR_POP_LONG: 2,
+
+    OP_CALL: 1, OP_ARRAY: 1, OP_ARRAY_EXTEND: 1,
+
+    OP_POP_JUMP_IF_FALSE:          1, OP_POP_JUMP_IF_TRUE:           1,
+    OP_LESS_JUMP_IF_FALSE:         1, OP_LESS_THAN_JUMP_IF_FALSE:    1,
+    OP_GREATER_JUMP_IF_FALSE:      1, OP_GREATER_THAN_JUMP_IF_FALSE: 1,
+    OP_EQUALS_JUMP_IF_FALSE:       1, OP_NOT_EQUAL_JUMP_IF_FALSE:    1
+}
+
+# Net stack effect of each opcode, when it doesn't jump
+STACK_EFFECTS = {
+    OP_CONSTANT:  1, OP_TRUE:  1, OP_FALSE: 1, OP_NULL: 1,
+    OP_GET_GLOBAL: 1, OP_GET_LOCAL: 1, OP_GET_GLOBAL_NAME: 1,
+
+    OP_PRINT: -1, OP_POP: -1, OP_SET_GLOBAL: -1, OP_SET_LOCAL: -1, OP_SET_GLOBAL_NAME: -1,
+    OP_ADD:   -1, OP_SUB: -1, OP_MUL: -1, OP_DIV: -1,
+    OP_NOT_EQUAL: -1, OP_GREATER: -1, OP_GREATER_THAN: -1, OP_LESS: -1,
+    OP_LESS_THAN: -1, OP_EQUALS:  -1, OP_AND: -1, OP_OR: -1,
+
+    OP_POP_JUMP_IF_FALSE: -1, OP_POP_JUMP_IF_TRUE: -1,
+
+    OP_LESS_JUMP_IF_FALSE:    -2, OP_LESS_THAN_JUMP_IF_FALSE:    -2,
+    OP_GREATER_JUMP_IF_FALSE: -2, OP_GREATER_THAN_JUMP_IF_FALSE: -2,
+    OP_EQUALS_JUMP_IF_FALSE:  -2, OP_NOT_EQUAL_JUMP_IF_FALSE:    -2,
+
+    OP_ADD_NUM:       -1, OP_ADD_STR:       -1,
+    OP_EQUALS_NUM:    -1, OP_EQUALS_STR:    -1,
+    OP_NOT_EQUAL_NUM: -1, OP_NOT_EQUAL_STR: -1,
+
+    OP_JUMP_IF_FALSE_OR_POP:      -1, OP_JUMP_IF_TRUE_OR_POP:      -1,
+    OP_JUMP_IF_FALSE_OR_POP_LONG: -1, OP_JUMP_IF_TRUE_OR_POP_LONG: -1,
+
+    OP_ARRAY: 1, OP_INDEX: -1
+}
+
+# Net stack effect of the jumps that leave the stack different when they jump
+JUMP_STACK_EFFECTS = {
+    OP_JUMP_IF_FALSE_OR_POP:      0, OP_JUMP_IF_TRUE_OR_POP:      0,
+    OP_JUMP_IF_FALSE_OR_POP_LONG: 0, OP_JUMP_IF_TRUE_OR_POP_LONG: 0
+}
+
+# Opcodes that always leave a boolean on the stack, comparisons leave an
+# array when comparing arrays
+BOOLEAN_OPCODES = [OP_TRUE, OP_FALSE, OP_NOT, OP_AND, OP_OR, OP_CHECK_BOOL]
+
+# Opcodes that reach outside of a function, a function without them only
+# depends on its arguments
+IMPURE_OPCODES = [
+    OP_GET_GLOBAL, OP_SET_GLOBAL, OP_TEE_GLOBAL, OP_GET_GLOBAL_NAME,
+    OP_SET_GLOBAL_NAME, OP_INCREMENT_GLOBAL, OP_PRINT, OP_CALL
+]
+
+# Opcodes whose operand is a forward jump offset
+JUMP_OPCODES = [
+    OP_JUMP_IF_FALSE, OP_JUMP, OP_JUMP_IF_TRUE, OP_POP_JUMP_IF_FALSE,
+    OP_POP_JUMP_IF_TRUE, OP_LESS_JUMP_IF_FALSE, OP_LESS_THAN_JUMP_IF_FALSE,
+    OP_GREATER_JUMP_IF_FALSE, OP_GREATER_THAN_JUMP_IF_FALSE,
+    OP_EQUALS_JUMP_IF_FALSE, OP_NOT_EQUAL_JUMP_IF_FALSE, OP_JUMP_LONG,
+    OP_JUMP_IF_FALSE_LONG, OP_JUMP_IF_FALSE_OR_POP, OP_JUMP_IF_TRUE_OR_POP,
+    OP_JUMP_IF_FALSE_OR_POP_LONG, OP_JUMP_IF_TRUE_OR_POP_LONG
+]
+
+# Opcodes whose operand is a backward jump offset
+LOOP_OPCODES = [OP_LOOP, OP_LOOP_LONG]
+
+# Jumps that never fall through to the next instruction
+UNCONDITIONAL_OPCODES = [OP_JUMP, OP_LOOP, OP_JUMP_LONG, OP_LOOP_LONG]
+
+# Long form of each jump
+LONG_OPCODES = {
+    OP_LOOP:          OP_LOOP_LONG,
+    OP_JUMP:          OP_JUMP_LONG,
+    OP_JUMP_IF_FALSE: OP_JUMP_IF_FALSE_LONG,
+
+    OP_JUMP_IF_FALSE_OR_POP: OP_JUMP_IF_FALSE_OR_POP_LONG,
+    OP_JUMP_IF_TRUE_OR_POP:  OP_JUMP_IF_TRUE_OR_POP_LONG
+}
+
+# Opcode names, by opcode
+OPCODE_NAMES = {value: name for name, value in list(globals().items()) if (name.startswith("OP_") and name != "OP_COUNT")}
\ No newline at end of file
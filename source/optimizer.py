@@ -0,0 +1,395 @@
+from array   import array
+from opcodes import *
+from chunk   import CODE_MAX
+
+# Instruction
+class Instruction():
+
+    # Initialize
+    def __init__(self, opcode, operands, line, column):
+
+        self.opcode   = opcode
+        self.operands = operands
+        self.line     = line
+        self.column   = column
+
+        # Jump target, for jumps and loops
+        self.target = None
+
+        # Removed instructions forward to the instruction that replaced them
+        self.removed     = False
+        self.replacement = None
+
+        # Offset in the encoded code
+        self.offset = 0
+
+# Get instruction size in cells
+def instruction_size(opcode):
+    return 1 + OPERAND_COUNTS.get(opcode, 0)
+
+# Get the jump offset of the instruction at index
+def jump_offset(code, index):
+
+    if (code[index] in LONG_OPCODES.values()):
+        return (code[index + 1] << 16) | code[index + 2]
+
+    return code[index + 1]
+
+# Check that a jump with no long form stays in reach of target once encoded,
+# encode() may widen every jump in between by a cell, at most half of what
+# they take up, the offsets are the decoded ones
+def in_reach(instruction, target):
+    return abs(target.offset - instruction.offset) * 3 // 2 + 2 <= CODE_MAX
+
+# Get live instruction
+def live(instruction):
+
+    # Follow removed instructions to the one that took their place
+    while (instruction.removed):
+        instruction = instruction.replacement
+
+    return instruction
+
+# Remove instruction
+def remove(instruction, replacement):
+
+    instruction.removed     = True
+    instruction.replacement = replacement
+
+# Decode chunk into instructions
+def decode(chunk):
+
+    code         = chunk.code
+    instructions = []
+    offsets      = {}
+
+    # Read every instruction
+    index = 0
+
+    while (index < chunk.count):
+
+        opcode = code[index]
+        size   = instruction_size(opcode)
+
+        instruction = Instruction(opcode, list(code[index + 1 : index + size]), chunk.lines[index], chunk.columns[index])
+        instruction.offset = index
+
+        offsets[index] = instruction
+        instructions.append(instruction)
+
+        index += size
+
+    # Resolve jump targets, jumps only have the offset as operand
+    for instruction in instructions:
+
+        end = instruction.offset + instruction_size(instruction.opcode)
+
+        if (instruction.opcode in JUMP_OPCODES):
+            instruction.target = offsets[end + jump_offset(code, instruction.offset)]
+        elif (instruction.opcode in LOOP_OPCODES):
+            instruction.target = offsets[end - jump_offset(code, instruction.offset)]
+
+    return instructions
+
+# Encode instructions into chunk
+def encode(chunk, instructions):
+
+    # Pick the direction of every unconditional jump, and the long form for
+    # jumps too far away, until the offsets stop moving
+    changed = True
+
+    while (changed):
+
+        # Assign the new offsets
+        offset = 0
+
+        for instruction in instructions:
+            instruction.offset = offset
+            offset += instruction_size(instruction.opcode)
+
+        changed = False
+
+        for instruction in instructions:
+
+            if (instruction.target == None): continue
+
+            target = live(instruction.target).offset
+            opcode = instruction.opcode
+
+            # An unconditional jump may have been threaded backwards
+            if (opcode in UNCONDITIONAL_OPCODES):
+                long = opcode in [OP_JUMP_LONG, OP_LOOP_LONG]
+
+                if (target > instruction.offset):
+                    opcode = OP_JUMP_LONG if (long) else OP_JUMP
+                else:
+                    opcode = OP_LOOP_LONG if (long) else OP_LOOP
+
+            # Too far for one cell? The distance is worked out from the short
+            # form, long forms stay long
+            end = instruction.offset + 2
+
+            if (opcode in LONG_OPCODES and max(target - end, end - target) > CODE_MAX):
+                opcode = LONG_OPCODES[opcode]
+
+            if (opcode != instruction.opcode):
+                instruction.opcode = opcode
+                changed = True
+
+    code    = array("H")
+    lines   = array("I")
+    columns = array("I")
+
+    # Write every instruction, recomputing the jump offsets
+    for instruction in instructions:
+
+        opcode   = instruction.opcode
+        operands = instruction.operands
+
+        if (instruction.target != None):
+
+            target = live(instruction.target).offset
+            end    = instruction.offset + instruction_size(opcode)
+
+            distance = (end - target) if (opcode in LOOP_OPCODES) else (target - end)
+
+            if (opcode in LONG_OPCODES.values()):
+                operands = [distance >> 16, distance & CODE_MAX]
+            else:
+                operands = [distance]
+
+        code.append(opcode)
+        code.extend(operands)
+
+        lines.extend([instruction.line] * (1 + len(operands)))
+        columns.extend([instruction.column] * (1 + len(operands)))
+
+    chunk.code    = code
+    chunk.lines   = lines
+    chunk.columns = columns
+
+# Get jump targets
+def jump_targets(instructions):
+
+    targets = set()
+
+    for instruction in instructions:
+        if (instruction.target != None):
+            targets.add(id(live(instruction.target)))
+
+    return targets
+
+# Run one pass over the instructions, returns the new list and if it changed
+def peephole_pass(instructions):
+
+    targets = jump_targets(instructions)
+    order   = {id(instruction): i for i, instruction in enumerate(instructions)}
+    changed = False
+
+    for i in range(len(instructions)):
+
+        instruction = instructions[i]
+        if (instruction.removed): continue
+
+        # Next instructions, if any
+        following = [x for x in instructions[i + 1 : i + 3] if (not x.removed)]
+        after     = following[0] if (len(following) > 0) else None
+
+        # SET x; GET x -> TEE x, the value stays on the stack
+        if (after != None and id(after) not in targets and after.operands == instruction.operands and
+            (instruction.opcode, after.opcode) in [(OP_SET_GLOBAL, OP_GET_GLOBAL), (OP_SET_LOCAL, OP_GET_LOCAL)]):
+
+            instruction.opcode = OP_TEE_GLOBAL if (instruction.opcode == OP_SET_GLOBAL) else OP_TEE_LOCAL
+            remove(after, instruction)
+
+            changed = True
+            continue
+
+        # TEE x; POP -> SET x
+        if (after != None and id(after) not in targets and after.opcode == OP_POP and
+            instruction.opcode in [OP_TEE_GLOBAL, OP_TEE_LOCAL]):
+
+            instruction.opcode = OP_SET_GLOBAL if (instruction.opcode == OP_TEE_GLOBAL) else OP_SET_LOCAL
+            remove(after, instruction)
+
+            changed = True
+            continue
+
+        # NOT; JUMP_IF_FALSE -> JUMP_IF_TRUE, when both paths just pop the condition
+        if (instruction.opcode == OP_NOT and len(following) == 2 and
+            after.opcode == OP_JUMP_IF_FALSE and id(after) not in targets and
+            following[1].opcode == OP_POP and live(after.target).opcode == OP_POP and
+            in_reach(instruction, live(after.target))):
+
+            instruction.opcode   = OP_JUMP_IF_TRUE
+            instruction.operands = [0]
+            instruction.target   = after.target
+            remove(after, instruction)
+
+            changed = True
+            continue
+
+        # Jump to a jump -> jump straight to the final target
+        if (instruction.target != None):
+
+            target = live(instruction.target)
+
+            if (target.opcode in UNCONDITIONAL_OPCODES and target is not instruction):
+
+                final = live(target.target)
+
+                # Conditional jumps can only go forwards, and must stay in
+                # reach of their one cell offset
+                if (instruction.opcode in UNCONDITIONAL_OPCODES or
+                    (order[id(final)] > i and in_reach(instruction, final))):
+                    if (final is not target):
+                        instruction.target = final
+                        changed = True
+
+        # Jump to the next instruction -> nothing
+        if (instruction.opcode in [OP_JUMP, OP_JUMP_LONG] and after != None and live(instruction.target) is after):
+
+            remove(instruction, after)
+
+            changed = True
+            continue
+
+    return ([x for x in instructions if (not x.removed)], changed)
+
+# Fused compare and jump opcodes, by compare opcode
+COMPARE_JUMPS = {
+    OP_LESS:         OP_LESS_JUMP_IF_FALSE,
+    OP_LESS_THAN:    OP_LESS_THAN_JUMP_IF_FALSE,
+    OP_GREATER:      OP_GREATER_JUMP_IF_FALSE,
+    OP_GREATER_THAN: OP_GREATER_THAN_JUMP_IF_FALSE,
+    OP_EQUALS:       OP_EQUALS_JUMP_IF_FALSE,
+    OP_NOT_EQUAL:    OP_NOT_EQUAL_JUMP_IF_FALSE
+}
+
+# Fuse one sequence of instructions into a superinstruction, returns the new
+# list and if it changed
+def fuse_pass(instructions):
+
+    targets = jump_targets(instructions)
+    order   = {id(instruction): i for i, instruction in enumerate(instructions)}
+    changed = False
+
+    # Number of jumps to each instruction
+    counts = {}
+
+    for instruction in instructions:
+        if (instruction.target != None):
+            counts[id(live(instruction.target))] = counts.get(id(live(instruction.target)), 0) + 1
+
+    for i in range(len(instructions)):
+
+        instruction = instructions[i]
+        if (instruction.removed): continue
+
+        # Next instructions, none of them may be a jump target
+        following = []
+
+        for x in instructions[i + 1 : i + 4]:
+            if (x.removed or id(x) in targets): break
+            following.append(x)
+
+        opcodes = [instruction.opcode] + [x.opcode for x in following]
+
+        # GET x; CONSTANT k; ADD; SET x -> INCREMENT x k
+        for get, set, increment in [(OP_GET_GLOBAL, OP_SET_GLOBAL, OP_INCREMENT_GLOBAL), (OP_GET_LOCAL, OP_SET_LOCAL, OP_INCREMENT_LOCAL)]:
+
+            if (opcodes[:4] == [get, OP_CONSTANT, OP_ADD, set] and following[2].operands == instruction.operands):
+
+                # Runtime errors come from the ADD
+                instruction.opcode   = increment
+                instruction.operands = instruction.operands + following[0].operands
+                instruction.line     = following[1].line
+                instruction.column   = following[1].column
+
+                for x in following:
+                    remove(x, instruction)
+
+                changed = True
+                break
+
+        if (instruction.opcode in [OP_INCREMENT_GLOBAL, OP_INCREMENT_LOCAL]): continue
+
+        # CONSTANT k; ADD -> ADD_CONSTANT k
+        if (opcodes[:2] == [OP_CONSTANT, OP_ADD]):
+
+            instruction.opcode = OP_ADD_CONSTANT
+            instruction.line   = following[0].line
+            instruction.column = following[0].column
+
+            remove(following[0], instruction)
+
+            changed = True
+            continue
+
+        # JUMP_IF_FALSE; POP, with a POP at the target that is only reached
+        # by this jump -> POP_JUMP_IF_FALSE past that POP
+        if (instruction.opcode in [OP_JUMP_IF_FALSE, OP_JUMP_IF_TRUE] and opcodes[1:2] == [OP_POP]):
+
+            target = live(instruction.target)
+            index  = order[id(target)]
+
+            # Nothing may fall through into the target
+            before = index - 1
+            while (before >= 0 and instructions[before].removed): before -= 1
+
+            if (target.opcode == OP_POP and counts.get(id(target)) == 1 and
+                before >= 0 and instructions[before].opcode in UNCONDITIONAL_OPCODES + [OP_EXIT, OP_RETURN] and
+                in_reach(instruction, instructions[index + 1])):
+
+                after = instructions[index + 1]
+
+                instruction.opcode = OP_POP_JUMP_IF_FALSE if (instruction.opcode == OP_JUMP_IF_FALSE) else OP_POP_JUMP_IF_TRUE
+                instruction.target = after
+
+                counts[id(target)] = 0
+                counts[id(after)]  = counts.get(id(after), 0) + 1
+                targets.add(id(after))
+
+                remove(following[0], instruction)
+                remove(target, after)
+
+                changed = True
+                continue
+
+        # Compare; POP_JUMP_IF_FALSE -> Compare and jump
+        if (instruction.opcode in COMPARE_JUMPS and opcodes[1:2] == [OP_POP_JUMP_IF_FALSE] and
+            in_reach(instruction, live(following[0].target))):
+
+            instruction.opcode   = COMPARE_JUMPS[instruction.opcode]
+            instruction.operands = [0]
+            instruction.target   = following[0].target
+
+            remove(following[0], instruction)
+
+            changed = True
+            continue
+
+    return ([x for x in instructions if (not x.removed)], changed)
+
+# Peephole optimize chunk, then fuse superinstructions
+def peephole(chunk, fuse = True):
+
+    instructions = decode(chunk)
+
+    # Loop until no pattern matches anymore
+    changed = True
+
+    while (changed):
+        instructions, changed = peephole_pass(instructions)
+
+    # Superinstructions
+    changed = fuse
+
+    while (changed):
+        instructions, changed = fuse_pass(instructions)
+
+    encode(chunk, instructions)
+
+# Count instructions in chunk
+def count_instructions(chunk):
+    return len(decode(chunk))
\ No newline at end of file
@@ -0,0 +1,76 @@
+from function import Function
+from array    import array
+from rope     import Rope, rope_text
+
+import os
+import sys
+
+# Flush policies, as buffer sizes
+FLUSH_EVERY_PRINT = 0     # Write every print straight away
+FLUSH_AT_EXIT     = None  # Only write when the interpreter stops
+BUFFER_SIZE       = 65536 # Write once this many characters are waiting
+
+# Output sink, where OP_PRINT writes to
+class Output():
+
+    # Initialize
+    def __init__(self, target = None, buffer_size = BUFFER_SIZE):
+
+        # A file object, an in-memory one like io.StringIO for embedding, a
+        # file descriptor, or None for whatever sys.stdout is when flushing
+        self.target = target
+
+        # Text waiting to be written, and how much of it there is
+        self.parts = []
+        self.size  = 0
+        self.limit = float("inf") if (buffer_size == FLUSH_AT_EXIT) else buffer_size
+
+# Text of every kind of value, null, true and false print as keywords
+FORMATS = {
+    type(None): lambda a: "null\n",
+    bool:       lambda a: "true\n" if (a) else "false\n",
+    float:      lambda a: str(a) + "\n",
+    str:        lambda a: a + "\n",
+    Function:   lambda a: "<function {0}>\n".format(a.name),
+    array:      lambda a: "[" + ", ".join(map(str, a)) + "]\n",
+    Rope:       lambda a: rope_text(a) + "\n"
+}
+
+# Format a value the way print shows it
+def format_value(a):
+    return FORMATS.get(type(a), lambda a: str(a) + "\n")(a)
+
+# Write text, flushing once the buffer is full
+def output_write(output, text):
+
+    output.parts.append(text)
+    output.size += len(text)
+
+    if (output.size > output.limit): output_flush(output)
+
+# Write all the text waiting in the buffer
+def output_flush(output):
+
+    if (output.size == 0): return
+
+    text   = "".join(output.parts)
+    target = output.target
+
+    # Keep the same list, the interpreter handlers hold on to it
+    output.parts.clear()
+    output.size = 0
+
+    # File descriptor, write until all of it is out
+    if (type(target) == int):
+
+        data = text.encode()
+
+        while (len(data) > 0):
+            data = data[os.write(target, data):]
+
+        return
+
+    if (target == None): target = sys.stdout
+
+    target.write(text)
+    target.flush()
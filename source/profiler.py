@@ -0,0 +1,126 @@
+from opcodes     import *
+from chunk       import chunk_view
+from interpreter import Interpreter, interpreter_init, make_handlers
+from output      import output_flush
+
+import json
+import time
+
+# Interpret bytecode, counting every pair of consecutive opcodes
+def interpret_pairs(chunk):
+
+    interpreter = Interpreter()
+    interpreter_init(interpreter, chunk)
+
+    code     = chunk_view(chunk)
+    handlers = make_handlers(interpreter, code)
+
+    pairs    = {}
+    previous = [None]
+
+    # Same loop as interpret(), with the counting swapped in, calls run it
+    # too and pair the opcodes in the order they ran
+    def dispatch(handlers, code, index):
+
+        while (index >= 0):
+
+            opcode = code[index]
+
+            pair = (previous[0], opcode)
+            pairs[pair] = pairs.get(pair, 0) + 1
+
+            previous[0] = opcode
+            index       = handlers[opcode](index + 1)
+
+    interpreter.dispatch = dispatch
+
+    try:
+        dispatch(handlers, code, interpreter.index)
+
+    finally:
+        code.release()
+        output_flush(interpreter.output)
+
+    return pairs
+
+# Interpret bytecode, recording the count and the time of every opcode
+def interpret_profile(interpreter):
+
+    chunk    = interpreter.chunk
+    code     = chunk_view(chunk)
+    handlers = make_handlers(interpreter, code)
+    clock    = time.perf_counter_ns
+
+    counts = [0] * OP_COUNT
+    times  = [0] * OP_COUNT
+
+    # Time spent in the loops of calls so far, an OP_CALL only keeps the
+    # time the call itself took, the function body is timed by opcode
+    spent = [0]
+
+    # Same loop as interpret(), with the timing swapped in, calls run it too
+    def dispatch(handlers, code, index):
+
+        entered = clock()
+        base    = spent[0]
+
+        while (index >= 0):
+
+            opcode = code[index]
+            before = spent[0]
+            start  = clock()
+
+            index = handlers[opcode](index + 1)
+
+            times[opcode]  += clock() - start - (spent[0] - before)
+            counts[opcode] += 1
+
+        # The whole loop, calls it made included, counts once for its caller
+        spent[0] = base + clock() - entered
+
+    interpreter.dispatch = dispatch
+
+    try:
+        dispatch(handlers, code, interpreter.index)
+
+    finally:
+        code.release()
+        output_flush(interpreter.output)
+
+    # Only keep the opcodes that ran
+    profile = {}
+
+    for opcode in range(OP_COUNT):
+        if (counts[opcode] > 0):
+            profile[OPCODE_NAMES[opcode]] = {"count": counts[opcode], "time_ns": times[opcode]}
+
+    return profile
+
+# Sort profile by time, slowest first
+def sorted_profile(profile):
+    return sorted(profile.items(), key = lambda x: -x[1]["time_ns"])
+
+# Format profile as a table
+def profile_table(profile):
+
+    total_count = sum(x["count"] for x in profile.values())
+    total_time  = sum(x["time_ns"] for x in profile.values())
+
+    lines = ["{0:<32} {1:>10} {2:>12} {3:>10} {4:>7}".format("opcode", "count", "total ms", "avg ns", "time")]
+
+    for name, entry in sorted_profile(profile):
+        lines.append("{0:<32} {1:>10} {2:>12.3f} {3:>10.1f} {4:>6.1f}%".format(name, entry["count"],
+            entry["time_ns"] / 1e6, entry["time_ns"] / entry["count"], 100.0 * entry["time_ns"] / max(total_time, 1)))
+
+    lines.append("{0:<32} {1:>10} {2:>12.3f}".format("total", total_count, total_time / 1e6))
+
+    return "\n".join(lines)
+
+# Format profile as JSON
+def profile_json(profile):
+
+    return json.dumps({
+        "opcodes": [dict(name = name, **entry) for name, entry in sorted_profile(profile)],
+        "total_count":   sum(x["count"] for x in profile.values()),
+        "total_time_ns": sum(x["time_ns"] for x in profile.values())
+    }, indent = 4)
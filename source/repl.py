@@ -0,0 +1,80 @@
+from tokens      import TOKEN_END, TOKEN_ERROR
+from scanner     import UNTERMINATED_STRING
+from chunk       import chunk_truncate
+from compiler    import Compiler, compile_source
+from interpreter import Interpreter, interpreter_init, interpreter_grow, interpret
+
+# Session, the compiler and the interpreter live as long as the REPL does, so
+# every input only compiles and runs its own statements
+class Session():
+
+    # Initialize
+    def __init__(self):
+
+        self.compiler    = Compiler()
+        self.interpreter = Interpreter()
+
+        interpreter_init(self.interpreter, self.compiler.chunk)
+
+        # Line the next input starts at, errors count lines across inputs
+        self.line = 1
+
+# Input results
+INPUT_DONE       = 0 # Compiled and ran
+INPUT_INCOMPLETE = 1 # Ended in the middle of a statement, needs more lines
+INPUT_ERROR      = 2 # Failed to compile
+
+# Compile and run one input, appended to the session chunk
+def session_run(session, source):
+
+    compiler = session.compiler
+    chunk    = compiler.chunk
+
+    # Keep where the chunk was, so a failed input can be dropped
+    count           = chunk.count
+    constants_count = chunk.constants_count
+    globals_count   = len(chunk.global_names)
+
+    parser = compile_source(compiler, source, False, session.line)
+
+    # Every input starts and ends at the top level
+    compiler.scope_depth     = 0
+    compiler.local_variables = []
+    compiler.jumps           = {}
+
+    # Failed to compile, forget everything the input added
+    if (parser.had_error):
+
+        chunk_truncate(chunk, count, constants_count)
+
+        for name in chunk.global_names[globals_count:]:
+            del compiler.global_variables[name]
+
+        del chunk.global_names[globals_count:]
+
+        # Ran out of source, the statement or the string may go on in the
+        # next line
+        token = parser.error_token
+
+        if (token.kind == TOKEN_END or (token.kind == TOKEN_ERROR and token.content == UNTERMINATED_STRING)):
+            return INPUT_INCOMPLETE
+
+        session.line += source.count("\n")
+
+        print(parser.error_message)
+        return INPUT_ERROR
+
+    session.line += source.count("\n")
+
+    # Run the new code only, the earlier code ended at its own OP_EXIT
+    interpreter = session.interpreter
+
+    interpreter_grow(interpreter)
+
+    interpreter.index     = count
+    interpreter.had_error = False
+    interpreter.stack.clear()
+
+    interpret(interpreter)
+
+    return INPUT_DONE
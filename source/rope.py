@@ -0,0 +1,51 @@
+# Shortest text worth keeping as a rope, shorter text is just copied
+ROPE_MIN = 256
+
+# Rope, text built by concatenation, the pieces are only joined once the
+# text is needed
+class Rope():
+
+    __slots__ = ("parts", "count", "length", "text")
+
+    # Initialize
+    def __init__(self, parts, count, length):
+
+        # Pieces, shared with the ropes made by appending to this one, only
+        # the first count of them belong to this rope
+        self.parts  = parts
+        self.count  = count
+        self.length = length
+
+        # Joined text, once it was needed
+        self.text = None
+
+# Get the text of a string or a rope
+def rope_text(a):
+
+    if (type(a) == str): return a
+
+    if (a.text == None):
+        a.text = "".join(a.parts) if (len(a.parts) == a.count) else "".join(a.parts[:a.count])
+
+    return a.text
+
+# Concatenate strings or ropes, appending the right one to the pieces of the
+# left one, so building text piece by piece doesn't copy it every time
+def concat(a, b):
+
+    if (type(a) == str):
+
+        # Short text, copying it is cheaper
+        if (len(a) < ROPE_MIN): return a + rope_text(b)
+
+        parts, count, length = [a], 1, len(a)
+    else:
+        parts, count, length = a.parts, a.count, a.length
+
+        # Something else was appended to these pieces already, copy them
+        if (len(parts) != count): parts = parts[:count]
+
+    b = rope_text(b)
+    parts.append(b)
+
+    return Rope(parts, count + 1, length + len(b))
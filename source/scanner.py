@@ -1,19 +1,31 @@
 from tokens import *
 from utils  import is_digit, is_alpha
 
+import mmap
+import re
+
 # Scanner
 class Scanner():
 
-    source  = ""
-    length  = 0
+    # Initialize
+    def __init__(self):
 
-    start   = 0
-    current = 0
+        self.source = ""
+        self.length = 0
 
-    line   = 1
-    column = 1
+        self.start   = 0
+        self.current = 0
+
+        self.line   = 1
+        self.column = 1
 
-scanner = Scanner()
+        # Bulk mode token generator and the end token, once reached
+        self.bulk   = False
+        self.tokens = None
+        self.end    = None
+
+# Error of a string still open at the end of the source
+UNTERMINATED_STRING = "Unterminated string."
 
 # Keywords tokens
 keywords = {
@@ -31,33 +43,196 @@ keywords = {
     "var":      TOKEN_VAR
 }
 
+# Token pattern for the bulk tokenizer, spacing before a token is matched with
+# it, then one alternative per token class
+token_pattern_text = r"""
+    [ \r\t]*
+    (?:
+          (?P<identifier>[A-Za-z_][A-Za-z0-9_]*)
+        | (?P<operator>--|-=|\+\+|\+=|/=|\*=|%=|!=|==|<=|>=|&&|\|\||[(){}\[\];,.?:\-+/*%!=<>])
+        | (?P<newline>\n)
+        | (?P<number>[0-9]+(?:\.[0-9]+)?)
+        | (?P<string>"(?:[^"\\]|\\[\s\S])*")
+        | (?P<comment>\#[^\n]*)
+        | (?P<unterminated>"(?:[^"\\]|\\[\s\S])*\\?)
+        | (?P<error>[\s\S])
+        | $
+    )
+"""
+
+# Compiled for text and for bytes sources, like memory-mapped files
+token_pattern       = re.compile(token_pattern_text, re.VERBOSE)
+token_pattern_bytes = re.compile(token_pattern_text.encode("ascii"), re.VERBOSE)
+
+# UTF-8 continuation bytes, they don't start a character of their own
+continuation_pattern = re.compile(rb"[\x80-\xbf]")
+
+# Operator tokens
+operators = {
+    "(":  TOKEN_LEFT_PAREN,    ")":  TOKEN_RIGHT_PAREN,
+    "{":  TOKEN_LEFT_BRACE,    "}":  TOKEN_RIGHT_BRACE,
+    "[":  TOKEN_LEFT_BRACKET,  "]":  TOKEN_RIGHT_BRACKET,
+    ";":  TOKEN_SEMICOLON,     ",":  TOKEN_COMMA,
+    ".":  TOKEN_DOT,           "?":  TOKEN_QUESTION,
+    ":":  TOKEN_COLON,
+    "-":  TOKEN_MINUS,         "--": TOKEN_MINUS_MINUS,   "-=": TOKEN_MINUS_EQUAL,
+    "+":  TOKEN_PLUS,          "++": TOKEN_PLUS_PLUS,     "+=": TOKEN_PLUS_EQUAL,
+    "/":  TOKEN_SLASH,         "/=": TOKEN_SLASH_EQUAL,
+    "*":  TOKEN_STAR,          "*=": TOKEN_STAR_EQUAL,
+    "%":  TOKEN_PERCENT,       "%=": TOKEN_PERCENT_EQUAL,
+    "!":  TOKEN_BANG,          "!=": TOKEN_BANG_EQUAL,
+    "=":  TOKEN_EQUAL,         "==": TOKEN_EQUAL_EQUAL,
+    "<":  TOKEN_LESS,          "<=": TOKEN_LESS_EQUAL,
+    ">":  TOKEN_GREATER,       ">=": TOKEN_GREATER_EQUAL,
+    "&&": TOKEN_AND,           "||": TOKEN_OR
+}
+
+# Tokenize the source lazily, in one pass, line is where the source starts
+def tokenize(source, line = 1):
+
+    # Text or bytes source?
+    is_bytes = (type(source) != str)
+
+    pattern = token_pattern_bytes if (is_bytes) else token_pattern
+    newline = b"\n"  if (is_bytes) else "\n"
+
+    # Copy a small piece of the source out as text
+    def text(start, end):
+        if (is_bytes): return source[start : end].decode("utf-8", "replace")
+        return source[start : end]
+
+    # Count the characters in a piece of the source, columns count characters
+    # in bytes sources too
+    def width(start, end):
+        if (is_bytes): return end - start - len(continuation_pattern.findall(source, start, end))
+        return end - start
+
+    # The source ends at the first '\0', like in the character scanner
+    length = source.find(b"\0" if (is_bytes) else "\0")
+    if (length == -1): length = len(source)
+
+    column = 1
+
+    for match in pattern.finditer(source, 0, length):
+
+        group = match.lastgroup
+        start, end = match.span(match.lastindex or 0)
+
+        # Spacing before the token
+        column += start - match.start()
+
+        # Identifier
+        if (group == "identifier"):
+            kind = keywords.get(text(start, end), TOKEN_IDENTIFIER)
+
+        # Operator
+        elif (group == "operator"):
+            kind = operators[text(start, end)]
+
+        # New line, the column counts the new line itself
+        elif (group == "newline"):
+            line  += 1
+            column = 2
+            continue
+
+        # Number
+        elif (group == "number"):
+            kind = TOKEN_NUMBER
+
+        # String
+        elif (group == "string"):
+            kind = TOKEN_STRING
+            line += source[start : end].count(newline)
+
+        # Comment, the new line after it is matched on its own
+        elif (group == "comment"):
+            if (end == length):
+                line  += 1
+                column = 1
+            continue
+
+        # Unterminated String
+        elif (group == "unterminated"):
+            line   += source[start : end].count(newline)
+            column += width(start, end)
+            yield Token(TOKEN_ERROR, UNTERMINATED_STRING, len(UNTERMINATED_STRING), line, column)
+            continue
+
+        # Unexpected character
+        elif (group == "error"):
+            column += 1
+
+            # In a bytes source the character may span several bytes
+            if (is_bytes):
+                while (end < length and 0x80 <= source[end] < 0xC0): end += 1
+
+            message = "Unexpected character '{0}'.".format(text(start, end))
+            yield Token(TOKEN_ERROR, message, len(message), line, column)
+            continue
+
+        # Trailing spacing
+        else:
+            column += end - start
+            continue
+
+        column += width(start, end) if (kind == TOKEN_STRING) else end - start
+
+        # The content stays in the source until the compiler asks for it
+        yield TokenView(kind, source, start, end - start, line, column)
+
+    # End
+    yield Token(TOKEN_END, "", -1, line, column)
+
+# Open a script for scanning, memory-mapped when possible
+def open_source(file_name):
+
+    with open(file_name, "rb") as f:
+
+        # Empty files can't be mapped
+        try:
+            return mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        except ValueError:
+            return f.read()
+
 # Initialize Scanner
-def scanner_init(source):
+def scanner_init(scanner, source, bulk = True, line = 1):
 
     scanner.source = source
     scanner.length = len(source)
 
+    scanner.start   = 0
+    scanner.current = 0
+
+    scanner.line   = line
+    scanner.column = 1
+
+    # Tokens are produced lazily in bulk mode, the character scanner needs
+    # a text source
+    scanner.bulk   = bulk
+    scanner.tokens = tokenize(source, line) if (bulk) else None
+    scanner.end    = None
+
 # Make Token
-def make_token(kind):
+def make_token(scanner, kind):
 
     return Token(kind, scanner.source[scanner.start : scanner.current],
             scanner.current - scanner.start, scanner.line, scanner.column)
 
 # Make Error Token
-def make_error_token(message):
+def make_error_token(scanner, message):
 
     return Token(TOKEN_ERROR, message, 
             len(message), scanner.line, scanner.column)
 
 # Is scanner end?
-def is_end():
+def is_end(scanner):
 
     # Current index is bigger than source length
     if (scanner.current >= scanner.length): return True
     return (scanner.source[scanner.current] == '\0')
 
 # Advance scanner
-def advance():
+def advance(scanner):
 
     # Only advance if current index is not bigger than source length
     if (scanner.current < scanner.length): 
@@ -67,57 +242,54 @@ def advance():
     return scanner.source[scanner.current - 1]
 
 # Peek current character
-def peek():
+def peek(scanner):
 
-    if (is_end()): return '\0'
+    if (is_end(scanner)): return '\0'
     return scanner.source[scanner.current]
 
 # Peek next character
-def peek_next():
+def peek_next(scanner):
 
-    if (is_end()): return '\0'
+    if (is_end(scanner)): return '\0'
     return scanner.source[scanner.current + 1]
 
 # Current character matches the expected character?
-def match(expected):
+def match(scanner, expected):
 
-    if (is_end()):           return False
-    if (peek() != expected): return False
+    if (is_end(scanner)):           return False
+    if (peek(scanner) != expected): return False
 
-    advance()
+    advance(scanner)
     return True
 
 # Skip Whitespace
-def skip_whitespace():
+def skip_whitespace(scanner):
 
     while (True):
 
-        c = peek()
+        c = peek(scanner)
 
         # Spacing
         if (c in " \r\t"):
-            advance()
-            break
+            advance(scanner)
         elif (c == '\n'): # New Line
             scanner.line += 1
             scanner.column = 1
-            advance()
-            break
+            advance(scanner)
         elif (c == '#'): # Comment
             # Loop until a new line
-            while (peek() != '\n' and not is_end()):
-                advance()
+            while (peek(scanner) != '\n' and not is_end(scanner)):
+                advance(scanner)
 
             # Jump the new line
             scanner.line += 1
             scanner.column = 1
-            advance()
-            break
+            advance(scanner)
         else:
             return
 
 # Get identifier type
-def identifier_type():
+def identifier_type(scanner):
 
     # Get keyword name
     keyword = scanner.source[scanner.start : scanner.current]
@@ -130,124 +302,144 @@ def identifier_type():
     return TOKEN_IDENTIFIER
 
 # Make Identifier Token
-def make_identifier():
+def make_identifier(scanner):
 
     # Loop while an alpha or digit character
-    while (is_alpha(peek()) or is_digit(peek())):
-        advance()
+    while (is_alpha(peek(scanner)) or is_digit(peek(scanner))):
+        advance(scanner)
 
     # Make the token and return it
-    return make_token(identifier_type())
+    return make_token(scanner, identifier_type(scanner))
 
 # Make Number Token
-def make_number():
+def make_number(scanner):
 
     # Loop while a digit
-    while (is_digit(peek())):
-        advance()
+    while (is_digit(peek(scanner))):
+        advance(scanner)
 
     # Fractional?
-    if (peek() == '.' and is_digit(peek_next())):
+    if (peek(scanner) == '.' and is_digit(peek_next(scanner))):
 
         # Advance the dot part
-        advance()
+        advance(scanner)
 
         # Loop while a digit
-        while (is_digit(peek())):
-            advance()
+        while (is_digit(peek(scanner))):
+            advance(scanner)
 
     # Make the token and return it
-    return make_token(TOKEN_NUMBER)
+    return make_token(scanner, TOKEN_NUMBER)
 
 # Make String Token
-def make_string():
+def make_string(scanner):
 
     # Loop until "
-    while (peek() != '"' and not is_end()):
+    while (peek(scanner) != '"' and not is_end(scanner)):
+
+        # Escaped character, like \", is kept for the compiler to decode
+        if (peek(scanner) == '\\'):
+            advance(scanner)
+            if (is_end(scanner)): break
 
         # New line?
-        if (peek() == '\n'): scanner.line += 1
-        advance()
+        if (peek(scanner) == '\n'): scanner.line += 1
+        advance(scanner)
 
     # No matching "
-    if (is_end()): return make_error_token("Unterminated string.")
+    if (is_end(scanner)): return make_error_token(scanner, UNTERMINATED_STRING)
 
     # Advance the " part
-    advance()
+    advance(scanner)
 
     # Make the token and return it
-    return make_token(TOKEN_STRING)
+    return make_token(scanner, TOKEN_STRING)
 
 # Scan Token
-def scan_token():
+def scan_token(scanner):
+
+    # Bulk mode, take the next token from the stream
+    if (scanner.bulk):
+        return stream_token(scanner)
 
     # Skip Whitespace
-    skip_whitespace()
+    skip_whitespace(scanner)
     scanner.start = scanner.current
 
     # Is End?
-    if (is_end()):
+    if (is_end(scanner)):
         scanner.start = scanner.current + 1
-        return make_token(TOKEN_END)
+        return make_token(scanner, TOKEN_END)
 
     # Advance
-    c = advance()
+    c = advance(scanner)
 
     # Check character(s)
-    if (is_alpha(c)): return make_identifier() # Identifier
-    if (is_digit(c)): return make_number()     # Number
-
-    if (c == '('):   return make_token(TOKEN_LEFT_PAREN)       # (
-    elif (c == ')'): return make_token(TOKEN_RIGHT_PAREN)      # )
-    elif (c == '{'): return make_token(TOKEN_LEFT_BRACE)       # {
-    elif (c == '}'): return make_token(TOKEN_RIGHT_BRACE)      # }
-    elif (c == '['): return make_token(TOKEN_LEFT_BRACKET)     # [
-    elif (c == ']'): return make_token(TOKEN_RIGHT_BRACKET)    # ]
-    elif (c == ';'): return make_token(TOKEN_SEMICOLON)        # ;
-    elif (c == ','): return make_token(TOKEN_COMMA)            # ,
-    elif (c == '.'): return make_token(TOKEN_DOT)              # .
-    elif (c == '?'): return make_token(TOKEN_QUESTION)         # ?
-    elif (c == ':'): return make_token(TOKEN_COLON)            # :
+    if (is_alpha(c)): return make_identifier(scanner) # Identifier
+    if (is_digit(c)): return make_number(scanner)     # Number
+
+    if (c == '('):   return make_token(scanner, TOKEN_LEFT_PAREN)       # (
+    elif (c == ')'): return make_token(scanner, TOKEN_RIGHT_PAREN)      # )
+    elif (c == '{'): return make_token(scanner, TOKEN_LEFT_BRACE)       # {
+    elif (c == '}'): return make_token(scanner, TOKEN_RIGHT_BRACE)      # }
+    elif (c == '['): return make_token(scanner, TOKEN_LEFT_BRACKET)     # [
+    elif (c == ']'): return make_token(scanner, TOKEN_RIGHT_BRACKET)    # ]
+    elif (c == ';'): return make_token(scanner, TOKEN_SEMICOLON)        # ;
+    elif (c == ','): return make_token(scanner, TOKEN_COMMA)            # ,
+    elif (c == '.'): return make_token(scanner, TOKEN_DOT)              # .
+    elif (c == '?'): return make_token(scanner, TOKEN_QUESTION)         # ?
+    elif (c == ':'): return make_token(scanner, TOKEN_COLON)            # :
     elif (c == '-'): 
-        if (match('-')): return make_token(TOKEN_MINUS_MINUS)  # --
-        if (match('=')): return make_token(TOKEN_MINUS_EQUAL)  # -=
-        return make_token(TOKEN_MINUS)                         # -
+        if (match(scanner, '-')): return make_token(scanner, TOKEN_MINUS_MINUS)  # --
+        if (match(scanner, '=')): return make_token(scanner, TOKEN_MINUS_EQUAL)  # -=
+        return make_token(scanner, TOKEN_MINUS)                         # -
     elif (c == '+'): 
-        if (match('+')): return make_token(TOKEN_PLUS_PLUS)    # ++
-        if (match('=')): return make_token(TOKEN_PLUS_EQUAL)   # +=
-        return make_token(TOKEN_PLUS)                          # +
+        if (match(scanner, '+')): return make_token(scanner, TOKEN_PLUS_PLUS)    # ++
+        if (match(scanner, '=')): return make_token(scanner, TOKEN_PLUS_EQUAL)   # +=
+        return make_token(scanner, TOKEN_PLUS)                          # +
     elif (c == '/'): 
-        if (match('=')): return make_token(TOKEN_SLASH_EQUAL)  # /=
-        return make_token(TOKEN_SLASH)                         # /
+        if (match(scanner, '=')): return make_token(scanner, TOKEN_SLASH_EQUAL)  # /=
+        return make_token(scanner, TOKEN_SLASH)                         # /
     elif (c == '*'):
-        if (match('=')): return make_token(TOKEN_STAR_EQUAL)   # *=
-        return make_token(TOKEN_STAR)                          # *
+        if (match(scanner, '=')): return make_token(scanner, TOKEN_STAR_EQUAL)   # *=
+        return make_token(scanner, TOKEN_STAR)                          # *
     elif (c == '%'):
-        if (match('=')): return make_token(TOKEN_PERCENT_EQUAL) # %=
-        return make_token(TOKEN_PERCENT)                        # %
+        if (match(scanner, '=')): return make_token(scanner, TOKEN_PERCENT_EQUAL) # %=
+        return make_token(scanner, TOKEN_PERCENT)                        # %
     elif (c == '!'): 
-        if (match('=')): return make_token(TOKEN_BANG_EQUAL)   # !=
-        return make_token(TOKEN_BANG)                          # !
+        if (match(scanner, '=')): return make_token(scanner, TOKEN_BANG_EQUAL)   # !=
+        return make_token(scanner, TOKEN_BANG)                          # !
     elif (c == '='): 
-        if (match('=')): return make_token(TOKEN_EQUAL_EQUAL)  # ==
-        return make_token(TOKEN_EQUAL)                         # =
+        if (match(scanner, '=')): return make_token(scanner, TOKEN_EQUAL_EQUAL)  # ==
+        return make_token(scanner, TOKEN_EQUAL)                         # =
     elif (c == '<'): 
-        if (match('=')): return make_token(TOKEN_LESS_EQUAL)   # <=
-        return make_token(TOKEN_LESS)                          # <
+        if (match(scanner, '=')): return make_token(scanner, TOKEN_LESS_EQUAL)   # <=
+        return make_token(scanner, TOKEN_LESS)                          # <
     elif (c == '>'): 
-        if (match('=')): return make_token(TOKEN_GREATER_EQUAL) # >=
-        return make_token(TOKEN_GREATER)                        # >
+        if (match(scanner, '=')): return make_token(scanner, TOKEN_GREATER_EQUAL) # >=
+        return make_token(scanner, TOKEN_GREATER)                        # >
     elif (c == '&'):                                               
-        if (match('&')): return make_token(TOKEN_AND)          # &&
+        if (match(scanner, '&')): return make_token(scanner, TOKEN_AND)          # &&
     elif (c == '|'):                                               
-        if (match('|')): return make_token(TOKEN_OR)           # ||
+        if (match(scanner, '|')): return make_token(scanner, TOKEN_OR)           # ||
     elif (c == '"'):
-        return make_string()  # String
+        return make_string(scanner)  # String
     elif (c in " \r\t#\n"):
         # We probably found spacing here, so skip that spacing, scan again and 
         # return that scanned token
-        skip_whitespace()
-        return scan_token()
+        skip_whitespace(scanner)
+        return scan_token(scanner)
 
     # Unexpected character
-    return make_error_token("Unexpected character '{0}'.".format(c))
\ No newline at end of file
+    return make_error_token(scanner, "Unexpected character '{0}'.".format(c))
+
+# Get next token from the token generator
+def stream_token(scanner):
+
+    # Stay at the end token once reached
+    if (scanner.end != None): return scanner.end
+
+    token = next(scanner.tokens)
+    if (token.kind == TOKEN_END): scanner.end = token
+
+    return token
\ No newline at end of file
@@ -70,4 +70,30 @@ class Token():
         self.content = content
         self.length  = length
         self.line    = line
-        self.column  = column
\ No newline at end of file
+        self.column  = column
+
+# Token View, the content is only copied out of the source when needed
+class TokenView(Token):
+
+    # Initialize
+    def __init__(self, kind, source, start, length, line, column):
+
+        self.kind   = kind
+        self.source = source
+        self.start  = start
+        self.length = length
+        self.line   = line
+        self.column = column
+
+    # Get content
+    @property
+    def content(self):
+
+        content = self.source[self.start : self.start + self.length]
+
+        # Memory-mapped and bytes sources hold utf-8, bytes that aren't
+        # valid utf-8 become U+FFFD like in the rest of the scanner
+        if (type(content) != str):
+            content = content.decode("utf-8", "replace")
+
+        return content
\ No newline at end of file
@@ -1,3 +1,5 @@
+import sys
+
 # Check if character is an alpha
 def is_alpha(c):
     return ((c >= 'a' and c <= 'z') or
@@ -13,4 +15,9 @@ def to_number(v):
     try:
         return float(v)
     except ValueError:
-        return str(v)
\ No newline at end of file
+        return str(v)
+
+# Raise the Python recursion limit to at least limit, it is never lowered
+# again, so code running in other threads keeps the room it counted on
+def ensure_recursion_limit(limit):
+    if (sys.getrecursionlimit() < limit): sys.setrecursionlimit(limit)